@@ -9,7 +9,6 @@ from numpy.core.numeric import False_
 import torch
 import torch.nn
 
-import matplotlib.pyplot as plt
 
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_only
@@ -18,6 +17,13 @@ from pytorch_lightning.utilities import rank_zero_only
 import tools
 import lib
 
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Fixed batch used by the visualizations of each split
+VISUALIZATION_BATCH_SIZE = 3
+VISUALIZATION_SEED = 0
+
 #-------------------------------------------------------------------------------
 # Classes
 
@@ -53,24 +59,59 @@ class MyCallback(pl.callbacks.Callback):
         else:
             self.checkpoint_monitor = checkpoint_monitor
 
-    @rank_zero_only
+        # Rendering the figures in background processes (if requested)
+        if self.HPARAM.ASYNC_FIGURES:
+            self.renderer = tools.figure_renderer.AsyncFigureRenderer(
+                num_workers=self.HPARAM.FIGURE_RENDER_WORKERS,
+                max_pending=self.HPARAM.FIGURE_MAX_PENDING
+            )
+        else:
+            self.renderer = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+
+        # Following the resolution schedule of the training samples (all ranks)
+        if hasattr(trainer.datamodule, 'update_resolution'):
+            trainer.datamodule.update_resolution(trainer.current_epoch)
+
+        # Rotating the shards of the ranks (all ranks)
+        if hasattr(trainer.datamodule, 'set_epoch'):
+            trainer.datamodule.set_epoch(trainer.current_epoch)
+
+        # Starting the statistics of the epoch
+        pl_module.running_metrics['train'].reset()
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+
+        # Starting the statistics of the epoch
+        pl_module.running_metrics['valid'].reset()
+
     def on_train_epoch_end(self, trainer, pl_module, outputs):
 
+        # Reducing the statistics of the epoch (every rank takes part)
+        epoch_metrics = pl_module.running_metrics['train'].compute()
+
         # Performing the shared functions of logging after end of epoch
-        self.shared_epoch_end('train', trainer, pl_module)
+        self.shared_epoch_end('train', trainer, pl_module, epoch_metrics)
 
-    @rank_zero_only
     def on_validation_epoch_end(self, trainer, pl_module):
 
+        # Reducing the statistics of the epoch (every rank takes part)
+        epoch_metrics = pl_module.running_metrics['valid'].compute()
+
         # Performing the shared functions of logging after end of epoch
-        self.shared_epoch_end('valid', trainer, pl_module)
+        self.shared_epoch_end('valid', trainer, pl_module, epoch_metrics)
 
         # If a checkpoint system has been request it, perform it
+        self.save_best_checkpoints(trainer, pl_module, epoch_metrics)
+
+    @rank_zero_only
+    def save_best_checkpoints(self, trainer, pl_module, epoch_metrics):
+
         if self.checkpoint_monitor:
 
             # Creating variable for possible metrics to monitor
-            # Removing /batch from the metrics
-            monitorable_metrics = [x.replace('/batch', '') for x in list(pl_module.logger.log['valid'].keys())]
+            monitorable_metrics = list(epoch_metrics.keys())
 
             # If there is nothing logged yet, this must be the sanity test. Skip this.
             if monitorable_metrics == []:
@@ -91,7 +132,7 @@ class MyCallback(pl.callbacks.Callback):
                     comparison = operator.ge
 
                 # Obtaining the values that need to be compared
-                current_value = pl_module.logger.log['valid'][monitor_name+'/batch'][0]
+                current_value = epoch_metrics[monitor_name]['mean']
                 best_value = monitor_data['best_value']
 
                 # If current is better than best, then update
@@ -125,10 +166,22 @@ class MyCallback(pl.callbacks.Callback):
         return None
 
     @rank_zero_only
-    def shared_epoch_end(self, mode, trainer, pl_module):
+    def shared_epoch_end(self, mode, trainer, pl_module, epoch_metrics):
 
         # Log the average for the metrics for each epoch
-        self.log_epoch_average(mode, trainer, pl_module)
+        self.log_epoch_average(mode, trainer, epoch_metrics)
+
+        # Log the hits/misses of the decoded-image cache (if used)
+        self.log_epoch_cache_stats(mode, trainer, pl_module)
+
+        # Log the batch wait times of the shared-memory loader or prefetcher (if used)
+        self.log_epoch_loader_stats(mode, trainer, pl_module)
+
+        # Log the rendered/dropped/failed figures of the background renderer (if used)
+        self.log_epoch_renderer_stats(mode, trainer, pl_module)
+
+        # Single forward pass of the fixed visualization batch
+        self.run_visualization_batch(mode, trainer, pl_module)
 
         # Depending on the task, create the correct visualization
         if 'mask' in self.tasks:
@@ -160,217 +213,274 @@ class MyCallback(pl.callbacks.Callback):
             self.log_epoch_pose(mode, trainer, pl_module)
 
     @rank_zero_only
-    def log_epoch_average(self, mode, trainer, pl_module):
-
-        log = pl_module.logger.log[mode]
+    def log_epoch_average(self, mode, trainer, epoch_metrics):
 
-        for log_name in log.keys():
+        for log_name, statistics in epoch_metrics.items():
 
-            # Removing the /batch to make it epoch level
-            tb_log_name = log_name.replace('/batch', '')
+            # Epoch level average (nan if the metric was always nan)
+            epoch_log = {f'{log_name}/epoch': statistics['mean']}
 
-            # Move all items inside the logger into cuda:0
-            if pl_module.on_gpu:
-                cuda_0_log = [x.to('cuda:0').float() for x in log[log_name] if torch.isnan(x) != True]
-            else:
-                cuda_0_log = [x.to('cpu').float() for x in log[log_name] if torch.isnan(x) != True]
-
-            # If cuda_0_log is not empty, then determine the average
-            if cuda_0_log:
-                average = torch.mean(torch.stack(cuda_0_log))
-            
-            else: # else just use nan as the average
-                if pl_module.on_gpu:
-                    average = torch.tensor(float('nan')).to('cuda:0').float()
-                else:
-                    average = torch.tensor(float('nan')).to('cpu').float()
+            # and its standard deviation (if tracked)
+            if 'std' in statistics.keys():
+                epoch_log[f'{log_name}/epoch_std'] = statistics['std']
 
             # Log the average
             trainer.logger.log_metrics(
                 mode, 
-                {f'{tb_log_name}/epoch': average},
-                trainer.current_epoch+1,
-                store=False
+                epoch_log,
+                trainer.current_epoch+1
             )
 
-            # Store the average as the initial value of the next epoch log
-            pl_module.logger.log[mode][log_name] = [average]
+    @rank_zero_only
+    def log_epoch_cache_stats(self, mode, trainer, pl_module):
 
-        # After an epoch, we clear out the log
-        #pl_module.logger.clear_metrics(mode)
+        # Accessing the cache of the corresponding dataset
+        cache = getattr(trainer.datamodule.datasets[mode], 'cache', None)
 
-    #---------------------------------------------------------------------------
-    # Visualizations
+        if cache is None:
+            return None
 
-    # MASK 
-    @rank_zero_only
-    def log_epoch_mask(self, mode, trainer, pl_module):
+        # Log the statistics of the epoch
+        cache_stats = cache.get_stats()
+        trainer.logger.log_metrics(
+            mode,
+            {f'cache/{k}': v for k,v in cache_stats.items()},
+            trainer.current_epoch+1
+        )
 
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
+        # Starting the counters again for the next epoch
+        cache.reset_stats()
 
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
+    @rank_zero_only
+    def log_epoch_loader_stats(self, mode, trainer, pl_module):
 
-        # Obtaining the corresponding colormap from the dataset
-        colormap = dataset.COLORMAP
+        # Accessing the shared-memory loader or prefetcher of the corresponding dataset
+        loader = getattr(trainer.datamodule, 'loaders', {}).get(mode, None)
 
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
+        if loader is None:
+            return None
 
-        # Given the sample, make the prediction with the PyTorch Lightning Module
-        with torch.no_grad():
-            outputs = pl_module(torch.from_numpy(sample['image']).float().to(pl_module.device))
-        
-        # Obtaining the categorical predicted mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
+        # Log the per-batch wait of the epoch
+        loader_stats = loader.get_stats()
+        trainer.logger.log_metrics(
+            mode,
+            {f'loader/{k}': v for k,v in loader_stats.items()},
+            trainer.current_epoch+1
+        )
 
-        # Create the summary figure
-        summary_fig = tools.vz.compare_mask_performance(sample, pred_cat_mask, colormap)
+        # Starting the wait times again for the next epoch
+        loader.reset_stats()
 
-        # Log the figure to tensorboard
-        pl_module.logger.writers[mode].add_figure(f'mask_gen/{mode}', summary_fig, trainer.global_step)
-    
-    # QUAT
     @rank_zero_only
-    def log_epoch_quat(self, mode, trainer, pl_module):
-        
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
+    def log_epoch_renderer_stats(self, mode, trainer, pl_module):
 
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
+        if self.renderer is None:
+            return None
 
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
+        # Log the figures handled since the last epoch end (of any split)
+        renderer_stats = self.renderer.get_stats()
+        trainer.logger.log_metrics(
+            mode,
+            {f'figures/{k}': v for k,v in renderer_stats.items()},
+            trainer.current_epoch+1
+        )
 
-        # Given the sample, make the prediciton with the PyTorch Lightning Moduel
-        with torch.no_grad():
-            outputs = pl_module(torch.from_numpy(sample['image']).float().to(pl_module.device))
-        
-        # Applying activation function to the mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
+        # Starting the counters again for the next epoch
+        self.renderer.reset_stats()
 
-        # Selecting the quaternion from the output
-        # https://pytorch.org/docs/stable/nn.functional.html?highlight=activation%20functions
-        pred_quaternion = outputs['quaternion'].cpu().numpy()
+    #---------------------------------------------------------------------------
+    # Visualizations
 
-        # Create the pose figure
-        summary_fig = tools.vz.compare_quat_performance(
-            sample, 
-            pred_quaternion, 
-            pred_cat_mask=pred_cat_mask, 
-            mask_colormap=dataset.COLORMAP
-        )
+    def get_visualization_batch(self, mode, trainer, pl_module):
 
-        # Log the figure to tensorboard
-        pl_module.logger.writers[mode].add_figure(f'quat_gen/{mode}', summary_fig, trainer.global_step)      
+        # Building the fixed batch of the split only once (same samples every
+        # epoch, stacked in a single pass)
+        if mode not in self.visualization_samples.keys():
+
+            dataset = trainer.datamodule.datasets[mode]
+            sample_ids = np.random.RandomState(VISUALIZATION_SEED).choice(
+                np.arange(len(dataset)),
+                size=min(VISUALIZATION_BATCH_SIZE, len(dataset)),
+                replace=False
+            )
+            self.visualization_samples[mode] = dataset.get_batched_sample(sample_ids)
+
+        # Keeping the batch resident in the device of the model
+        batch = self.visualization_batches.get(mode, None)
+        if batch is None or batch['image'].device != pl_module.device:
+            batch = {k:torch.from_numpy(v).to(pl_module.device) for k,v in self.visualization_samples[mode].items()}
+            self.visualization_batches[mode] = batch
+
+        return self.visualization_samples[mode], batch
 
-    # XY
     @rank_zero_only
-    def log_epoch_xy(self, mode, trainer, pl_module):
+    def setup(self, trainer, pl_module, stage):
 
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
+        # Creating the visualization batches of the splits
+        self.visualization_samples = {}
+        self.visualization_batches = {}
 
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
+        datamodule = getattr(trainer, 'datamodule', None)
+        if datamodule is not None and hasattr(datamodule, 'datasets'):
+            for mode in datamodule.datasets.keys():
+                self.get_visualization_batch(mode, trainer, pl_module)
 
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
+    @rank_zero_only
+    def run_visualization_batch(self, mode, trainer, pl_module):
 
-        # Given the sample, make the prediciton with the PyTorch Lightning Moduel
-        with torch.no_grad():
-            outputs = pl_module(torch.from_numpy(sample['image']).float().to(pl_module.device))
-        
-        # Applying activation function to the mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
+        if not hasattr(self, 'visualization_samples'):
+            self.visualization_samples = {}
+            self.visualization_batches = {}
 
-        # Selecting the quaternion from the output
-        # https://pytorch.org/docs/stable/nn.functional.html?highlight=activation%20functions
-        pred_xy = outputs['xy'].cpu().numpy()
+        sample, batch = self.get_visualization_batch(mode, trainer, pl_module)
 
-        # Create the pose figure
-        summary_fig = tools.vz.compare_xy_performance(
-            sample, 
-            pred_xy, 
-            pred_cat_mask=pred_cat_mask, 
-            mask_colormap=dataset.COLORMAP
-        )
+        # A single forward pass (and aggregation) shared by all the visualizations
+        with torch.no_grad():
+            outputs = pl_module.model(batch['image'].float(), batch.get('intrinsics'))
+
+            if self.HPARAM.PERFORM_AGGREGATION and self.HPARAM.PERFORM_MATCHING:
+
+                # Obtain the matches between aggregated predictions and ground truth data
+                agg_gt = pl_module.model.agg_hough_and_generate_RT(
+                    batch['mask'],
+                    data=batch,
+                    inv_intrinsics=torch.inverse(batch['intrinsics']) if 'intrinsics' in batch else None
+                )
+
+                # Determine matches between the aggreated ground truth and preds
+                gt_pred_matches = lib.gtf.batchwise_find_matches(
+                    outputs['auxilary']['agg_pred'],
+                    agg_gt
+                )
+            else:
+                gt_pred_matches = None
 
-        # Log the figure to tensorboard
-        pl_module.logger.writers[mode].add_figure(f'xy_gen/{mode}', summary_fig, trainer.global_step)      
+        self.visualization = {
+            'sample': sample,
+            'batch': batch,
+            'outputs': outputs,
+            'pred_cat_mask': outputs['auxilary']['cat_mask'].cpu().numpy(),
+            'gt_pred_matches': gt_pred_matches
+        }
 
-    # Z
     @rank_zero_only
-    def log_epoch_z(self, mode, trainer, pl_module):
-        
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
+    def log_figure(self, mode, trainer, pl_module, tag, function_name, *args, **kwargs):
+
+        # Rendering in the background (the data is copied to the CPU)
+        if self.renderer is not None:
+            self.renderer.submit(
+                pl_module.logger.writers[mode].log_dir,
+                tag,
+                trainer.global_step,
+                function_name,
+                *args,
+                **kwargs
+            )
 
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
+        # or right away
+        else:
+            summary_image = getattr(tools.vz, function_name)(*args, **kwargs)
+            pl_module.logger.writers[mode].add_image(tag, summary_image, trainer.global_step, dataformats='HWC')
 
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
+    # MASK 
+    @rank_zero_only
+    def log_epoch_mask(self, mode, trainer, pl_module):
 
-        # Given the sample, make the prediciton with the PyTorch Lightning Moduel
-        with torch.no_grad():
-            outputs = pl_module(torch.from_numpy(sample['image']).float().to(pl_module.device))
-        
-        # Applying activation function to the mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
+        # Obtaining the corresponding colormap from the dataset
+        colormap = trainer.datamodule.datasets[mode].COLORMAP
+
+        # Create the figure and log it to tensorboard
+        self.log_figure(
+            mode,
+            trainer,
+            pl_module,
+            f'mask_gen/{mode}',
+            'compare_mask_performance',
+            self.visualization['sample'],
+            self.visualization['pred_cat_mask'],
+            colormap
+        )
+    
+    # QUAT
+    @rank_zero_only
+    def log_epoch_quat(self, mode, trainer, pl_module):
 
         # Selecting the quaternion from the output
-        # https://pytorch.org/docs/stable/nn.functional.html?highlight=activation%20functions
-        pred_z = outputs['z'].cpu().numpy()
-
-        # Create the pose figure
-        summary_fig = tools.vz.compare_z_performance(
-            sample, 
-            pred_z, 
-            pred_cat_mask=pred_cat_mask, 
-            mask_colormap=dataset.COLORMAP
+        pred_quaternion = self.visualization['outputs']['quaternion'].cpu().numpy()
+
+        # Create the figure and log it to tensorboard
+        self.log_figure(
+            mode,
+            trainer,
+            pl_module,
+            f'quat_gen/{mode}',
+            'compare_quat_performance',
+            self.visualization['sample'], 
+            pred_quaternion, 
+            pred_cat_mask=self.visualization['pred_cat_mask'], 
+            mask_colormap=trainer.datamodule.datasets[mode].COLORMAP
         )
 
-        # Log the figure to tensorboard
-        pl_module.logger.writers[mode].add_figure(f'z_gen/{mode}', summary_fig, trainer.global_step)      
-
-    # SCALES
+    # XY
     @rank_zero_only
-    def log_epoch_scales(self, mode, trainer, pl_module):
-
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
+    def log_epoch_xy(self, mode, trainer, pl_module):
 
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
+        # Selecting the xy from the output
+        pred_xy = self.visualization['outputs']['xy'].cpu().numpy()
+
+        # Create the figure and log it to tensorboard
+        self.log_figure(
+            mode,
+            trainer,
+            pl_module,
+            f'xy_gen/{mode}',
+            'compare_xy_performance',
+            self.visualization['sample'], 
+            pred_xy, 
+            pred_cat_mask=self.visualization['pred_cat_mask'], 
+            mask_colormap=trainer.datamodule.datasets[mode].COLORMAP
+        )
 
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
+    # Z
+    @rank_zero_only
+    def log_epoch_z(self, mode, trainer, pl_module):
 
-        # Given the sample, make the prediciton with the PyTorch Lightning Moduel
-        with torch.no_grad():
-            outputs = pl_module(torch.from_numpy(sample['image']).float().to(pl_module.device))
-        
-        # Applying activation function to the mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
+        # Selecting the z from the output
+        pred_z = self.visualization['outputs']['z'].cpu().numpy()
+
+        # Create the figure and log it to tensorboard
+        self.log_figure(
+            mode,
+            trainer,
+            pl_module,
+            f'z_gen/{mode}',
+            'compare_z_performance',
+            self.visualization['sample'], 
+            pred_z, 
+            pred_cat_mask=self.visualization['pred_cat_mask'], 
+            mask_colormap=trainer.datamodule.datasets[mode].COLORMAP
+        )
 
-        # Selecting the quaternion from the output
-        # https://pytorch.org/docs/stable/nn.functional.html?highlight=activation%20functions
-        pred_scales = outputs['scales'].cpu().numpy()
+    # SCALES
+    @rank_zero_only
+    def log_epoch_scales(self, mode, trainer, pl_module):
 
-        # Create the pose figure
-        summary_fig = tools.vz.compare_scales_performance(
-            sample, 
+        # Selecting the scales from the output
+        pred_scales = self.visualization['outputs']['scales'].cpu().numpy()
+
+        # Create the figure and log it to tensorboard
+        self.log_figure(
+            mode,
+            trainer,
+            pl_module,
+            f'scales_gen/{mode}',
+            'compare_scales_performance',
+            self.visualization['sample'], 
             pred_scales, 
-            pred_cat_mask=pred_cat_mask, 
-            mask_colormap=dataset.COLORMAP
+            pred_cat_mask=self.visualization['pred_cat_mask'], 
+            mask_colormap=trainer.datamodule.datasets[mode].COLORMAP
         )
 
-        # Log the figure to tensorboard
-        pl_module.logger.writers[mode].add_figure(f'scales_gen/{mode}', summary_fig, trainer.global_step)      
-
     # HOUGH VOTING
     @rank_zero_only
     def log_epoch_hough_voting(self, mode, trainer, pl_module):
@@ -381,46 +491,17 @@ class MyCallback(pl.callbacks.Callback):
             self.HPARAM.PERFORM_HOUGH_VOTING == False:
             return
 
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
-
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
-
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
-
-        # Trimming the batch, to make visualization easier to see
-        batch = {k:torch.from_numpy(v).to(pl_module.device) for k,v in sample.items()}
-
-        # Given the sample, make the prediciton with the PyTorch Lightning Moduel
-        with torch.no_grad():
-            outputs = pl_module(batch['image'].float())
-
-        # Applying activation function to the mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
-
-        # Obtain the matches between aggregated predictions and ground truth data
-        agg_gt = pl_module.model.agg_hough_and_generate_RT(
-            batch['mask'],
-            data=batch
-        )
-
-        # Determine matches between the aggreated ground truth and preds
-        gt_pred_matches = lib.gtf.batchwise_find_matches(
-            outputs['auxilary']['agg_pred'],
-            agg_gt
+        # Create the figure and log it to tensorboard
+        self.log_figure(
+            mode,
+            trainer,
+            pl_module,
+            f'hough_voting_gen/{mode}',
+            'compare_hough_voting_performance',
+            self.visualization['batch']['clean_image'],
+            self.visualization['gt_pred_matches']
         )
 
-        # Create summary for the pose
-        summary_fig = tools.vz.compare_hough_voting_performance(
-            batch['clean_image'],
-            gt_pred_matches
-        )
-
-        # Log the figure to tensorboard
-        pl_module.logger.writers[mode].add_figure(f'hough_voting_gen/{mode}', summary_fig, trainer.global_step)
-
     # POSE
     @rank_zero_only
     def log_epoch_pose(self, mode, trainer, pl_module):
@@ -429,50 +510,24 @@ class MyCallback(pl.callbacks.Callback):
         if self.HPARAM.PERFORM_AGGREGATION == False or self.HPARAM.PERFORM_MATCHING == False:
             return
 
-        # Obtaining the LightningDataModule
-        datamodule = trainer.datamodule
-
-        # Accessing the corresponding dataset
-        dataset = datamodule.datasets[mode]
-
-        # Get random sample
-        sample = dataset.get_random_batched_sample(batch_size=3)
-
-        # Trimming the batch, to make visualization easier to see
-        batch = {k:torch.from_numpy(v).to(pl_module.device) for k,v in sample.items()}
-
-        # Given the sample, make the prediciton with the PyTorch Lightning Moduel
-        with torch.no_grad():
-            outputs = pl_module(batch['image'].float())
+        dataset = trainer.datamodule.datasets[mode]
+        batch = self.visualization['batch']
 
-        # Applying activation function to the mask
-        pred_cat_mask = outputs['auxilary']['cat_mask'].cpu().numpy()
-
-        # Obtain the matches between aggregated predictions and ground truth data
-        agg_gt = pl_module.model.agg_hough_and_generate_RT(
-            batch['mask'],
-            data=batch
-        )
-
-        # Determine matches between the aggreated ground truth and preds
-        gt_pred_matches = lib.gtf.batchwise_find_matches(
-            outputs['auxilary']['agg_pred'],
-            agg_gt
-        )
-
-        # Create summary for the pose
+        # Create the figure and log it to tensorboard
         try:
-            summary_fig = tools.vz.compare_pose_performance_v5(
+            self.log_figure(
+                mode,
+                trainer,
+                pl_module,
+                f'pose_gen/{mode}',
+                'compare_pose_performance_v5',
                 batch['clean_image'],
-                gt_pred_matches,
-                pred_cat_mask,
+                self.visualization['gt_pred_matches'],
+                self.visualization['pred_cat_mask'],
                 mask_colormap=dataset.COLORMAP,
-                intrinsics=dataset.INTRINSICS
+                intrinsics=self.visualization['sample'].get('intrinsics', [dataset.INTRINSICS])[0]
             )
 
-            # Log the figure to tensorboard
-            pl_module.logger.writers[mode].add_figure(f'pose_gen/{mode}', summary_fig, trainer.global_step)      
-
         except Exception as e:
             print('pose visualization error: ', e)
         
@@ -482,6 +537,10 @@ class MyCallback(pl.callbacks.Callback):
     @rank_zero_only
     def teardown(self, trainer, pl_module, stage):
         
+        # Waiting for the figures still being rendered
+        if self.renderer is not None:
+            self.renderer.close()
+
         """
         # Log hyper parameters:
             - Using the initialization parameter self.hparams, we use that as the
@@ -23,6 +23,31 @@ class DEFAULT_POSE_HPARAM(argparse.Namespace):
     NUM_GPUS = 0# 1 # 4 total GPUs
     TRAIN_SIZE= 100#5000#100
     VALID_SIZE= 20#300#20
+    COMPILED_DATASET = False # use the compiled (memory-mapped) dense targets
+    DATASET_INDEX = False # use the persistent dataset index (no startup scan, written in $DATASET_INDEX_DIR)
+    SHARDED_DATASET = False # stream the samples from sequential tar shards
+    SHUFFLE_BUFFER_SIZE = 1000 # shuffle buffer of the sharded dataset
+    SAMPLE_CACHE_SIZE = 0 # GB of decoded images cached per split and per GPU process (0 = disabled)
+    COMPACT_TRANSPORT = False # uint8 mask and int16 dense targets from the workers
+    DEVICE_DENSE_TARGETS = False # workers only send instances, dense targets made on the device
+    DATASET_AGG_GT = False # aggregated ground truth from the _meta+ values (no GT hough voting, requires PERFORM_MATCHING)
+    SHM_LOADER = False # persistent workers writing into a pinned shared-memory batch ring
+    SHM_RING_SIZE = None # number of batches in the ring (None = 2 * NUM_WORKERS + 2)
+    PREFETCH_DEPTH = 0 # batches loaded and copied to the device in the background (0 = disabled)
+    BATCH_AUGMENTATION = False # batched photometric and zoom/translation augmentation on the device
+    BATCH_AUGMENTATION_SEED = 0
+    CROP_SIZE = None # (h, w) training crops around a random instance (None = full image)
+    RESOLUTION_SCHEDULE = None # {epoch: scale} of the training samples, e.g. {0: 0.5, 10: 0.75, 20: 1.0}
+    SUBSET_SEED = None # TRAIN_SIZE/VALID_SIZE select a random subset instead of the first samples
+    BALANCED_SAMPLING = False # oversample the rare selected classes (per-sample class counts)
+    TARGET_CLASS_DISTRIBUTION = None # fraction of the instances of each selected class (None = uniform)
+    ASYNC_FIGURES = False # render the epoch figures in background processes
+    FIGURE_RENDER_WORKERS = 2
+    FIGURE_MAX_PENDING = 16 # figures beyond this are dropped instead of blocking
+    TRACK_METRIC_VARIANCE = False # also log the per-epoch std of the losses and metrics
+    ASYNC_SCALARS = False # write the per-batch scalars from a background thread (one host transfer per batch)
+    SCALAR_FLUSH_INTERVAL = 10 # seconds between the flushes of the event files
+    SCALAR_DECIMATION = 1 # write every Nth per-batch value, an int or {metric_name: N}
 
     # Training Specifications
     WEIGHT_DECAY = 0.0003
@@ -37,6 +62,8 @@ class DEFAULT_POSE_HPARAM(argparse.Namespace):
     FREEZE_ROTATION_TRAINING = False
     FREEZE_TRANSLATION_TRAINING = False
     FREEZE_SCALES_TRAINING = False
+    FEATURE_CACHE = False # decoder-only training from the cached encoder features (requires FREEZE_ENCODER)
+    FEATURE_CACHE_DTYPE = 'float16' # 'float16' or 'float32' cached features
 
     # Algorithmic Training Specifications
     PERFORM_AGGREGATION = True
@@ -48,6 +75,7 @@ class DEFAULT_POSE_HPARAM(argparse.Namespace):
     BACKBONE_ARCH = 'FPN'
     ENCODER = 'resnet18' #'resnext50_32x4d'
     ENCODER_WEIGHTS = 'imagenet'
+    DECODER_SHARING = 'separate' # 'separate' (FPN decoder per task), 'shared' or 'adapters' (one FPN decoder)
 
     # Algorithmic Parameters
     
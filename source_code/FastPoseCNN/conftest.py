@@ -0,0 +1,14 @@
+import os
+import sys
+import pathlib
+
+import dotenv
+
+# Loading the environment variables of the project (paths) before the tools
+# and lib packages are imported by the tests
+root = pathlib.Path(os.path.abspath(__file__)).parent
+dotenv.load_dotenv(str(root / '.env'))
+
+sys.path.append(str(root))
+sys.path.append(str(root / 'tools'))
+sys.path.append(str(root / 'lib'))
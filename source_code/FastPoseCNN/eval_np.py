@@ -10,7 +10,6 @@ import pandas as pd
 import torch
 import torch.nn as nn
 import numpy as np
-import matplotlib.pyplot as plt
 import skimage.io
 
 import pytorch_lightning.overrides.data_parallel as pl_o_d
@@ -205,20 +204,18 @@ if __name__ == '__main__':
                     )
 
                     # Visually compare all inputs and outputs of this single sample
-                    single_sample_performance_fig = tools.vz.compare_all(
+                    single_sample_performance_image = tools.vz.compare_all(
                         single_preds, 
                         single_gts,
                         mask_colormap = valid_dataset.COLORMAP
                     )
 
-                    # Save the figure into the images folder
-                    single_sample_performance_fig.savefig(
-                        str(images_path / f'{image_counter}.png')
+                    # Save the image grid into the images folder
+                    skimage.io.imsave(
+                        str(images_path / f'{image_counter}.png'),
+                        single_sample_performance_image
                     )
 
-                    # Clear matplotlib
-                    plt.clf()
-
                 # Update image counter
                 image_counter += 1
 
@@ -0,0 +1,156 @@
+# Imports
+import os
+import sys
+import argparse
+import pathlib
+import itertools
+
+import torch
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+# Local Imports
+import setup_env
+import tools
+import lib
+import train
+from config import DEFAULT_POSE_HPARAM
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Post-training int8 quantization report
+
+Quantizes a trained PoseRegressor (see lib/quantization.py) with the first
+--num_calibration_batches batches of the validation split, then evaluates the
+float and the int8 models on the following --num_eval_batches batches and
+reports the degree/offset/3D IoU AP deltas (lib/metrics) and the CPU speedup:
+
+    python eval_quantized.py --checkpoint $LOGS/.../last.ckpt --num_calibration_batches 32 --num_eval_batches 100
+
+The regression heads stay in float by default (--float_modules), use
+--float_modules without values to quantize them too.
+"""
+
+#-------------------------------------------------------------------------------
+# Constants
+
+PATH = pathlib.Path(os.getenv("LOGS")) / 'good_saved_runs' / '09-23-LONG_RUN_N51_GPU4_IQR_PRUN-NOCS-resnet18-imagenet' / '_' / 'checkpoints' / 'last.ckpt'
+
+HPARAM = DEFAULT_POSE_HPARAM()
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def create_pose_metrics():
+
+    # The AP metrics of the training ('pose' task)
+    return {
+        'degree_error_AP_5': lib.metrics.DegreeErrorMeanAP(5),
+        'degree_error_AP_10': lib.metrics.DegreeErrorMeanAP(10),
+        'iou_3d_mAP_0.25': lib.metrics.Iou3dAP(0.25),
+        'iou_3d_mAP_0.5': lib.metrics.Iou3dAP(0.5),
+        'offset_error_AP_5cm': lib.metrics.OffsetAP(5),
+        'offset_error_AP_10cm': lib.metrics.OffsetAP(10)
+    }
+
+#-------------------------------------------------------------------------------
+# File Main
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Quantize a PoseRegressor to int8 and report the AP deltas and the speedup')
+    parser.add_argument('--checkpoint', type=pathlib.Path, default=PATH)
+    parser.add_argument('--num_calibration_batches', type=int, default=32)
+    parser.add_argument('--num_eval_batches', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=HPARAM.BATCH_SIZE)
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=['fbgemm', 'x86', 'qnnpack'])
+    parser.add_argument('--float_modules', type=str, nargs='*', default=lib.quantization.DEFAULT_FLOAT_MODULES)
+    parser.add_argument('--num_of_runs', type=int, default=10)
+    parser.add_argument('--num_of_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_of_threads is not None:
+        torch.set_num_threads(args.num_of_threads)
+
+    # Load from checkpoint
+    checkpoint = torch.load(args.checkpoint, map_location=torch.device('cpu'))
+    OLD_HPARAM = checkpoint['hyper_parameters']
+
+    # Merge the NameSpaces between the model's hyperparameters and
+    # the evaluation hyperparameters
+    for attr in OLD_HPARAM.keys():
+        setattr(HPARAM, attr, OLD_HPARAM[attr])
+
+    # The AP metrics need the complete post-processing
+    HPARAM.PERFORM_AGGREGATION = True
+    HPARAM.PERFORM_HOUGH_VOTING = True
+    HPARAM.PERFORM_RT_CALCULATION = True
+    HPARAM.PERFORM_MATCHING = True
+
+    # Create model
+    base_model = lib.PoseRegressor(
+        HPARAM,
+        intrinsics=torch.from_numpy(tools.pj.constants.INTRINSICS[HPARAM.DATASET_NAME]).float(),
+        architecture=HPARAM.BACKBONE_ARCH,
+        encoder_name=HPARAM.ENCODER,
+        encoder_weights=HPARAM.ENCODER_WEIGHTS,
+        classes=len(HPARAM.SELECTED_CLASSES),
+        decoder_sharing=HPARAM.DECODER_SHARING
+    )
+
+    # Create PyTorch Lightning Module
+    model = train.PoseRegresssionTask.load_from_checkpoint(
+        str(args.checkpoint),
+        model=base_model,
+        criterion=None,
+        metrics=None,
+        HPARAM=HPARAM
+    )
+
+    # Put the model into evaluation mode
+    model.freeze()
+    model.eval()
+
+    # Load the PyTorch Lightning dataset (enough validation samples for both
+    # the calibration and the evaluation)
+    datamodule = train.PoseRegressionDataModule(
+        dataset_name=HPARAM.DATASET_NAME,
+        selected_classes=HPARAM.SELECTED_CLASSES,
+        batch_size=args.batch_size,
+        num_workers=HPARAM.NUM_WORKERS,
+        encoder=HPARAM.ENCODER,
+        encoder_weights=HPARAM.ENCODER_WEIGHTS,
+        train_size=1,
+        valid_size=(args.num_calibration_batches + args.num_eval_batches) * args.batch_size
+    )
+    datamodule.setup()
+
+    batches = list(itertools.islice(datamodule.val_dataloader(), args.num_calibration_batches + args.num_eval_batches))
+    calibration_batches = batches[:args.num_calibration_batches]
+    eval_batches = batches[args.num_calibration_batches:]
+
+    # Quantizing the model
+    quantized_model = lib.quantization.quantize_pose_regressor(
+        model.model,
+        calibration_batches,
+        backend=args.backend,
+        float_modules=args.float_modules
+    )
+
+    print(f'Quantized modules: {quantized_model.quantized_modules}')
+
+    # Comparing the float and the quantized models
+    report = lib.quantization.report_quantization(
+        model.model,
+        quantized_model,
+        eval_batches,
+        create_pose_metrics,
+        num_of_runs=args.num_of_runs
+    )
+
+    # Saving the report next to the checkpoint
+    report_path = args.checkpoint.parent.parent / f'quantization_{args.backend}_report.json'
+    tools.jt.save_to_json(report_path, report)
+    print(f'Saved the report to {report_path}')
@@ -10,7 +10,6 @@ import pandas as pd
 import torch
 import torch.nn as nn
 import numpy as np
-import matplotlib.pyplot as plt
 import skimage.io
 
 import pytorch_lightning.overrides.data_parallel as pl_o_d
@@ -72,6 +71,7 @@ if __name__ == '__main__':
             encoder_name=HPARAM.ENCODER,
             encoder_weights=HPARAM.ENCODER_WEIGHTS,
             classes=len(HPARAM.SELECTED_CLASSES),
+            decoder_sharing=HPARAM.DECODER_SHARING
         )
 
         # Create PyTorch Lightning Module
@@ -140,8 +140,8 @@ if __name__ == '__main__':
                 # Accounting for the new image
                 image_counter += 1
                 
-                # Generating massive figure
-                gt_fig, pred_fig, poses_fig = tools.vz.compare_all_performance(
+                # Generating massive image grids
+                gt_image, pred_image, poses_image = tools.vz.compare_all_performance(
                     batch,
                     outputs,
                     gt_pred_matches,
@@ -149,16 +149,10 @@ if __name__ == '__main__':
                     valid_dataset.COLORMAP
                 )
 
-                # Saving figure
-                gt_fig.savefig(
-                    str(images_path / f'{image_counter}_gt.png')
-                )
-                pred_fig.savefig(
-                    str(images_path / f'{image_counter}_pred.png')
-                )
-                poses_fig.savefig(
-                    str(images_path / f'{image_counter}_poses.png')
-                )
+                # Saving image grids
+                skimage.io.imsave(str(images_path / f'{image_counter}_gt.png'), gt_image)
+                skimage.io.imsave(str(images_path / f'{image_counter}_pred.png'), pred_image)
+                skimage.io.imsave(str(images_path / f'{image_counter}_poses.png'), poses_image)
                 
 
             # Saving the matched data
@@ -6,4 +6,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import loss
 import gpu_tensor_funcs as gtf
 import metrics 
-from pose_regressor import PoseRegressor
\ No newline at end of file
+from pose_regressor import PoseRegressor
+from dense_targets import DenseTargetGenerator
+import onnx_backend
+import quantization
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class DenseTargetGenerator(nn.Module):
+    """
+    Generating the dense ground truth on the training device from the instance
+    mask and the padded per-instance tables of NOCSPoseRegDataset(dense_targets=False).
+    Equivalent to tools.dm.create_dense_targets, but batched and with a single
+    gather from the instance-id map.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+    def forward(self, batch):
+        """
+        Args:
+            batch (dict):
+                instance_mask: [B, H, W] 0 for the background, k+1 for the k-th row
+                instance_quaternion: [B, K, 4]
+                instance_scales: [B, K, 3]
+                instance_center_2d: [B, K, 2] (x, y) projected 3D center
+                instance_z: [B, K] log of the depth of the 3D center
+        Output:
+            dense_targets (dict): quaternion [B,4,H,W], scales [B,3,H,W],
+                xy [B,2,H,W], z [B,H,W]
+        """
+
+        instance_mask = batch['instance_mask'].long()
+        b, h, w = instance_mask.shape
+        device = instance_mask.device
+
+        # Tables with a first row of zeros for the background
+        table = torch.cat([
+            batch['instance_quaternion'].float(),
+            batch['instance_scales'].float(),
+            batch['instance_center_2d'].float(),
+            torch.unsqueeze(batch['instance_z'].float(), dim=-1)
+        ], dim=-1)
+        table = torch.cat([torch.zeros_like(table[:, :1]), table], dim=1)
+
+        # Gathering the rows of all the pixels
+        index = instance_mask.reshape((b, h*w, 1)).expand(-1, -1, table.shape[-1])
+        dense = torch.gather(table, 1, index).reshape((b, h, w, -1))
+
+        foreground = instance_mask > 0
+
+        # Quaternion, scales and z are uniform per instance
+        quaternion = dense[..., 0:4]
+        scales = dense[..., 4:7]
+        z = dense[..., 9]
+
+        # Constructing the unit vectors pointing to the center
+        ys, xs = torch.meshgrid(
+            torch.arange(h, device=device, dtype=torch.float32),
+            torch.arange(w, device=device, dtype=torch.float32)
+        )
+        dx = dense[..., 7] - xs
+        dy = dense[..., 8] - ys
+        norm = torch.sqrt(dx*dx + dy*dy)
+
+        # The pixel at the center and the background have no direction
+        valid = foreground & (norm > 0)
+        safe_norm = torch.where(valid, norm, torch.ones_like(norm))
+        xy = torch.stack([
+            torch.where(valid, dx / safe_norm, torch.zeros_like(dx)),
+            torch.where(valid, dy / safe_norm, torch.zeros_like(dy))
+        ], dim=-1)
+
+        dense_targets = {
+            'quaternion': quaternion.permute(0, 3, 1, 2).contiguous(),
+            'scales': scales.permute(0, 3, 1, 2).contiguous(),
+            'xy': xy.permute(0, 3, 1, 2).contiguous(),
+            'z': z.contiguous()
+        }
+
+        return dense_targets
@@ -613,7 +613,12 @@ def batchwise_get_RT(q, xys, exp_zs, inv_intrinsics):
 
     # First construct the translation vector matrix
     homogenous_xyzs = torch.vstack([projected_xys.T, exp_zs.T/1000])
-    T = inv_intrinsics @ homogenous_xyzs # torch.inverse(intrinsics) @ homo_xyz
+
+    # (per-instance intrinsics [N, 3, 3], e.g. of cropped samples)
+    if inv_intrinsics.dim() == 3:
+        T = torch.squeeze(inv_intrinsics @ torch.unsqueeze(homogenous_xyzs.T, dim=-1), dim=-1).T
+    else:
+        T = inv_intrinsics @ homogenous_xyzs # torch.inverse(intrinsics) @ homo_xyz
 
     # Then create R
     norm = q.norm(dim=1)
@@ -654,13 +659,19 @@ def samplewise_get_RT(agg_data, inv_intrinsics):
 
     for class_id in range(len(agg_data)):
 
+        # Per-sample intrinsics [B, 3, 3] are selected for each instance
+        if inv_intrinsics.dim() == 3:
+            class_inv_intrinsics = inv_intrinsics[agg_data[class_id]['sample_ids']]
+        else:
+            class_inv_intrinsics = inv_intrinsics
+
         # Once all the raw data has been aggregated, we need to calculate the 
         # rotation matrix of each instance.
         R_data, T_data, RT_data = batchwise_get_RT(
             agg_data[class_id]['quaternion'],
             agg_data[class_id]['xy'],
             agg_data[class_id]['z'],
-            inv_intrinsics
+            class_inv_intrinsics
         )
 
         # Storing generated RT
@@ -670,6 +681,24 @@ def samplewise_get_RT(agg_data, inv_intrinsics):
 
     return agg_data
 
+def complete_agg_gt(agg_gt, instance_mask, xy=None):
+
+    # Completing the ground truth aggregated by the dataset (on the device)
+    # with the instance masks (and the masked unit vectors)
+    for class_id in range(len(agg_gt)):
+
+        sample_ids = agg_gt[class_id]['sample_ids']
+        instance_ids = agg_gt[class_id]['instance_ids']
+
+        # Selecting the pixels of each instance from the instance mask
+        instance_masks = (instance_mask[sample_ids].long() == (instance_ids + 1).reshape((-1,1,1))).float()
+        agg_gt[class_id]['instance_masks'] = instance_masks
+
+        if xy is not None:
+            agg_gt[class_id]['xy_mask'] = torch.unsqueeze(instance_masks, dim=1) * xy[sample_ids]
+
+    return agg_gt
+
 #-------------------------------------------------------------------------------
 # Generative/Conversion Functions
 
@@ -3,8 +3,6 @@ import sys
 import time
 import argparse
 
-import matplotlib.pyplot as plt
-
 import torch
 import torch.nn as nn
 
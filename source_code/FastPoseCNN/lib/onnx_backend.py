@@ -0,0 +1,371 @@
+import os
+import sys
+import copy
+import time
+import inspect
+import pathlib
+import argparse
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+# Local imports
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import gpu_tensor_funcs as gtf
+import aggregation_layer as al
+import hough_voting as hv
+from pose_regressor import PoseRegressor, LOGIT_KEYS
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# ONNX Runtime CPU backend
+
+To serve the PoseRegressor on CPU-only machines, the dense part of the
+pipeline (encoder, decoders, heads, categorical mask and class_compress2) is
+exported as a single ONNX graph, with a dynamic batch size and the image size
+fixed at export time:
+
+    inputs: 'image' [B,3,H,W]
+    outputs: 'mask' [B,C,H,W], 'cat_mask' [B,H,W], 'quaternion' [B,4,H,W],
+        'scales' [B,3,H,W], 'xy' [B,2,H,W], 'z' [B,H,W]
+
+The ONNXPoseRegressor runs the graph with ONNX Runtime (CPUExecutionProvider)
+and then the existing torch post-processing (aggregation, hough voting and RT,
+as configured by the HPARAM), with the same output structure as
+PoseRegressor.forward.
+
+Exporting a checkpoint, checking the parity of the ONNX Runtime outputs with
+the eager PyTorch ones and comparing their latency at batch sizes 1, 4 and 8:
+
+    python onnx_backend.py --checkpoint last.ckpt --onnx_path pose_regressor.onnx
+
+onnx and onnxruntime are only needed by this module (imported when used).
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+INPUT_NAMES = ['image']
+OUTPUT_NAMES = ['mask', 'cat_mask'] + LOGIT_KEYS
+
+DEFAULT_OPSET_VERSION = 11
+
+# Maximum absolute difference of the logits for the parity check
+PARITY_ATOL = 1e-3
+
+# (of the normalized quaternion and xy, the normalization of near-zero
+# vectors amplifies the float differences)
+PARITY_UNIT_ATOL = 1e-2
+
+# Minimum fraction of the categorical mask pixels agreeing for the parity
+# check (argmax ties can flip with float differences)
+PARITY_MIN_AGREEMENT = 0.999
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class DensePipeline(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+
+        # Saving parameters
+        self.model = model
+
+    def forward(self, x):
+
+        # Dense outputs of the network
+        mask_logits, logits = self.model.forward_dense(x)
+
+        # Create categorical mask
+        cat_mask = torch.argmax(torch.nn.LogSoftmax(dim=1)(mask_logits), dim=1)
+
+        # Class compression of the data
+        cc_logits = gtf.class_compress2(self.model.classes, cat_mask, logits)
+
+        return (mask_logits, cat_mask, *[cc_logits[k] for k in LOGIT_KEYS])
+
+class ONNXPoseRegressor():
+
+    def __init__(self, onnx_path, HPARAM, intrinsics, classes, num_of_threads=None):
+
+        import onnxruntime
+
+        # Storing crucial parameters
+        self.HPARAM = HPARAM
+        self.classes = classes
+        self.intrinsics = intrinsics
+        self.inv_intrinsics = torch.inverse(self.intrinsics)
+
+        # ONNX Runtime session of the dense pipeline (CPU)
+        session_options = onnxruntime.SessionOptions()
+        if num_of_threads is not None:
+            session_options.intra_op_num_threads = num_of_threads
+
+        self.session = onnxruntime.InferenceSession(
+            str(onnx_path),
+            session_options,
+            providers=['CPUExecutionProvider']
+        )
+
+        # Post-processing layers (same as PoseRegressor)
+        self.aggregation_layer = al.AggregationLayer(
+            self.HPARAM,
+            self.classes
+        )
+        self.hough_voting_layer = hv.HoughVotingLayer(
+            self.HPARAM
+        )
+
+    def forward_dense(self, x):
+        """
+        Args:
+            x (torch.Tensor or np.ndarray): [B,3,H,W] input images
+        Output:
+            outputs (dict): the OUTPUT_NAMES torch tensors (on the CPU)
+        """
+
+        x = x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else x
+        onnx_outputs = self.session.run(OUTPUT_NAMES, {'image': x.astype(np.float32)})
+
+        return {k:torch.from_numpy(v) for k,v in zip(OUTPUT_NAMES, onnx_outputs)}
+
+    def forward(self, x, intrinsics=None):
+
+        # Per-sample intrinsics (of cropped/resized samples) replace the camera's
+        inv_intrinsics = None if intrinsics is None else torch.inverse(intrinsics.float())
+
+        # Dense outputs from ONNX Runtime
+        outputs = self.forward_dense(x)
+        cc_logits = {k:outputs[k] for k in LOGIT_KEYS}
+
+        # Perform aggregation, hough voting, and generate RT matrix given the
+        # results of previous operations.
+        agg_pred = self.agg_hough_and_generate_RT(
+            outputs['cat_mask'],
+            cc_logits,
+            inv_intrinsics
+        )
+
+        # Generating complete output
+        output = {
+            'mask': outputs['mask'],
+            **cc_logits,
+            'auxilary': {
+                'cat_mask': outputs['cat_mask'],
+                'agg_pred': agg_pred
+            }
+        }
+
+        return output
+
+    def __call__(self, x, intrinsics=None):
+        return self.forward(x, intrinsics)
+
+    def agg_hough_and_generate_RT(self, cat_mask, data, inv_intrinsics=None):
+
+        # The torch post-processing of the PoseRegressor (same attributes)
+        return PoseRegressor.agg_hough_and_generate_RT(self, cat_mask, data, inv_intrinsics)
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def export_onnx(model, onnx_path, image_size=(480, 640), opset_version=DEFAULT_OPSET_VERSION):
+    """
+    Args:
+        model (PoseRegressor): the model to export (not modified)
+        onnx_path (pathlib.Path): destination of the ONNX graph
+        image_size (tuple): (h, w) of the input images (fixed)
+        opset_version (int): ONNX opset
+    Output:
+        onnx_path (pathlib.Path): the exported (and checked) ONNX graph
+    """
+
+    import onnx
+
+    # A CPU copy in evaluation mode (dropout and batchnorm)
+    pipeline = DensePipeline(copy.deepcopy(model).cpu().eval())
+    x = torch.rand((1, 3, *image_size))
+
+    # Only the batch size is dynamic
+    dynamic_axes = {k:{0: 'batch'} for k in INPUT_NAMES + OUTPUT_NAMES}
+
+    # The TorchScript-based exporter (the default of torch.onnx.export until
+    # the dynamo exporter, which needs onnxscript, replaced it)
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters.keys():
+        export_kwargs['dynamo'] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            pipeline,
+            x,
+            str(onnx_path),
+            opset_version=opset_version,
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes=dynamic_axes,
+            **export_kwargs
+        )
+
+    # Validating the graph
+    onnx.checker.check_model(onnx.load(str(onnx_path)))
+
+    return pathlib.Path(onnx_path)
+
+def check_onnx_parity(model, onnx_runner, x):
+    """
+    Args:
+        model (PoseRegressor): the eager PyTorch model
+        onnx_runner (ONNXPoseRegressor): the exported model
+        x (torch.Tensor): [B,3,H,W] input images
+    Output:
+        results (dict): maximum absolute difference of each output (for the
+            cat_mask, the fraction of agreeing pixels) and 'passed' (within
+            the PARITY_* tolerances)
+    """
+
+    pipeline = DensePipeline(copy.deepcopy(model).cpu().eval())
+
+    with torch.no_grad():
+        torch_outputs = dict(zip(OUTPUT_NAMES, pipeline(x.cpu())))
+
+    onnx_outputs = onnx_runner.forward_dense(x)
+
+    # Pixels with the same class in both categorical masks
+    agreement = torch_outputs['cat_mask'] == onnx_outputs['cat_mask']
+
+    results = {'cat_mask': agreement.float().mean().item()}
+    for key in ['mask'] + LOGIT_KEYS:
+
+        difference = (torch_outputs[key] - onnx_outputs[key]).abs()
+
+        # The class compressed logits are only compared where the classes agree
+        if key != 'mask':
+            difference = difference * (agreement.unsqueeze(1) if difference.dim() == 4 else agreement)
+
+        results[key] = difference.max().item()
+
+    results['passed'] = results['cat_mask'] >= PARITY_MIN_AGREEMENT and \
+        all([results[k] <= PARITY_ATOL for k in ['mask', 'scales', 'z']]) and \
+        all([results[k] <= PARITY_UNIT_ATOL for k in ['quaternion', 'xy']])
+
+    for key, value in results.items():
+        print(f'{key}: {value}')
+
+    return results
+
+def benchmark_onnx(model, onnx_runner, image_size=(480, 640), batch_sizes=(1, 4, 8), num_of_runs=10):
+    """
+    Args:
+        model (PoseRegressor): the eager PyTorch model
+        onnx_runner (ONNXPoseRegressor): the exported model
+        image_size (tuple): (h, w) of the input images
+        batch_sizes (list): batch sizes to time
+        num_of_runs (int): number of timed passes per batch size
+    Output:
+        results (dict): per batch size, the mean CPU latency (ms) of the dense
+            pipeline with PyTorch and ONNX Runtime
+    """
+
+    pipeline = DensePipeline(copy.deepcopy(model).cpu().eval())
+    results = {}
+
+    for batch_size in batch_sizes:
+
+        x = torch.rand((batch_size, 3, *image_size))
+        results[batch_size] = {}
+
+        for name, run_fn in [('torch', pipeline), ('onnxruntime', onnx_runner.forward_dense)]:
+
+            # Warming up before timing
+            with torch.no_grad():
+                for _ in range(2):
+                    run_fn(x)
+
+                start_time = time.perf_counter()
+                for _ in range(num_of_runs):
+                    run_fn(x)
+                latency = (time.perf_counter() - start_time) / num_of_runs
+
+            results[batch_size][f'{name}_latency_ms'] = latency * 1000
+
+        print(
+            f"batch size {batch_size}: "
+            f"torch {results[batch_size]['torch_latency_ms']:.1f}ms, "
+            f"onnxruntime {results[batch_size]['onnxruntime_latency_ms']:.1f}ms "
+            f"({results[batch_size]['torch_latency_ms']/results[batch_size]['onnxruntime_latency_ms']:.2f}x)"
+        )
+
+    return results
+
+#-------------------------------------------------------------------------------
+# File Main
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export the PoseRegressor to ONNX, check its parity and compare the CPU latency')
+    parser.add_argument('--checkpoint', type=pathlib.Path, default=None)
+    parser.add_argument('--onnx_path', type=pathlib.Path, default=pathlib.Path('pose_regressor.onnx'))
+    parser.add_argument('--encoder', type=str, default='resnet18')
+    parser.add_argument('--classes', type=int, default=3)
+    parser.add_argument('--decoder_sharing', type=str, default='separate')
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--opset_version', type=int, default=DEFAULT_OPSET_VERSION)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--num_of_runs', type=int, default=10)
+    parser.add_argument('--num_of_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_of_threads is not None:
+        torch.set_num_threads(args.num_of_threads)
+
+    # The architecture (and weights) of the checkpoint, if given
+    HPARAM = argparse.Namespace()
+    state_dict = None
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location='cpu')
+        HPARAM = argparse.Namespace(**checkpoint['hyper_parameters'])
+        args.encoder = HPARAM.ENCODER
+        args.classes = len(HPARAM.SELECTED_CLASSES)
+        args.decoder_sharing = getattr(HPARAM, 'DECODER_SHARING', 'separate')
+        state_dict = {k[len('model.'):]:v for k,v in checkpoint['state_dict'].items() if k.startswith('model.')}
+
+    model = PoseRegressor(
+        HPARAM,
+        intrinsics=torch.eye(3),
+        encoder_name=args.encoder,
+        encoder_weights=None,
+        classes=args.classes,
+        decoder_sharing=args.decoder_sharing
+    ).eval()
+
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+
+    # Exporting, checking the parity and timing
+    export_onnx(model, args.onnx_path, (args.height, args.width), args.opset_version)
+
+    onnx_runner = ONNXPoseRegressor(
+        args.onnx_path,
+        HPARAM,
+        intrinsics=torch.eye(3),
+        classes=args.classes,
+        num_of_threads=args.num_of_threads
+    )
+
+    check_onnx_parity(model, onnx_runner, torch.rand((2, 3, args.height, args.width)))
+
+    benchmark_onnx(
+        model,
+        onnx_runner,
+        (args.height, args.width),
+        batch_sizes=args.batch_sizes,
+        num_of_runs=args.num_of_runs
+    )
@@ -1,6 +1,8 @@
 from typing import Optional, Union
 import os
+import time
 import base64
+import argparse
 
 import numpy as np
 from numpy.core.fromnumeric import compress
@@ -18,6 +20,102 @@ import aggregation_layer as al
 import hough_voting as hv
 
 #-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Decoder sharing
+
+By default (decoder_sharing='separate'), each task (mask, rotation,
+translation and scales) has its own FPN decoder on the encoder features, so
+the decoder FLOPs and activations are 4 times those of a single decoder. The
+other options use a single FPN decoder (trunk) for all the tasks:
+
+    'shared': the heads are applied directly on the trunk output.
+    'adapters': each task has a light adapter (3x3 conv, batchnorm and relu)
+        between the trunk and its head.
+
+The task attributes (mask_decoder, rotation_decoder, ...) are then the
+task-specific part of the decoder (the adapters), so freezing a task (FREEZE_*)
+does not freeze the shared trunk (self.decoder).
+
+The parameters, FLOPs and CPU latency of the variants are compared with:
+
+    python pose_regressor.py --encoder resnet18 --height 480 --width 640
+
+# Cached encoder features
+
+With a frozen encoder, forward(x, features=...) skips the encoder and feeds
+the given features (e.g. from tools.feature_cache) to the decoders. Only the
+levels used by the FPN decoders (the last 4) are needed.
+
+# Task-selective inference
+
+forward always computes every output. predict(x, outputs) only runs the
+decoders, heads and post-processing stages the requested outputs depend on:
+
+    'mask': mask decoder and segmentation head
+    'quaternion', 'scales': mask and rotation/scales branches, class compression
+    'xy', 'z': mask and translation branch, class compression
+    'cat_mask': mask branch and argmax
+    'agg_pred': everything (aggregation, hough voting and RT)
+
+For example, predict(x, ['mask']) for a cheap segmentation pre-filter, or
+predict(x, ['mask', 'quaternion']) for an orientation-only service. The
+latency of such output sets is compared with:
+
+    python pose_regressor.py --benchmark selective --encoder resnet18
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+DECODER_SHARING_OPTIONS = ['separate', 'shared', 'adapters']
+
+# Dense outputs (logits) and the decoder/head branch computing each one
+OUTPUT_BRANCHES = {
+    'mask': 'mask',
+    'quaternion': 'rotation',
+    'scales': 'scales',
+    'xy': 'translation',
+    'z': 'translation'
+}
+DENSE_OUTPUTS = list(OUTPUT_BRANCHES.keys())
+LOGIT_KEYS = ['quaternion', 'scales', 'xy', 'z']
+
+# Outputs of the post-processing stages
+OUTPUTS = DENSE_OUTPUTS + ['cat_mask', 'agg_pred']
+
+# Output sets compared by benchmark_selective_inference
+SELECTIVE_BENCHMARK_OUTPUT_SETS = [
+    ['mask'],
+    ['mask', 'quaternion'],
+    ['mask', 'xy', 'z'],
+    DENSE_OUTPUTS
+]
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_required_outputs(outputs):
+
+    required_outputs = set(outputs)
+
+    # The aggregation uses all the (class compressed) logits
+    if 'agg_pred' in required_outputs:
+        required_outputs.update(OUTPUTS)
+
+    # The class compression of the logits uses the categorical mask
+    if required_outputs & set(LOGIT_KEYS):
+        required_outputs.add('cat_mask')
+
+    # which comes from the mask logits
+    if 'cat_mask' in required_outputs:
+        required_outputs.add('mask')
+
+    return required_outputs
+
+#-------------------------------------------------------------------------------
+# Classes
 
 class PoseRegressor(torch.nn.Module):
 
@@ -41,7 +139,8 @@ class PoseRegressor(torch.nn.Module):
         in_channels: int = 3,
         classes: int = 2, # bg and one more class
         activation: Optional[str] = None,
-        upsampling: int = 4
+        upsampling: int = 4,
+        decoder_sharing: str = 'separate'
         ):
 
         super().__init__()
@@ -72,14 +171,31 @@ class PoseRegressor(torch.nn.Module):
                 'merge_policy': decoder_merge_policy,
             }
 
-            self.mask_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
-            self.rotation_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
-            self.translation_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
-            self.scales_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
+            # A decoder per task
+            if decoder_sharing == 'separate':
+                self.decoder = None
+                self.mask_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
+                self.rotation_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
+                self.translation_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
+                self.scales_decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
+                decoder_out_channels = self.mask_decoder.out_channels
+
+            # A decoder (trunk) shared by all the tasks, followed by the task
+            # adapters (if any)
+            elif decoder_sharing in ['shared', 'adapters']:
+                self.decoder = smp.fpn.decoder.FPNDecoder(**param_dict)
+                decoder_out_channels = self.decoder.out_channels
+                self.mask_decoder = self.create_task_adapter(decoder_sharing, decoder_out_channels)
+                self.rotation_decoder = self.create_task_adapter(decoder_sharing, decoder_out_channels)
+                self.translation_decoder = self.create_task_adapter(decoder_sharing, decoder_out_channels)
+                self.scales_decoder = self.create_task_adapter(decoder_sharing, decoder_out_channels)
+
+            else:
+                raise RuntimeError(f'Invalid decoder sharing: {decoder_sharing}, possible include {DECODER_SHARING_OPTIONS}')
 
         # Obtain segmentation head
         self.segmentation_head = smp.base.SegmentationHead(
-            in_channels=self.mask_decoder.out_channels,
+            in_channels=decoder_out_channels,
             out_channels=classes,
             activation=activation,
             kernel_size=1,
@@ -88,7 +204,7 @@ class PoseRegressor(torch.nn.Module):
 
         # Creating rotation head (quaternion or rotation matrix)
         self.rotation_head = smp.base.SegmentationHead(
-            in_channels=self.rotation_decoder.out_channels,
+            in_channels=decoder_out_channels,
             out_channels=4*(classes-1), # Removing the background
             activation=activation,
             kernel_size=1,
@@ -97,7 +213,7 @@ class PoseRegressor(torch.nn.Module):
 
         # Creating translation head (xyz)
         self.translation_head = smp.base.SegmentationHead(
-            in_channels=self.translation_decoder.out_channels,
+            in_channels=decoder_out_channels,
             out_channels=3*(classes-1), # Removing the background
             activation=activation,
             kernel_size=1,
@@ -106,7 +222,7 @@ class PoseRegressor(torch.nn.Module):
 
         # Creating scales head (height, width, and length)
         self.scales_head = smp.base.SegmentationHead(
-            in_channels=self.scales_decoder.out_channels,
+            in_channels=decoder_out_channels,
             out_channels=3*(classes-1), # Removing the background
             activation=activation,
             kernel_size=1,
@@ -125,6 +241,9 @@ class PoseRegressor(torch.nn.Module):
         )
 
         # initialize the network
+        if self.decoder is not None:
+            init.initialize_decoder(self.decoder)
+
         init.initialize_decoder(self.mask_decoder)
         init.initialize_head(self.segmentation_head)
 
@@ -137,72 +256,149 @@ class PoseRegressor(torch.nn.Module):
         init.initialize_decoder(self.scales_decoder)
         init.initialize_head(self.scales_head)
 
-    def forward(self, x):
+    def create_task_adapter(self, decoder_sharing, channels):
+
+        # The heads directly use the shared decoder output
+        if decoder_sharing == 'shared':
+            return nn.Identity()
+
+        # Light task-specific layer on top of the shared decoder output
+        return nn.Sequential(
+            nn.Conv2d(channels, channels, kernel_size=3, padding=1, bias=False),
+            nn.BatchNorm2d(channels),
+            nn.ReLU(inplace=True)
+        )
+
+    def forward(self, x, intrinsics=None, features=None):
+
+        # All the outputs of the network
+        outputs = self.predict(x, OUTPUTS, intrinsics, features)
+
+        # Generating complete output
+        output = {
+            'mask': outputs['mask'],
+            **{k:outputs[k] for k in LOGIT_KEYS},
+            'auxilary': {
+                'cat_mask': outputs['cat_mask'],
+                'agg_pred': outputs['agg_pred']
+            }
+        }
+
+        return output
+
+    def predict(self, x, outputs, intrinsics=None, features=None):
+        """
+        Args:
+            x (torch.Tensor): [B,3,H,W] input images
+            outputs (iterable): requested outputs, from OUTPUTS (e.g. ['mask']
+                for a segmentation pre-filter or ['mask', 'quaternion'] for the
+                orientation only)
+            intrinsics (torch.Tensor): [B,3,3] per-sample intrinsics
+            features (list): cached encoder features (skips the encoder)
+        Output:
+            predictions (dict): only the requested outputs, the class
+                compressed logits for 'quaternion', 'xy', 'z' and 'scales'
+        Objective:
+            Only run the decoders, heads and post-processing stages needed by
+            the requested outputs (see get_required_outputs).
+        """
+
+        outputs = set(outputs)
+        invalid_outputs = outputs - set(OUTPUTS)
+        if invalid_outputs:
+            raise RuntimeError(f'Invalid outputs: {sorted(invalid_outputs)}, possible include {OUTPUTS}')
+
+        required_outputs = get_required_outputs(outputs)
 
         # Ensuring that intrinsics is in the same device
         if self.intrinsics.device != x.device:
             self.intrinsics = self.intrinsics.to(x.device)
             self.inv_intrinsics = torch.inverse(self.intrinsics)
 
-        # Encoder
-        features = self.encoder(x)
-        
-        # Decoders
-        mask_decoder_output = self.mask_decoder(*features)
-        rotation_decoder_output = self.rotation_decoder(*features)
-        translation_decoder_output = self.translation_decoder(*features)
-        scales_decoder_output = self.scales_decoder(*features)
-
-        # Heads 
-        mask_logits = self.segmentation_head(mask_decoder_output)
-        quat_logits = self.rotation_head(rotation_decoder_output)
-        xyz_logits = self.translation_head(translation_decoder_output)
-        scales_logits = self.scales_head(scales_decoder_output)
+        # Dense outputs of the network (only the required branches)
+        mask_logits, logits = self.forward_dense(
+            x,
+            features,
+            [k for k in DENSE_OUTPUTS if k in required_outputs]
+        )
 
-        # Spliting the (xyz) to (xy, z) since they will eventually have different
-        # ways of computing the loss.
-        xy_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3!=0]) - 1
-        z_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3==0]) + 2
-        xy_logits = xyz_logits[:,xy_index,:,:]
-        z_logits = xyz_logits[:,z_index,:,:]
-
-        # Storing all logits in a dictionary
-        logits = {
-            'quaternion': quat_logits,
-            'scales': scales_logits,
-            'xy': xy_logits,
-            'z': z_logits
-        }
+        predictions = {}
+        if 'mask' in outputs:
+            predictions['mask'] = mask_logits
 
-        # ! Debugging only
-        #return logits
+        if 'cat_mask' not in required_outputs:
+            return predictions
 
         # Create categorical mask
         cat_mask = torch.argmax(torch.nn.LogSoftmax(dim=1)(mask_logits), dim=1)
+        if 'cat_mask' in outputs:
+            predictions['cat_mask'] = cat_mask
 
         # Class compression of the data
         cc_logits = gtf.class_compress2(self.classes, cat_mask, logits)
+        predictions.update({k:v for k,v in cc_logits.items() if k in outputs})
 
         # Perform aggregation, hough voting, and generate RT matrix given the 
         # results of previous operations.
-        agg_pred = self.agg_hough_and_generate_RT(
-            cat_mask,
-            cc_logits
-        )
+        if 'agg_pred' in outputs:
 
-        # Generating complete output
-        output = {
-            'mask': mask_logits,
-            **cc_logits,
-            'auxilary': {
-                'cat_mask': cat_mask,
-                'agg_pred': agg_pred
-            }
-        }
+            # Per-sample intrinsics (of cropped/resized samples) replace the camera's
+            inv_intrinsics = None if intrinsics is None else torch.inverse(intrinsics.float())
 
-        return output
+            predictions['agg_pred'] = self.agg_hough_and_generate_RT(
+                cat_mask,
+                cc_logits,
+                inv_intrinsics
+            )
+
+        return predictions
+
+    def forward_dense(self, x, features=None, outputs=DENSE_OUTPUTS):
 
-    def agg_hough_and_generate_RT(self, cat_mask, data):
+        # The decoder and head branches needed by the outputs
+        branches = list(dict.fromkeys([OUTPUT_BRANCHES[k] for k in outputs]))
+
+        # Encoder, unless its (cached) features are given
+        if features is None:
+            features = self.encoder(x)
+        
+        # Decoders
+        if self.decoder is None:
+            decoder_outputs = {k:getattr(self, f'{k}_decoder')(*features) for k in branches}
+
+        # The shared decoder runs once, then each task adapter
+        else:
+            decoder_output = self.decoder(*features)
+            decoder_outputs = {k:getattr(self, f'{k}_decoder')(decoder_output) for k in branches}
+
+        # Heads 
+        mask_logits = self.segmentation_head(decoder_outputs['mask']) if 'mask' in branches else None
+        logits = {}
+
+        if 'rotation' in branches:
+            logits['quaternion'] = self.rotation_head(decoder_outputs['rotation'])
+
+        if 'scales' in branches:
+            logits['scales'] = self.scales_head(decoder_outputs['scales'])
+
+        # Spliting the (xyz) to (xy, z) since they will eventually have different
+        # ways of computing the loss.
+        if 'translation' in branches:
+            xyz_logits = self.translation_head(decoder_outputs['translation'])
+            xy_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3!=0]) - 1
+            z_index = np.array([i for i in range(xyz_logits.shape[1]) if i%3==0]) + 2
+
+            if 'xy' in outputs:
+                logits['xy'] = xyz_logits[:,xy_index,:,:]
+            if 'z' in outputs:
+                logits['z'] = xyz_logits[:,z_index,:,:]
+
+        return mask_logits, logits
+
+    def agg_hough_and_generate_RT(self, cat_mask, data, inv_intrinsics=None):
+
+        if inv_intrinsics is None:
+            inv_intrinsics = self.inv_intrinsics
 
         # If aggregation is wanted, perform it
         if self.HPARAM.PERFORM_AGGREGATION:
@@ -217,29 +413,190 @@ class PoseRegressor(torch.nn.Module):
                 # If RT calculation is wanted, perform it
                 if self.HPARAM.PERFORM_RT_CALCULATION:
                     # Calculate RT
-                    agg_data = gtf.samplewise_get_RT(agg_data, self.inv_intrinsics)
+                    agg_data = gtf.samplewise_get_RT(agg_data, inv_intrinsics)
 
         return agg_data
 
 #-------------------------------------------------------------------------------
-# File Main
-
-if __name__ == '__main__':
+# Functions (Benchmark)
+
+def count_flops(model, x):
+    """
+    Args:
+        model (PoseRegressor): the model
+        x (torch.Tensor): input batch
+    Output:
+        flops (int): FLOPs of the dense part of the model (2 per multiply-add
+            of the convolutions and linear layers, the rest is negligible)
+    """
+
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel_macs = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        macs.append(output.numel() * kernel_macs)
+
+    def linear_hook(module, inputs, output):
+        macs.append(output.numel() * module.in_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+
+    with torch.no_grad():
+        model.forward_dense(x)
+
+    for hook in hooks:
+        hook.remove()
+
+    return 2 * sum(macs)
+
+def benchmark_decoder_sharing(
+    encoder_name='resnet18',
+    classes=3,
+    image_size=(480, 640),
+    num_of_runs=10,
+    variants=DECODER_SHARING_OPTIONS
+    ):
+    """
+    Args:
+        encoder_name (str): encoder of the models
+        classes (int): number of classes (including the background)
+        image_size (tuple): (h, w) of the input image
+        num_of_runs (int): number of timed forward passes (batch of 1)
+        variants (list): decoder sharing options to compare
+    Output:
+        results (dict): per variant, the parameters (total and decoder), GFLOPs
+            and mean CPU latency (ms) of the dense part of the model
+    """
+
+    x = torch.rand((1, 3, *image_size))
+    results = {}
+
+    for variant in variants:
+
+        # Only the dense part of the model is benchmarked (no HPARAM needed)
+        model = PoseRegressor(
+            argparse.Namespace(),
+            intrinsics=torch.eye(3),
+            encoder_name=encoder_name,
+            encoder_weights=None,
+            classes=classes,
+            decoder_sharing=variant
+        ).eval()
+
+        encoder_params = sum([p.numel() for p in model.encoder.parameters()])
+        total_params = sum([p.numel() for p in model.parameters()])
+
+        # Warming up before timing
+        with torch.no_grad():
+            for _ in range(2):
+                model.forward_dense(x)
+
+            start_time = time.perf_counter()
+            for _ in range(num_of_runs):
+                model.forward_dense(x)
+            latency = (time.perf_counter() - start_time) / num_of_runs
+
+        results[variant] = {
+            'params': total_params,
+            'decoder_params': total_params - encoder_params,
+            'gflops': count_flops(model, x) / 1e9,
+            'cpu_latency_ms': latency * 1000
+        }
 
-    # Load the model
-    model = PoseRegressor()
+        print(
+            f"{variant}: {results[variant]['params']/1e6:.2f}M params "
+            f"({results[variant]['decoder_params']/1e6:.2f}M decoder), "
+            f"{results[variant]['gflops']:.2f} GFLOPs, "
+            f"{results[variant]['cpu_latency_ms']:.1f}ms CPU latency"
+        )
 
-    # Forward propagate
-    x1 = np.random.random_sample((3,254,254))
-    #x2 = np.random.random_sample((3,254,254))
-    
-    x1 = torch.from_numpy(x1).unsqueeze(0).float()
-    #x2 = torch.from_numpy(x2).unsqueeze(0).float()
-    
-    #x = torch.cat([x1, x2])
-    x = x1
+    return results
+
+def benchmark_selective_inference(
+    encoder_name='resnet18',
+    classes=3,
+    image_size=(480, 640),
+    num_of_runs=10,
+    output_sets=SELECTIVE_BENCHMARK_OUTPUT_SETS
+    ):
+    """
+    Args:
+        encoder_name (str): encoder of the model
+        classes (int): number of classes (including the background)
+        image_size (tuple): (h, w) of the input image
+        num_of_runs (int): number of timed passes (batch of 1)
+        output_sets (list): sets of requested outputs to compare (without
+            'agg_pred', which needs the aggregation HPARAM)
+    Output:
+        results (dict): per output set, the mean CPU latency (ms) of predict
+    """
+
+    x = torch.rand((1, 3, *image_size))
+    results = {}
+
+    # Only the dense part and the class compression are benchmarked
+    model = PoseRegressor(
+        argparse.Namespace(),
+        intrinsics=torch.eye(3),
+        encoder_name=encoder_name,
+        encoder_weights=None,
+        classes=classes
+    ).eval()
+
+    for output_set in output_sets:
+
+        name = '+'.join(output_set)
+
+        # Warming up before timing
+        with torch.no_grad():
+            for _ in range(2):
+                model.predict(x, output_set)
+
+            start_time = time.perf_counter()
+            for _ in range(num_of_runs):
+                model.predict(x, output_set)
+            latency = (time.perf_counter() - start_time) / num_of_runs
+
+        results[name] = {'cpu_latency_ms': latency * 1000}
+
+        print(f"{name}: {results[name]['cpu_latency_ms']:.1f}ms CPU latency")
+
+    return results
 
-    y = model.forward(x)
+#-------------------------------------------------------------------------------
+# File Main
 
-    print(y)
+if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Compare the decoder sharing options or the selective outputs of the PoseRegressor')
+    parser.add_argument('--benchmark', type=str, default='decoder_sharing', choices=['decoder_sharing', 'selective'])
+    parser.add_argument('--encoder', type=str, default='resnet18')
+    parser.add_argument('--classes', type=int, default=3)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--num_of_runs', type=int, default=10)
+    parser.add_argument('--num_of_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_of_threads is not None:
+        torch.set_num_threads(args.num_of_threads)
+
+    if args.benchmark == 'decoder_sharing':
+        benchmark_decoder_sharing(
+            encoder_name=args.encoder,
+            classes=args.classes,
+            image_size=(args.height, args.width),
+            num_of_runs=args.num_of_runs
+        )
+    else:
+        benchmark_selective_inference(
+            encoder_name=args.encoder,
+            classes=args.classes,
+            image_size=(args.height, args.width),
+            num_of_runs=args.num_of_runs
+        )
@@ -0,0 +1,373 @@
+import sys
+import copy
+import time
+import inspect
+import pathlib
+import itertools
+
+import torch
+import torch.nn as nn
+
+import segmentation_models_pytorch as smp
+
+# Local imports
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import gpu_tensor_funcs as gtf
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Post-training int8 quantization (CPU)
+
+The PoseRegressor is quantized with FX graph mode static post-training
+quantization (torch.quantization.quantize_fx, torch >= 1.8, with a qconfig_dict
+so the same code runs with the later torch.ao.quantization versions):
+
+    1. prepare: each dense module (encoder, FPN decoders or trunk and
+       adapters, heads) is traced, its conv-bn(-relu) sequences fused and
+       observers inserted,
+    2. calibrate: N batches (e.g. of the validation split) are passed through
+       the model to record the activation ranges,
+    3. convert: the modules are replaced by their int8 versions.
+
+The modules are quantized separately, so the PoseRegressor itself (the
+selective outputs, class compression and torch post-processing) is unchanged:
+each quantized module takes and returns float tensors. The modules listed in
+float_modules stay in float, by default the regression heads (1x1 convs with a
+negligible cost, whose outputs are the regressed values).
+
+The degree/offset/3D IoU AP deltas (lib/metrics) and the speedup are reported
+by eval_quantized.py.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Dense modules of the PoseRegressor that can be quantized
+QUANTIZABLE_MODULES = [
+    'encoder',
+    'decoder',
+    'mask_decoder',
+    'rotation_decoder',
+    'translation_decoder',
+    'scales_decoder',
+    'segmentation_head',
+    'rotation_head',
+    'translation_head',
+    'scales_head'
+]
+
+# Kept in float by default (the outputs regressed directly)
+DEFAULT_FLOAT_MODULES = ['rotation_head', 'translation_head', 'scales_head']
+
+# Number of encoder levels used by the FPN decoders (the deepest ones)
+NUM_OF_FEATURE_LEVELS = 4
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class TracedEncoder(nn.Module):
+
+    # FX cannot trace the encoders of segmentation_models_pytorch, which build
+    # their stages (nn.Sequential of their layers) in every forward, so the
+    # stages are built once here (sharing the layers of the encoder)
+    def __init__(self, encoder):
+        super().__init__()
+        self.stages = nn.ModuleList(encoder.get_stages())
+        self.depth = encoder._depth
+
+    def forward(self, x):
+
+        features = []
+        for stage in self.stages[:self.depth+1]:
+            x = stage(x)
+            features.append(x)
+
+        return features
+
+class TracedFPNDecoder(nn.Module):
+
+    # FX cannot trace the *features of the FPN decoder, so the levels it uses
+    # are explicit inputs
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, c2, c3, c4, c5):
+        return self.decoder(c2, c3, c4, c5)
+
+class LastFeatureLevels(nn.Module):
+
+    # Called as the FPN decoder (with all the encoder features)
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *features):
+        return self.module(*features[-NUM_OF_FEATURE_LEVELS:])
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_quantize_fx():
+
+    # FX graph mode quantization was added in torch 1.8
+    try:
+        from torch.quantization import quantize_fx
+    except ImportError:
+        raise RuntimeError(f'FX graph mode quantization requires torch >= 1.8 (found {torch.__version__})')
+
+    return quantize_fx
+
+def prepare_module(module, qconfig_dict, example_inputs):
+
+    quantize_fx = get_quantize_fx()
+
+    # The example inputs are required (and only accepted) since torch 1.13
+    if 'example_inputs' in inspect.signature(quantize_fx.prepare_fx).parameters.keys():
+        return quantize_fx.prepare_fx(module, qconfig_dict, example_inputs=tuple(example_inputs))
+    else:
+        return quantize_fx.prepare_fx(module, qconfig_dict)
+
+def get_module_inputs(model, x, module_names):
+    """
+    Args:
+        model (PoseRegressor): the float model
+        x (torch.Tensor): example input images
+        module_names (list): names of the modules
+    Output:
+        module_inputs (dict): the example (positional) inputs of each module
+    """
+
+    module_inputs = {}
+
+    def get_hook(name):
+        def hook(module, inputs):
+            module_inputs[name] = inputs
+        return hook
+
+    hooks = [getattr(model, name).register_forward_pre_hook(get_hook(name)) for name in module_names]
+
+    with torch.no_grad():
+        model.forward_dense(x)
+
+    for hook in hooks:
+        hook.remove()
+
+    return module_inputs
+
+def prepare_pose_regressor(model, x, backend='fbgemm', float_modules=DEFAULT_FLOAT_MODULES):
+    """
+    Args:
+        model (PoseRegressor): the float model (not modified)
+        x (torch.Tensor): example input images
+        backend (str): quantized engine ('fbgemm' or 'qnnpack' for ARM, 'x86'
+            with torch >= 2.0)
+        float_modules (list): modules kept in float
+    Output:
+        prepared_model (PoseRegressor): a CPU copy with the fused and observed
+            modules, to calibrate
+    """
+
+    get_quantize_fx()
+
+    torch.backends.quantized.engine = backend
+    qconfig_dict = {'': torch.quantization.get_default_qconfig(backend)}
+
+    prepared_model = copy.deepcopy(model).cpu().eval()
+
+    # Only the existing (and not empty) modules are quantized
+    module_names = [
+        name for name in QUANTIZABLE_MODULES
+        if name not in float_modules and \
+            isinstance(getattr(prepared_model, name, None), nn.Module) and \
+            not isinstance(getattr(prepared_model, name), nn.Identity)
+    ]
+
+    module_inputs = get_module_inputs(prepared_model, x, module_names)
+
+    for name in module_names:
+
+        module = getattr(prepared_model, name)
+
+        # The FPN decoders are traced with the levels they use
+        if isinstance(module, smp.fpn.decoder.FPNDecoder):
+            example_inputs = module_inputs[name][-NUM_OF_FEATURE_LEVELS:]
+            prepared_module = LastFeatureLevels(prepare_module(TracedFPNDecoder(module), qconfig_dict, example_inputs))
+        elif hasattr(module, 'get_stages'):
+            prepared_module = prepare_module(TracedEncoder(module), qconfig_dict, module_inputs[name])
+        else:
+            prepared_module = prepare_module(module, qconfig_dict, module_inputs[name])
+
+        setattr(prepared_model, name, prepared_module)
+
+    prepared_model.quantized_modules = module_names
+
+    return prepared_model
+
+def calibrate(prepared_model, batches, num_of_batches=None):
+    """
+    Args:
+        prepared_model (PoseRegressor): the model returned by prepare_pose_regressor
+        batches (iterable): batches with an 'image' key (e.g. a DataLoader)
+        num_of_batches (int): number of batches used (None = all)
+    """
+
+    with torch.no_grad():
+        for batch in itertools.islice(batches, num_of_batches):
+            prepared_model.forward_dense(batch['image'].float().cpu())
+
+def convert_pose_regressor(prepared_model):
+    """
+    Args:
+        prepared_model (PoseRegressor): the calibrated model
+    Output:
+        quantized_model (PoseRegressor): the model with the int8 modules
+    """
+
+    convert_fx = get_quantize_fx().convert_fx
+
+    for name in prepared_model.quantized_modules:
+
+        module = getattr(prepared_model, name)
+
+        if isinstance(module, LastFeatureLevels):
+            module.module = convert_fx(module.module)
+        else:
+            setattr(prepared_model, name, convert_fx(module))
+
+    return prepared_model
+
+def quantize_pose_regressor(
+    model,
+    batches,
+    num_of_batches=None,
+    backend='fbgemm',
+    float_modules=DEFAULT_FLOAT_MODULES
+    ):
+    """
+    Args:
+        model (PoseRegressor): the float model (not modified)
+        batches (list): calibration batches with an 'image' key
+        num_of_batches (int): number of calibration batches (None = all)
+        backend (str): quantized engine ('fbgemm' or 'qnnpack' for ARM, 'x86'
+            with torch >= 2.0)
+        float_modules (list): modules kept in float
+    Output:
+        quantized_model (PoseRegressor): CPU model with the int8 modules
+    """
+
+    batches = list(itertools.islice(batches, num_of_batches))
+
+    prepared_model = prepare_pose_regressor(
+        model,
+        batches[0]['image'].float().cpu(),
+        backend,
+        float_modules
+    )
+
+    calibrate(prepared_model, batches)
+
+    return convert_pose_regressor(prepared_model)
+
+def evaluate_pose_metrics(model, batches, metrics):
+    """
+    Args:
+        model (PoseRegressor): the (float or quantized) model, on the CPU
+        batches (list): evaluation batches (dense targets, on the CPU)
+        metrics (dict): {name: lib.metrics metric} updated with the matches
+            of the aggregated predictions and ground truth
+    Output:
+        results (dict): {name: value} of the metrics
+    """
+
+    for metric in metrics.values():
+        metric.reset()
+
+    with torch.no_grad():
+        for batch in batches:
+
+            inv_intrinsics = torch.inverse(batch['intrinsics']) if 'intrinsics' in batch else None
+
+            # Predictions and aggregated ground truth
+            outputs = model(batch['image'].float(), batch.get('intrinsics'))
+            agg_gt = model.agg_hough_and_generate_RT(
+                batch['mask'],
+                data=batch,
+                inv_intrinsics=inv_intrinsics
+            )
+
+            # Determine matches between the aggreated ground truth and preds
+            gt_pred_matches = gtf.batchwise_find_matches(
+                outputs['auxilary']['agg_pred'],
+                agg_gt
+            )
+
+            for metric in metrics.values():
+                metric.update(gt_pred_matches)
+
+    return {name:float(metric.compute()) for name, metric in metrics.items()}
+
+def measure_latency(model, x, num_of_runs=10):
+
+    # Mean latency (ms) of the dense part of the model
+    with torch.no_grad():
+        for _ in range(2):
+            model.forward_dense(x)
+
+        start_time = time.perf_counter()
+        for _ in range(num_of_runs):
+            model.forward_dense(x)
+
+    return (time.perf_counter() - start_time) / num_of_runs * 1000
+
+def report_quantization(float_model, quantized_model, batches, metrics_fn, num_of_runs=10):
+    """
+    Args:
+        float_model (PoseRegressor): the float model
+        quantized_model (PoseRegressor): the model returned by quantize_pose_regressor
+        batches (list): evaluation batches (not used for the calibration)
+        metrics_fn (function): metrics_fn() -> {name: lib.metrics metric}
+        num_of_runs (int): number of timed passes of the first batch
+    Output:
+        report (dict): per metric, the float and int8 values and their delta,
+            and the CPU latency (ms) of both models and the speedup
+    """
+
+    float_model = copy.deepcopy(float_model).cpu().eval()
+
+    float_results = evaluate_pose_metrics(float_model, batches, metrics_fn())
+    quantized_results = evaluate_pose_metrics(quantized_model, batches, metrics_fn())
+
+    report = {'metrics': {}}
+    for name in float_results.keys():
+        report['metrics'][name] = {
+            'float': float_results[name],
+            'int8': quantized_results[name],
+            'delta': quantized_results[name] - float_results[name]
+        }
+
+    x = batches[0]['image'].float().cpu()
+    float_latency = measure_latency(float_model, x, num_of_runs)
+    quantized_latency = measure_latency(quantized_model, x, num_of_runs)
+
+    report['latency'] = {
+        'batch_size': x.shape[0],
+        'float_ms': float_latency,
+        'int8_ms': quantized_latency,
+        'speedup': float_latency / quantized_latency
+    }
+
+    # Printing the report
+    print(f"{'metric':<25}{'float':>10}{'int8':>10}{'delta':>10}")
+    for name, values in report['metrics'].items():
+        print(f"{name:<25}{values['float']:>10.2f}{values['int8']:>10.2f}{values['delta']:>+10.2f}")
+
+    print(
+        f"latency (batch size {x.shape[0]}): float {float_latency:.1f}ms, "
+        f"int8 {quantized_latency:.1f}ms ({report['latency']['speedup']:.2f}x)"
+    )
+
+    return report
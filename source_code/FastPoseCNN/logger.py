@@ -7,6 +7,9 @@ from torch.utils.tensorboard.writer import SummaryWriter
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_only
 
+# Local Imports
+import tools
+
 #-------------------------------------------------------------------------------
 # Classes
 
@@ -55,26 +58,40 @@ class MyLogger(pl.loggers.LightningLoggerBase):
             'valid': SummaryWriter(log_dir=str(self.valid_dir))
         }
 
-        # Creating logging variables
-        self.log = {
-            'base': {},
-            'train': {},
-            'valid': {}
-        }
+        # Writing the scalars from a background thread (if requested)
+        if self.HPARAM.ASYNC_SCALARS:
+            self.scalar_writer = tools.scalar_writer.AsyncScalarWriter(
+                self.writers,
+                flush_interval=self.HPARAM.SCALAR_FLUSH_INTERVAL,
+                decimation=self.HPARAM.SCALAR_DECIMATION
+            )
+        else:
+            self.scalar_writer = None
+            self.decimator = tools.scalar_writer.ScalarDecimator(self.HPARAM.SCALAR_DECIMATION)
+
+        # Number of batches of the dataloaders (computed once per epoch)
+        self.num_of_batchs = None
 
     @rank_zero_only
     def calculate_global_step(self, mode, batch_idx):
 
-        # Calculate the actual global step
-        if self.pl_module.trainer.train_dataloader is not None:
-            num_of_train_batchs = len(self.pl_module.trainer.train_dataloader)
-        else:
-            num_of_train_batchs = 0
+        # The number of batches only changes between epochs
+        if self.num_of_batchs is None or self.num_of_batchs[0] != self.pl_module.current_epoch:
 
-        if self.pl_module.trainer.val_dataloaders[0] is not None:
-            num_of_valid_batchs = len(self.pl_module.trainer.val_dataloaders[0])
-        else:
-            num_of_valid_batchs = 0
+            # Calculate the actual global step
+            if self.pl_module.trainer.train_dataloader is not None:
+                num_of_train_batchs = len(self.pl_module.trainer.train_dataloader)
+            else:
+                num_of_train_batchs = 0
+
+            if self.pl_module.trainer.val_dataloaders[0] is not None:
+                num_of_valid_batchs = len(self.pl_module.trainer.val_dataloaders[0])
+            else:
+                num_of_valid_batchs = 0
+
+            self.num_of_batchs = (self.pl_module.current_epoch, num_of_train_batchs, num_of_valid_batchs)
+
+        _, num_of_train_batchs, num_of_valid_batchs = self.num_of_batchs
 
         total_batchs = num_of_train_batchs + num_of_valid_batchs - 1
 
@@ -113,47 +130,23 @@ class MyLogger(pl.loggers.LightningLoggerBase):
         pass
 
     @rank_zero_only
-    def log_metrics(self, mode, metrics, batch_idx, store=True):
+    def log_metrics(self, mode, metrics, batch_idx, decimate=False):
 
         # Calculate global step, since given information regarding the step is 
         # given in batch_idx
         step = self.calculate_global_step(mode, batch_idx)
 
-        # Logging the metrics invidually to tensorboard
-        for metric_name, metric_value in metrics.items():
-            self.writers[mode].add_scalar(metric_name, metric_value, step)
+        # Enqueuing all the metrics at once (a single transfer to the host)
+        if self.scalar_writer is not None:
+            self.scalar_writer.add_scalars(mode, metrics, step, decimate=decimate)
 
-        # Saving the metrics for later use
-        if store:
-            self.save_metrics(mode, metrics)
-
-    @rank_zero_only
-    def save_metrics(self, mode, metrics):
-
-        for metric_name, metric_value in metrics.items():
-
-            # Save the information into the logs
-            # If log metric has been saved before, simply just append it to the list
-            if metric_name in self.log[mode].keys():
-                self.log[mode][metric_name].append(metric_value)
-            # else the log metric is new so we need to create a list for it
-            else:
-                self.log[mode][metric_name] = [metric_value]
-
-    @rank_zero_only
-    def clear_metrics(self, mode=None):
-
-        # If no mode is specified, just completely reset the log
-        if mode is None:
-            self.log = {
-            'base': {},
-            'train': {},
-            'valid': {}
-        }
-
-        # else reset that specific mode
+        # or logging the metrics invidually to tensorboard (the epoch
+        # statistics are kept by the running metrics of the task)
         else:
-            self.log[mode] = {}
+            if decimate:
+                metrics = self.decimator.filter(mode, metrics)
+            for metric_name, metric_value in metrics.items():
+                self.writers[mode].add_scalar(metric_name, metric_value, step)
 
     @rank_zero_only
     def agg_and_log_metrics(self, scalar_metrics, step):
@@ -164,12 +157,18 @@ class MyLogger(pl.loggers.LightningLoggerBase):
     def save(self):
         
         # Flushing all the writers to make sure all the logs are completed
+        if self.scalar_writer is not None:
+            self.scalar_writer.flush()
         for writer in self.writers.values():
             writer.flush()
 
     @rank_zero_only
     def finalize(self, status):
         
+        # Writing the pending scalars
+        if self.scalar_writer is not None:
+            self.scalar_writer.close()
+
         # Flushing and closing all the writers
         for writer in self.writers.values():
             writer.flush()
@@ -5,9 +5,18 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import data_manipulation as dm
 import dataset as ds
+import distributed_tools as dt
 import draw as dr
 import visualize as vz
 import project as pj
 import json_tools as jt
 import excel_tools as et
-import transforms
\ No newline at end of file
+import transforms
+import sample_cache
+import batch_loader
+import prefetcher
+import sampler
+import figure_renderer
+import running_metrics
+import scalar_writer
+import feature_cache
@@ -0,0 +1,447 @@
+import os
+import sys
+import time
+import math
+import random
+import pathlib
+import argparse
+import traceback
+import collections
+
+import numpy as np
+import torch
+import torch.multiprocessing
+
+# Local Imports
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import dataset as ds
+import distributed_tools as dt
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Shared-memory batch loader
+
+The default DataLoader pickles every sample dict through a queue, collates it
+in the main process, copies the batch again into pinned memory and (unless
+persistent) forks all its workers every epoch. The SharedMemoryBatchLoader
+instead:
+
+    1. preallocates a ring of batch buffers in shared memory (one tensor per
+       key with the shape of a complete batch),
+    2. starts its workers once and reuses them for every epoch,
+    3. has the workers write each sample directly into its row of a buffer,
+       only the (slot, batch index) goes through the queues,
+    4. page-locks (pins) the buffers in place when CUDA is available, so the
+       host to device copy can be asynchronous with no extra copy.
+
+The yielded batches are views into the ring: a slot is given back to the
+workers once the next batch is requested (and, when pinned, once the device
+has finished reading it). The time spent waiting for each batch is recorded,
+a wait close to zero means the training step never starves:
+
+    python batch_loader.py --dataset_dir $NOCS_CAMERA_TRAIN_DATASET --batch_size 8 --num_workers 36
+
+Only fixed-shape samples are supported (every key of the first sample defines a
+buffer), the variable-size values (e.g. the aggregated ground truth) are created
+by dataset.finalize_batch in the main process.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Waits below this value (in seconds) are not counted as starved batches
+STARVED_WAIT_THRESHOLD = 1e-3
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def allocate_batch_buffers(sample, batch_size):
+
+    buffers = {}
+
+    for key, value in sample.items():
+
+        # Only array-like values can be preallocated
+        if isinstance(value, (np.ndarray, np.generic, torch.Tensor, int, float)) is False:
+            continue
+
+        value = torch.as_tensor(value)
+        buffers[key] = torch.empty((batch_size, *value.shape), dtype=value.dtype).share_memory_()
+
+    return buffers
+
+def write_sample(buffers, row, sample):
+
+    # Writing each value in place into its row of the batch buffer
+    for key, buffer in buffers.items():
+        buffer[row].copy_(torch.as_tensor(sample[key]))
+
+def worker_loop(dataset, ring, task_queue, result_queue, worker_id, seed):
+
+    # Each worker has its own (augmentation) random state
+    worker_seed = (seed + worker_id) % 2**32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+
+    # A single thread per worker, the parallelism comes from the processes
+    torch.set_num_threads(1)
+
+    while True:
+
+        task = task_queue.get()
+
+        # Shutdown signal
+        if task is None:
+            break
+
+        batch_idx, slot, sample_ids = task
+
+        try:
+            for row, sample_id in enumerate(sample_ids):
+                write_sample(ring[slot], row, dataset[sample_id])
+            result_queue.put((batch_idx, slot, None))
+
+        except Exception:
+            result_queue.put((batch_idx, slot, traceback.format_exc()))
+
+def pin_buffers(buffers):
+
+    # Page-locking the shared memory in place (no pinned copy of the batch)
+    cudart = torch.cuda.cudart()
+    for buffer in buffers.values():
+        torch.cuda.check_error(cudart.cudaHostRegister(buffer.data_ptr(), buffer.numel() * buffer.element_size(), 0))
+
+def unpin_buffers(buffers):
+
+    cudart = torch.cuda.cudart()
+    for buffer in buffers.values():
+        torch.cuda.check_error(cudart.cudaHostUnregister(buffer.data_ptr()))
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class SharedMemoryBatchLoader():
+
+    def __init__(
+        self,
+        dataset,
+        batch_size=1,
+        num_workers=0,
+        shuffle=False,
+        drop_last=False,
+        ring_size=None,
+        pin_memory=True,
+        seed=0,
+        sampler=None
+        ):
+
+        # Saving parameters
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.sampler = sampler
+        self.epoch = 0
+
+        # Enough slots to keep every worker busy while a batch is being used
+        if ring_size is None:
+            ring_size = 2 * max(num_workers, 1) + 2
+        self.ring_size = ring_size
+
+        # Preallocating the shared-memory ring with the layout of the first sample
+        sample = dataset[0]
+        self.ring = [allocate_batch_buffers(sample, batch_size) for _ in range(ring_size)]
+
+        # Pinning the ring, if a device is going to read from it
+        self.pinned = pin_memory and torch.cuda.is_available()
+        if self.pinned:
+            for buffers in self.ring:
+                pin_buffers(buffers)
+
+        # The batch (e.g. the aggregated ground truth) is completed in the main process
+        self.finalize_batch = getattr(dataset, 'finalize_batch', None)
+
+        # The persistent workers are started with the first epoch
+        self.workers = []
+        self.task_queue = None
+        self.result_queue = None
+        self.num_in_flight = 0
+
+        # Per-batch wait times (seconds)
+        self.wait_times = []
+
+    def start_workers(self):
+
+        context = torch.multiprocessing.get_context()
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+
+        for worker_id in range(self.num_workers):
+            worker = context.Process(
+                target=worker_loop,
+                args=(self.dataset, self.ring, self.task_queue, self.result_queue, worker_id, self.seed),
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def close(self):
+
+        # Stopping the workers
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+        if self.pinned:
+            for buffers in self.ring:
+                unpin_buffers(buffers)
+            self.pinned = False
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def get_sample_ids(self):
+
+        # A given sampler already takes the share of this process
+        if self.sampler is not None:
+            if hasattr(self.sampler, 'set_epoch'):
+                self.sampler.set_epoch(self.epoch)
+            return list(self.sampler)
+
+        # Same permutation in every process (seed + epoch)
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            sample_ids = torch.randperm(len(self.dataset), generator=generator).tolist()
+        else:
+            sample_ids = list(range(len(self.dataset)))
+
+        # Each process takes its share, padded so every process has the same
+        # number of batches (as the DistributedSampler)
+        rank, world_size = dt.get_distributed_info()
+        total_size = int(math.ceil(len(sample_ids) / world_size)) * world_size
+        sample_ids += sample_ids[:(total_size - len(sample_ids))]
+
+        return sample_ids[rank:total_size:world_size]
+
+    def __len__(self):
+
+        if self.sampler is not None:
+            num_of_samples = len(self.sampler)
+        else:
+            _, world_size = dt.get_distributed_info()
+            num_of_samples = int(math.ceil(len(self.dataset) / world_size))
+
+        if self.drop_last:
+            return num_of_samples // self.batch_size
+        else:
+            return int(math.ceil(num_of_samples / self.batch_size))
+
+    def __iter__(self):
+
+        if self.num_workers > 0 and not self.workers:
+            self.start_workers()
+
+        # Discarding the batches of an interrupted epoch
+        while self.num_in_flight > 0:
+            self.result_queue.get()
+            self.num_in_flight -= 1
+
+        # Splitting the samples of the epoch into batches
+        sample_ids = self.get_sample_ids()
+        batches_ids = [sample_ids[i:i+self.batch_size] for i in range(0, len(sample_ids), self.batch_size)]
+        if self.drop_last and batches_ids and len(batches_ids[-1]) < self.batch_size:
+            batches_ids = batches_ids[:-1]
+
+        self.epoch += 1
+
+        if self.num_workers == 0:
+            yield from self.iterate_in_process(batches_ids)
+        else:
+            yield from self.iterate_with_workers(batches_ids)
+
+    def iterate_in_process(self, batches_ids):
+
+        buffers = self.ring[0]
+
+        for sample_ids in batches_ids:
+
+            start_time = time.perf_counter()
+
+            for row, sample_id in enumerate(sample_ids):
+                write_sample(buffers, row, self.dataset[sample_id])
+
+            batch = self.get_batch(buffers, len(sample_ids))
+            self.wait_times.append(time.perf_counter() - start_time)
+
+            yield batch
+
+            # The device must be done reading the batch before it is overwritten
+            if self.pinned:
+                torch.cuda.current_stream().synchronize()
+
+    def iterate_with_workers(self, batches_ids):
+
+        free_slots = collections.deque(range(self.ring_size))
+        used_slots = collections.deque()
+        ready_batches = {}
+        next_task = 0
+
+        for batch_idx, sample_ids in enumerate(batches_ids):
+
+            start_time = time.perf_counter()
+
+            # Giving back the slots the device is done with (blocking only if
+            # the workers have nothing to do)
+            while used_slots:
+                slot, event = used_slots[0]
+                if event is None or event.query() or (not free_slots and self.num_in_flight == 0):
+                    if event is not None:
+                        event.synchronize()
+                    free_slots.append(slot)
+                    used_slots.popleft()
+                else:
+                    break
+
+            # Keeping the workers busy with the next batches
+            while free_slots and next_task < len(batches_ids):
+                self.task_queue.put((next_task, free_slots.popleft(), batches_ids[next_task]))
+                self.num_in_flight += 1
+                next_task += 1
+
+            # Waiting for the batch (the workers may finish out of order)
+            while batch_idx not in ready_batches:
+                done_idx, slot, error = self.result_queue.get()
+                self.num_in_flight -= 1
+                if error is not None:
+                    raise RuntimeError(f'SharedMemoryBatchLoader worker failed:\n{error}')
+                ready_batches[done_idx] = slot
+
+            slot = ready_batches.pop(batch_idx)
+            batch = self.get_batch(self.ring[slot], len(sample_ids))
+            self.wait_times.append(time.perf_counter() - start_time)
+
+            yield batch
+
+            # The slot is in use until the device has read it (the event marks
+            # the work queued up to the request of the next batch)
+            event = None
+            if self.pinned:
+                event = torch.cuda.Event()
+                event.record()
+            used_slots.append((slot, event))
+
+    def get_batch(self, buffers, size):
+
+        # Views into the ring (no copy)
+        batch = {key: buffer[:size] for key, buffer in buffers.items()}
+
+        if self.finalize_batch is not None:
+            batch = self.finalize_batch(batch)
+
+        return batch
+
+    def get_stats(self):
+
+        wait_times = np.array(self.wait_times) * 1000
+
+        if wait_times.size == 0:
+            return {'num_of_batches': 0}
+
+        return {
+            'num_of_batches': wait_times.size,
+            'wait_mean_ms': float(np.mean(wait_times)),
+            'wait_p95_ms': float(np.percentile(wait_times, 95)),
+            'wait_max_ms': float(np.max(wait_times)),
+            'starved_fraction': float(np.mean(wait_times > STARVED_WAIT_THRESHOLD * 1000))
+        }
+
+    def reset_stats(self):
+        self.wait_times = []
+
+#-------------------------------------------------------------------------------
+# Functions (Benchmark)
+
+def benchmark_loaders(dataset, batch_size, num_workers, num_of_batches=100, step_time=0.0):
+    """
+    Args:
+        dataset (NOCSPoseRegDataset): The dataset to load
+        batch_size (int): batch size of both loaders
+        num_workers (int): number of workers of both loaders
+        num_of_batches (int): number of batches to time (after the first one)
+        step_time (float): simulated training step time (seconds)
+    Objective:
+        Compare the per-batch wait of the default DataLoader and of the
+        SharedMemoryBatchLoader (both pinned, with the same workers).
+    """
+
+    default_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=True,
+        pin_memory=torch.cuda.is_available(),
+        collate_fn=getattr(dataset, 'collate', None)
+    )
+
+    shm_loader = SharedMemoryBatchLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=True
+    )
+
+    for name, loader in [('DataLoader', default_loader), ('SharedMemoryBatchLoader', shm_loader)]:
+
+        wait_times = []
+        iterator = iter(loader)
+
+        # Not counting the start-up (worker creation and first batch)
+        next(iterator)
+
+        for _ in range(min(num_of_batches, len(loader) - 1)):
+            start_time = time.perf_counter()
+            next(iterator)
+            wait_times.append(time.perf_counter() - start_time)
+            time.sleep(step_time)
+
+        wait_times = np.array(wait_times) * 1000
+        print(f'{name}: mean wait {np.mean(wait_times):.2f}ms, p95 wait {np.percentile(wait_times, 95):.2f}ms, max wait {np.max(wait_times):.2f}ms')
+
+    shm_loader.close()
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare the batch wait of the default and the shared-memory loaders')
+    parser.add_argument('--dataset_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--num_of_batches', type=int, default=100)
+    parser.add_argument('--step_time', type=float, default=0.0)
+    args = parser.parse_args()
+
+    dataset = ds.NOCSPoseRegDataset(dataset_dir=args.dataset_dir)
+
+    benchmark_loaders(
+        dataset,
+        args.batch_size,
+        args.num_workers,
+        num_of_batches=args.num_of_batches,
+        step_time=args.step_time
+    )
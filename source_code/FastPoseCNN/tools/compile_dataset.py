@@ -0,0 +1,199 @@
+import os
+import sys
+import time
+import argparse
+import pathlib
+import concurrent.futures
+
+import tqdm
+import numpy as np
+
+# Local Imports
+root = next(path for path in pathlib.Path(os.path.abspath(__file__)).parents if path.name == 'FastPoseCNN')
+sys.path.append(str(root))
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import setup_env
+import json_tools as jt
+import dataset as ds
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Compiling a dataset
+
+Every NOCSPoseRegDataset.__getitem__ rebuilds the dense quaternion, scales, xy
+and z maps from the _meta+.json. Compiling the dataset performs this once,
+offline, and stores the dense targets (and the cleaned class mask) of a split
+into memory-mapped arrays that the dataset can then serve with no json parsing
+and no dense synthesis:
+
+    python compile_dataset.py --dataset_dir $NOCS_CAMERA_TRAIN_DATASET --compiled_dir $NOCS_CAMERA_TRAIN_COMPILED --classes bg camera laptop
+
+Then create the dataset with NOCSPoseRegDataset(..., compiled_dir=...). The
+compiled dataset is only valid for the classes it was compiled with.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+COMPILED_VERSION = 1
+
+# Number of channels of each compiled key (0 = no channel axis)
+COMPILED_CHANNELS = {
+    'mask': 0,
+    'quaternion': 4,
+    'scales': 3,
+    'xy': 2,
+    'z': 0
+}
+
+# Dataset used by the worker processes (set by the pool initializer)
+WORKER_DATASET = None
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def init_worker(dataset):
+
+    global WORKER_DATASET
+    WORKER_DATASET = dataset
+
+def compile_samples(compiled_dir, sample_ids, dataset=None):
+
+    # Worker processes use the dataset given by the initializer
+    if dataset is None:
+        dataset = WORKER_DATASET
+
+    # Opening the arrays in read/write mode, each sample is written in place
+    compiled_arrays = ds.open_compiled_arrays(compiled_dir, mode='r+')
+
+    for i in sample_ids:
+
+        # Constructing the dense data exactly as NOCSPoseRegDataset does
+        image, mask, json_data = dataset.read_raw_sample(i)
+        sample = dataset.create_dense_sample(image, mask, json_data)
+
+        # Writing the dense data into the compiled arrays
+        for key, compiled_array in compiled_arrays.items():
+            compiled_array[i] = sample[key]
+
+    # Making sure the data reaches the disk
+    for compiled_array in compiled_arrays.values():
+        compiled_array.flush()
+
+    return len(sample_ids)
+
+def compile_pose_dataset(
+    dataset_dir,
+    compiled_dir,
+    classes=None,
+    dtype='float32',
+    num_workers=0,
+    chunk_size=64
+    ):
+
+    dataset_dir = pathlib.Path(dataset_dir)
+    compiled_dir = pathlib.Path(compiled_dir)
+
+    if compiled_dir.exists() is False:
+        os.makedirs(str(compiled_dir))
+
+    # Removing a previous index, so a partially compiled dataset is never used
+    index_fp = compiled_dir / ds.COMPILED_INDEX_NAME
+    if index_fp.exists():
+        os.remove(str(index_fp))
+
+    # Collecting the samples (with empty samples already removed)
+    dataset = ds.NOCSPoseRegDataset(
+        dataset_dir=dataset_dir,
+        classes=classes
+    )
+    num_samples = len(dataset)
+
+    if num_samples == 0:
+        raise RuntimeError(f'No samples found in {dataset_dir}')
+
+    # Determing the image size with the first sample
+    _, mask, _ = dataset.read_raw_sample(0)
+    h, w = mask.shape
+
+    # Allocating the memory-mapped arrays
+    for key, channels in COMPILED_CHANNELS.items():
+
+        shape = (num_samples, h, w) if channels == 0 else (num_samples, h, w, channels)
+        key_dtype = np.uint8 if key == 'mask' else np.dtype(dtype)
+
+        compiled_array = np.lib.format.open_memmap(
+            str(compiled_dir / f'{key}.npy'),
+            mode='w+',
+            dtype=key_dtype,
+            shape=shape
+        )
+        del compiled_array
+
+    # Splitting the samples into chunks
+    chunks = [range(x, min(x+chunk_size, num_samples)) for x in range(0, num_samples, chunk_size)]
+
+    start_time = time.time()
+
+    with tqdm.tqdm(total=num_samples, bar_format='{l_bar}{bar:40}{r_bar}{bar:-10b}') as pbar:
+
+        # Single process
+        if num_workers == 0:
+            for chunk in chunks:
+                pbar.update(compile_samples(compiled_dir, chunk, dataset))
+
+        # Multiple processes, each writing its chunks in place
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=init_worker,
+                initargs=(dataset,)
+                ) as executor:
+
+                futures = [executor.submit(compile_samples, compiled_dir, chunk) for chunk in chunks]
+
+                for future in concurrent.futures.as_completed(futures):
+                    pbar.update(future.result())
+
+    # Finally writing the index, which marks the compiled dataset as complete
+    index = {
+        'version': COMPILED_VERSION,
+        'classes': list(dataset.selected_classes),
+        'dtype': str(np.dtype(dtype)),
+        'num_samples': num_samples,
+        'height': h,
+        'width': w,
+        'color_images': [str(x.relative_to(dataset_dir)) for x in dataset.images_fps]
+    }
+    jt.save_to_json(index_fp, index)
+
+    total_time = time.time() - start_time
+    print(f'Compiled {num_samples} samples in {total_time:.2f}s ({num_samples/total_time:.2f} samples/s)')
+
+    return index
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compile the dense targets of a NOCS split into memory-mapped arrays')
+    parser.add_argument('--dataset_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--compiled_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--classes', type=str, nargs='+', default=None)
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=64)
+    args = parser.parse_args()
+
+    compile_pose_dataset(
+        args.dataset_dir,
+        args.compiled_dir,
+        classes=args.classes,
+        dtype=args.dtype,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size
+    )
@@ -0,0 +1,119 @@
+import os
+import sys
+import pathlib
+
+import numpy as np
+import cv2
+import scipy.spatial.transform
+
+import pytest
+
+# Local Imports (the paths and the environment are set by the conftest.py of
+# FastPoseCNN)
+import project as pj
+import json_tools as jt
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Regression tests
+
+The tests of the tools (and of lib) are the test_*.py files of this directory:
+
+    cd source_code/FastPoseCNN && python -m pytest -q tools
+
+They use small synthetic NOCS CAMERA frames (random poses and circular
+instances) instead of the real datasets.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Selected classes of the synthetic datasets (as in config.py)
+SELECTED_CLASSES = ['bg', 'camera', 'laptop']
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def create_random_frame(rng, max_num_of_instances=6, h=480, w=640):
+    """
+    Output:
+        mask (np.array): [H, W] instance mask (0 = background)
+        json_data (dict): the _meta+ data of the instances
+    """
+
+    intrinsics = pj.constants.INTRINSICS['NOCS']
+
+    mask = np.zeros((h, w))
+    json_data = {'instance_dict': {}, 'RTs': [], 'quaternions': [], 'scales': [], 'norm_factors': []}
+
+    for instance_id in range(1, rng.integers(1, max_num_of_instances+1)+1):
+
+        # Random pose in front of the camera
+        R = scipy.spatial.transform.Rotation.random(random_state=int(rng.integers(1e6)))
+        T = np.array([rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2), rng.uniform(0.5, 1.5)])
+        pose = np.eye(4)
+        pose[:3, :3] = R.as_matrix()
+        pose[:3, 3] = T
+
+        # Drawing the instance around its projected center
+        center = intrinsics @ T
+        center = (center[:2] / center[2]).astype(int)
+        cv2.circle(mask, (int(center[0]), int(center[1])), int(rng.integers(20, 80)), instance_id, -1)
+
+        json_data['instance_dict'][str(instance_id)] = int(rng.integers(1, 7))
+        json_data['RTs'].append(np.linalg.inv(pose).tolist())
+        json_data['quaternions'].append(R.as_quat().tolist())
+        json_data['scales'].append(rng.uniform(0.05, 0.3, 3).tolist())
+        json_data['norm_factors'].append(float(rng.uniform(0.5, 1.5)))
+
+    return mask, json_data
+
+def write_random_dataset(dataset_dir, num_of_scenes=2, samples_per_scene=3, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    for scene_id in range(num_of_scenes):
+
+        scene_dir = pathlib.Path(dataset_dir) / f'{scene_id:05d}'
+        os.makedirs(str(scene_dir))
+
+        for sample_id in range(samples_per_scene):
+
+            mask, json_data = create_random_frame(rng)
+
+            # Every sample has a camera (class 3), so none of them is empty
+            json_data['instance_dict']['1'] = 3
+
+            image = rng.integers(0, 256, (*mask.shape, 3), dtype=np.uint8)
+
+            # The masks are 3 channel pngs with 255 as the background
+            png_mask = np.where(mask == 0, 255, mask).astype(np.uint8)
+
+            cv2.imwrite(str(scene_dir / f'{sample_id:04d}_color.png'), image)
+            cv2.imwrite(str(scene_dir / f'{sample_id:04d}_mask.png'), np.stack([png_mask]*3, axis=-1))
+            jt.save_to_json(scene_dir / f'{sample_id:04d}_meta+.json', json_data)
+
+#-------------------------------------------------------------------------------
+# Fixtures
+
+@pytest.fixture(scope='session')
+def selected_classes():
+    return SELECTED_CLASSES
+
+@pytest.fixture(scope='session')
+def random_frames():
+
+    # (mask, json_data) frames of the size of the NOCS CAMERA frames
+    rng = np.random.default_rng(0)
+    return [create_random_frame(rng) for _ in range(8)]
+
+@pytest.fixture(scope='session')
+def dataset_dir(tmp_path_factory):
+
+    # A small NOCS-like split, shared by the tests (read-only)
+    dataset_dir = tmp_path_factory.mktemp('dataset')
+    write_random_dataset(dataset_dir)
+
+    return dataset_dir
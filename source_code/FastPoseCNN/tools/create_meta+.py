@@ -28,6 +28,7 @@ import draw
 
 DEBUG = False
 FAULTY_IMAGES = []
+FAULTY_BINARY_METAS = []
 
 #-------------------------------------------------------------------------------
 # Small Helper Functions
@@ -578,6 +579,7 @@ def test_new_data_organization():
 def create_new_dataset(dataset_path, obj_model_dir):
 
     global FAULTY_IMAGES
+    global FAULTY_BINARY_METAS
 
     all_color_images = get_image_paths_in_dir(dataset_path, max_size=None)
 
@@ -677,12 +679,26 @@ def create_new_dataset(dataset_path, obj_model_dir):
             FAULTY_IMAGES.append(color_image)
             continue
 
+        # Also saving the compact binary version (fast loading), a failure
+        # only removes the binary (the json is used instead)
+        new_binary_meta_filepath = color_image.parent / f'{data_id}_meta+.bin'
+        try:
+            json_tools.save_meta_to_binary(new_binary_meta_filepath, data)
+        except Exception:
+            FAULTY_BINARY_METAS.append(new_binary_meta_filepath)
+            if new_binary_meta_filepath.exists():
+                os.remove(str(new_binary_meta_filepath))
+
         enable_print()
 
     if len(FAULTY_IMAGES):
         data = {'faulty images': FAULTY_IMAGES}
         json_tools.save_to_json('faulty_images.json', data)
 
+    if len(FAULTY_BINARY_METAS):
+        data = {'faulty binary metas': FAULTY_BINARY_METAS}
+        json_tools.save_to_json('faulty_binary_metas.json', data)
+
     return None
 
 def load_new_dataset(dataset_path, obj_model_dir):
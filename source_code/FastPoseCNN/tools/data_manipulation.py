@@ -17,9 +17,6 @@ import scipy.linalg
 import sklearn.preprocessing
 import scipy.spatial.transform
 
-import matplotlib
-import matplotlib.pyplot as plt
-
 import torch
 
 # Local Imports
@@ -363,6 +360,163 @@ def create_simple_dense_3d_centers(mask, json_data):
 
     return xys, zs
 
+def create_label_lut(label_map, size, dtype=np.float64):
+    """
+    Input:
+        label_map: {old label: new label} (keys may be strings, as in json)
+        size: number of entries in the lookup table
+    Output:
+        lut: [size,] lookup table, labels not in label_map are mapped to 0
+    """
+
+    lut = np.zeros((size,), dtype=dtype)
+
+    for old_label, new_label in label_map.items():
+        lut[int(old_label)] = new_label
+
+    return lut
+
+def remap_labels(mask, label_map):
+    """
+    Remapping all the labels of a mask in a single lookup table pass, instead of
+    one full-image comparison per label.
+    Input:
+        mask: [H, W] label mask
+        label_map: {old label: new label}, any other label is set to 0
+    Output:
+        new_mask: [H, W] remapped mask (same dtype as the mask)
+    """
+
+    labels = mask.astype(np.intp)
+
+    # The lookup table needs to cover all the labels in the mask and in the map
+    size = max(int(labels.max(initial=0)), max([int(x) for x in label_map.keys()], default=0)) + 1
+    lut = create_label_lut(label_map, size, dtype=mask.dtype)
+
+    return lut[labels]
+
+def get_instances_parameters(json_data, intrinsics):
+    """
+    Constructing the per-instance parameter table of the dense representation.
+    Input:
+        json_data: the _meta+.json data of a sample
+        intrinsics: [3, 3] intrinsics parameters of the camera
+    Output:
+        parameters: dictionary with (in the order of json_data['instance_dict'])
+            instance_id: [N,]
+            class_id: [N,]
+            quaternion: [N, 4]
+            scales: [N, 3] (normalized scales)
+            center_2d: [N, 2] (x, y) quantized projection of the 3D center
+            z: [N,] log of the depth of the 3D center
+    """
+
+    instance_dict = json_data['instance_dict']
+    n = len(instance_dict)
+
+    parameters = {
+        'instance_id': np.array([int(x) for x in instance_dict.keys()], dtype=np.int64),
+        'class_id': np.array([int(x) for x in instance_dict.values()], dtype=np.int64)
+    }
+
+    # If no instances, return empty tables
+    if n == 0:
+        parameters.update({
+            'quaternion': np.zeros((0, 4), dtype=np.float32),
+            'scales': np.zeros((0, 3), dtype=np.float32),
+            'center_2d': np.zeros((0, 2), dtype=np.int32),
+            'z': np.zeros((0,), dtype=np.float64)
+        })
+        return parameters
+
+    RTs = np.asarray(json_data['RTs'][:n], dtype=np.float32).reshape((n, 4, 4))
+    quaternions = np.asarray(json_data['quaternions'][:n], dtype=np.float32).reshape((n, 4))
+    scales = np.asarray(json_data['scales'][:n], dtype=np.float32).reshape((n, 3))
+    norm_factors = np.asarray(json_data['norm_factors'][:n], dtype=np.float32).reshape((n, 1))
+
+    # The 3D center (origin of the object) in camera coordinates is the 
+    # translation of the inverse RT
+    inv_RTs = np.linalg.inv(RTs)
+
+    # Projecting the 3D centers (same math as transform_3d_camera_coords_to_2d_quantized_projections)
+    K_matrix = np.hstack([intrinsics, np.zeros((intrinsics.shape[0], 1), dtype=np.float32)])
+    homogeneous_projections_2d = K_matrix @ inv_RTs[:, :, 3:]
+    center_2d = (homogeneous_projections_2d[:, :-1, 0] / homogeneous_projections_2d[:, -1:, 0]).astype(np.int32)
+
+    parameters.update({
+        'quaternion': quaternions,
+        'scales': scales / norm_factors,
+        'center_2d': center_2d,
+        'z': np.log(inv_RTs[:, 2, 3].astype(np.float64) * 1000)
+    })
+
+    return parameters
+
+def create_dense_targets(mask, json_data, intrinsics):
+    """
+    Single-pass version of create_dense_quaternion, create_dense_scales and 
+    create_dense_3d_centers. The per-instance parameters are placed into lookup
+    tables indexed by the instance id, and the dense images are then created
+    with a single gather over the pixels of the instances.
+    Input:
+        mask: [H, W] instance mask
+        json_data: the _meta+.json data of a sample
+        intrinsics: [3, 3] intrinsics parameters of the camera
+    Output:
+        quaternions: [H, W, 4]
+        scales: [H, W, 3]
+        xys: [H, W, 2] unit vectors pointing to the projected 3D center
+        zs: [H, W] log of the depth of the 3D center
+    """
+
+    h, w = mask.shape
+
+    # Ultimately the output
+    quaternions = np.zeros((h, w, 4))
+    scales = np.zeros((h, w, 3))
+    xys = np.zeros((h, w, 2))
+    zs = np.zeros((h, w))
+
+    # Obtaining the per-instance parameters
+    parameters = get_instances_parameters(json_data, intrinsics)
+
+    # Only keep the instances that are present in the mask (0 is the background)
+    labels = mask.astype(np.intp)
+    size = max(int(labels.max(initial=0)), int(parameters['instance_id'].max(initial=0))) + 1
+    
+    # Lookup table from the instance id to its row in the parameter table
+    row_lut = np.full((size,), -1, dtype=np.intp)
+    row_lut[parameters['instance_id']] = np.arange(parameters['instance_id'].shape[0])
+    row_lut[0] = -1
+
+    # Gathering the rows of all the pixels
+    rows = row_lut[labels]
+    pixels_ys, pixels_xs = np.nonzero(rows >= 0)
+
+    # If the mask is empty, simply return the empty dense images
+    if pixels_ys.shape[0] == 0:
+        return quaternions, scales, xys, zs
+
+    pixels_rows = rows[pixels_ys, pixels_xs]
+
+    # Quaternion, scales and z are uniform per instance
+    quaternions[pixels_ys, pixels_xs] = parameters['quaternion'][pixels_rows]
+    scales[pixels_ys, pixels_xs] = parameters['scales'][pixels_rows]
+    zs[pixels_ys, pixels_xs] = parameters['z'][pixels_rows]
+
+    # Constructing the unit vectors pointing to the center
+    centers_2d = parameters['center_2d'][pixels_rows]
+    dx = centers_2d[:, 0].astype(np.int64) - pixels_xs
+    dy = centers_2d[:, 1].astype(np.int64) - pixels_ys
+    norm = np.sqrt((dy*dy + dx*dx).astype(np.float64))
+
+    # The pixel at the center has no direction (nan values are removed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xys[pixels_ys, pixels_xs, 0] = np.nan_to_num(dx / norm)
+        xys[pixels_ys, pixels_xs, 1] = np.nan_to_num(dy / norm)
+
+    return quaternions, scales, xys, zs
+
 #-------------------------------------------------------------------------------
 # get Functions
 
@@ -1330,4 +1484,77 @@ def fix_quat_RT_matrix(intrinsics, original_RT, quat_RT, pts=None):
     return quat_RT
 
 #-------------------------------------------------------------------------------
-# Quaternion Functions
\ No newline at end of file
+# Quaternion Functions
+
+#-------------------------------------------------------------------------------
+# Test Functions
+
+def test_dense_targets_benchmark(num_of_frames=20, max_num_of_instances=6, h=480, w=640):
+
+    import time
+
+    intrinsics = project.constants.INTRINSICS['NOCS']
+    rng = np.random.default_rng(0)
+
+    # Creating random frames similar to the NOCS CAMERA frames
+    frames = []
+    for _ in range(num_of_frames):
+
+        mask = np.zeros((h, w))
+        json_data = {'instance_dict': {}, 'RTs': [], 'quaternions': [], 'scales': [], 'norm_factors': []}
+
+        for instance_id in range(1, rng.integers(1, max_num_of_instances+1)+1):
+
+            # Random pose in front of the camera
+            R = scipy.spatial.transform.Rotation.random(random_state=int(rng.integers(1e6)))
+            T = np.array([rng.uniform(-0.2, 0.2), rng.uniform(-0.2, 0.2), rng.uniform(0.5, 1.5)])
+            pose = np.eye(4)
+            pose[:3, :3] = R.as_matrix()
+            pose[:3, 3] = T
+
+            # Drawing the instance around its projected center
+            center = intrinsics @ T
+            center = (center[:2] / center[2]).astype(int)
+            cv2.circle(mask, (int(center[0]), int(center[1])), int(rng.integers(20, 80)), instance_id, -1)
+
+            json_data['instance_dict'][str(instance_id)] = int(rng.integers(1, 7))
+            json_data['RTs'].append(np.linalg.inv(pose).tolist())
+            json_data['quaternions'].append(R.as_quat().tolist())
+            json_data['scales'].append(rng.uniform(0.05, 0.3, 3).tolist())
+            json_data['norm_factors'].append(float(rng.uniform(0.5, 1.5)))
+
+        frames.append((mask, json_data))
+
+    # Current functions
+    start_time = time.time()
+    old_outputs = []
+    for mask, json_data in frames:
+        quaternions = create_dense_quaternion(mask, json_data)
+        scales = create_dense_scales(mask, json_data)
+        xy, z = create_dense_3d_centers(mask, json_data, intrinsics)
+        old_outputs.append((quaternions, scales, xy, z))
+    old_time = (time.time() - start_time) / num_of_frames
+
+    # Single-pass function
+    start_time = time.time()
+    new_outputs = []
+    for mask, json_data in frames:
+        new_outputs.append(create_dense_targets(mask, json_data, intrinsics))
+    new_time = (time.time() - start_time) / num_of_frames
+
+    # Checking that both produce the same dense images
+    max_error = max([np.max(np.abs(old - new)) for old_output, new_output in zip(old_outputs, new_outputs) for old, new in zip(old_output, new_output)])
+
+    print(f'{h}x{w} frames, up to {max_num_of_instances} instances')
+    print(f'current functions: {old_time*1000:.2f} ms/frame')
+    print(f'create_dense_targets: {new_time*1000:.2f} ms/frame ({old_time/new_time:.1f}x)')
+    print(f'max abs difference: {max_error}')
+
+    return old_time, new_time, max_error
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    test_dense_targets_benchmark()
@@ -1,14 +1,20 @@
 import os
 from os import replace
+import io
 import sys
+import json
+import math
 import shutil
+import tarfile
 import pathlib
+import itertools
 import collections
 from typing import List
 
 import pdb
 
 import random
+import multiprocessing
 import numpy as np
 import cv2
 import imutils
@@ -25,12 +31,6 @@ import torchvision.transforms.functional
 import catalyst
 import segmentation_models_pytorch as smp
 
-import matplotlib
-if os.environ.get('DISPLAY', '') == '':
-    matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.cm
-
 # Local Imports
 
 root = next(path for path in pathlib.Path(os.path.abspath(__file__)).parents if path.name == 'FastPoseCNN')
@@ -42,6 +42,8 @@ import project as pj
 import draw as dr
 import visualize as vz
 import transforms
+import dataset_index as di
+import distributed_tools as dt
 
 #-------------------------------------------------------------------------------
 # File Constants
@@ -49,6 +51,24 @@ import transforms
 ENCODER = 'resnext50_32x4d'
 ENCODER_WEIGHTS = 'imagenet'
 
+# Compiled dataset layout
+COMPILED_INDEX_NAME = 'index.json'
+COMPILED_KEYS = ['mask', 'quaternion', 'scales', 'xy', 'z']
+
+# Sharded dataset layout
+SHARDS_INDEX_NAME = 'shards.json'
+
+# Maximum number of instances per sample (padded per-instance tables)
+MAX_NUM_OF_INSTANCES = 32
+
+# Compact transport: dense fields as int16 fixed point (value = quantized / scale)
+QUANTIZATION_SCALES = {
+    'quaternion': 32767, # [-1, 1]
+    'scales': 32767,     # normalized scales, [0, 1]
+    'xy': 32767,         # unit vectors, [-1, 1]
+    'z': 2048            # log(depth in mm), [0, 16)
+}
+
 #-------------------------------------------------------------------------------
 # Old Data Classes
 
@@ -935,6 +955,31 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
             (e.g. flip, scale, etc.)
         preprocessing (albumentations.Compose): data preprocessing 
             (e.g. noralization, shape manipulation, etc.)
+        compiled_dir (str): filepath to the compiled dense targets of the dataset
+        use_index (bool): obtain the samples from the persistent dataset index
+            instead of walking the directory and parsing every _meta+.json
+        index_dir (str): directory of the dataset indices (default:
+            $DATASET_INDEX_DIR or ~/.cache/FastPoseCNN), the samples are found by the directory walk if
+            the index cannot be written
+        index_workers (int): processes used to (re)build the dataset index
+        cache (sample_cache.DecodedSampleCache): cache of the decoded images
+        compact (bool): return a uint8 mask and int16 quantized dense fields
+            (restored with dequantize_batch) to reduce the DataLoader IPC
+        dense_targets (bool): if False, return the instance mask and the padded
+            per-instance parameters instead of the dense targets (expanded on
+            the training device by lib.DenseTargetGenerator)
+        instance_data (bool): also return the instance mask and the per-instance
+            tables with the dense targets, and aggregate the ground truth in
+            collate (see create_agg_gt, only built when instance_data is set)
+        crop_size (tuple): (h, w) of a crop around a random instance, the
+            targets are created with the intrinsics of the crop (returned as
+            'intrinsics')
+        resolution_scale (float): downscaling of the (cropped) sample, can be
+            changed while training with set_resolution_scale
+        subset_seed (int): if given, max_size selects a random subset of the
+            samples instead of the first ones in the directory order
+        feature_cache (feature_cache.FeatureCache): cached encoder features,
+            returned with each sample (see set_feature_cache)
     """
 
     CLASSES = pj.constants.NOCS_CLASSES
@@ -948,7 +993,19 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
         max_size=None,
         classes=None,
         augmentation=None,
-        preprocessing=None
+        preprocessing=None,
+        compiled_dir=None,
+        use_index=False,
+        index_dir=None,
+        index_workers=0,
+        cache=None,
+        compact=False,
+        dense_targets=True,
+        instance_data=False,
+        crop_size=None,
+        resolution_scale=1.0,
+        subset_seed=None,
+        feature_cache=None
         ):
 
         # If None or just all the classes, no nead of class values map
@@ -960,22 +1017,117 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
             self.selected_classes = classes
             self.class_values_map = {self.CLASSES.index(cls.lower()):self.selected_classes.index(cls) for cls in self.selected_classes}
 
+        # Saving the location of the samples (and of their statistics)
+        self.dataset_dir = pathlib.Path(dataset_dir)
+        self.index_path = None
+        self.subset_seed = subset_seed
+        self.class_counts = None
+
         # Obtaining the filepaths for the images
-        self.images_fps = self.get_image_paths_in_dir(dataset_dir, max_size=max_size)
+        if compiled_dir is None:
+            self.compiled_dir = None
+            if use_index:
+                self.images_fps = self.get_image_paths_in_index(dataset_dir, index_dir, max_size=max_size, num_workers=index_workers)
+            else:
+                self.images_fps = self.get_image_paths_in_dir(dataset_dir, max_size=max_size)
+        # or from the index of the compiled dataset (no directory walk)
+        else:
+            self.compiled_dir = pathlib.Path(compiled_dir)
+            self.images_fps = self.get_image_paths_in_compiled_dir(dataset_dir, self.compiled_dir, max_size=max_size)
+
+        # The memory-mapped arrays are opened lazily (once per worker)
+        self.compiled_arrays = None
 
         # Saving parameters
         self.augmentation = augmentation
         self.preprocessing = preprocessing
+        self.cache = cache
+        self.compact = compact
+        self.dense_targets = dense_targets
+        self.instance_data = instance_data
+
+        self.crop_size = crop_size
+
+        # Shared with the (persistent) workers, to follow resolution schedules
+        self.resolution_scale = multiprocessing.Value('d', resolution_scale, lock=False)
+
+        # The compiled dataset only contains dense targets
+        if self.compiled_dir is not None and (dense_targets is False or instance_data):
+            raise RuntimeError('The compiled dataset only provides dense targets')
+
+        # (at the full resolution)
+        if self.compiled_dir is not None and (crop_size is not None or resolution_scale != 1):
+            raise RuntimeError('The compiled dataset does not support cropping or resizing')
+
+        # Cached encoder features (of the full, non-augmented images)
+        self.feature_cache = None
+        if feature_cache is not None:
+            self.set_feature_cache(feature_cache)
 
     def __getitem__(self, i):
+        return self.load_sample(
+            i,
+            dense_targets=self.dense_targets,
+            compact=self.compact,
+            instance_data=self.instance_data
+        )
+
+    def load_sample(self, i, dense_targets=True, compact=False, instance_data=False):
+
+        # Reading the dense data from the compiled dataset
+        if self.compiled_dir is not None:
+            sample = self.read_compiled_sample(i)
+
+        else:
+
+            # Reading the raw data
+            image, mask, json_data = self.read_raw_sample(i)
+
+            # Cropping around an instance and/or downscaling
+            if self.crop_size is not None or self.resolution_scale.value != 1:
+                image, mask, intrinsics = self.crop_raw_sample(image, mask, json_data)
+            else:
+                intrinsics = self.INTRINSICS
+
+            # Constructing the dense data
+            if dense_targets and instance_data is False:
+                sample = self.create_dense_sample(image, mask, json_data, intrinsics)
+
+            # or only the per-instance data
+            elif dense_targets is False:
+                sample = self.create_instance_sample(image, mask, json_data, intrinsics)
+
+            # or both (the dense sample modifies the json_data, so it goes last)
+            else:
+                sample = self.create_instance_sample(image, mask, json_data, intrinsics)
+                sample.update(self.create_dense_sample(image, mask, json_data, intrinsics))
+
+            # The intrinsics of the crop (needed to recover the translations)
+            if intrinsics is not self.INTRINSICS:
+                sample['intrinsics'] = intrinsics.astype(np.float32)
+
+        # Applying preprocessing and converting to Torch dataformat convention
+        sample = self.process_sample(sample)
+
+        # Adding the cached encoder features of the sample
+        if self.feature_cache is not None:
+            sample.update(self.feature_cache[i])
+
+        # Shrinking the sample for the transport to the main process
+        if compact:
+            sample = quantize_sample(sample)
+
+        return sample
+
+    def read_raw_sample(self, i):
 
         # Reading data
         # Image
-        image = skimage.io.imread(str(self.images_fps[i]))
+        image = self.read_image(str(self.images_fps[i]))
 
         # Mask
         mask_fp = str(self.images_fps[i]).replace('_color.png', '_mask.png')
-        mask = skimage.io.imread(mask_fp, 0)[:,:,0].astype('float')
+        mask = self.read_mask(mask_fp).astype('float')
         mask[mask == 255] = 0
 
         # Depth
@@ -987,31 +1139,139 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
 
         # Other data
         json_fp = str(self.images_fps[i]).replace('_color.png', '_meta+.json')
-        json_data = jt.load_from_json(json_fp)
+        json_data = jt.load_meta(json_fp)
+
+        return image, mask, json_data
 
-        # Removing destraction objects
-        new_mask = np.zeros_like(mask)
-        for instance_id in json_data['instance_dict'].keys():
-            new_mask[mask == int(instance_id)] = int(instance_id)
-        mask = new_mask
+    def read_image(self, image_fp):
+
+        # Decoding the image, unless already in the cache
+        if self.cache is None:
+            return skimage.io.imread(image_fp)
+        else:
+            return self.cache.load(image_fp, skimage.io.imread, tag='image')
 
-        # Removing the unwanted classes
+    def read_mask(self, mask_fp):
+
+        # Only the first channel of the mask is used (and cached)
+        decode_fn = lambda x: skimage.io.imread(x, 0)[:,:,0]
+
+        if self.cache is None:
+            return decode_fn(mask_fp)
+        else:
+            return self.cache.load(mask_fp, decode_fn, tag='mask')
+
+    def set_resolution_scale(self, resolution_scale):
+
+        # The cached features are only valid for the full images
+        if self.feature_cache is not None and resolution_scale != 1:
+            raise RuntimeError('The feature cache does not support resizing')
+
+        self.resolution_scale.value = resolution_scale
+
+    def set_feature_cache(self, feature_cache):
+
+        # The features are cached for the full images, in the order of the samples
+        if feature_cache is not None:
+            if self.crop_size is not None or self.resolution_scale.value != 1:
+                raise RuntimeError('The feature cache does not support cropping or resizing')
+            if len(feature_cache) != len(self.images_fps):
+                raise RuntimeError(f'The feature cache has {len(feature_cache)} samples, the dataset {len(self.images_fps)}')
+
+        self.feature_cache = feature_cache
+
+    def crop_raw_sample(self, image, mask, json_data):
+        """
+        Args:
+            image (np.array): [H, W, 3] color image
+            mask (np.array): [H, W] instance mask
+            json_data (dict): the _meta+ data of the sample
+        Objective:
+            Crop a window of crop_size around a random instance (of the wanted
+            classes) and downscale it by the resolution scale (rounded to a
+            multiple of 32 for the encoder). The intrinsics are modified
+            accordingly, so the projected centers (and therefore the xy unit
+            vectors) are computed in the coordinates of the output.
+        Output:
+            image (np.array): [h, w, 3]
+            mask (np.array): [h, w]
+            intrinsics (np.array): [3, 3] intrinsics of the output
+        """
+
+        h, w = mask.shape
+        crop_h, crop_w = self.crop_size if self.crop_size is not None else (h, w)
+
+        if crop_h > h or crop_w > w:
+            raise RuntimeError(f'Crop size {self.crop_size} larger than the image {(h, w)}')
+
+        # Selecting a random instance of the wanted classes
+        instance_ids = [
+            int(id_value) for id_value, class_value in json_data['instance_dict'].items()
+            if class_value in self.class_values_map.keys() and self.class_values_map[class_value] != 0
+        ]
+        random.shuffle(instance_ids)
+
+        center = None
+        for instance_id in instance_ids:
+            ys, xs = np.nonzero(mask == instance_id)
+            if ys.shape[0] > 0:
+                # (with some jitter, the instance is not always centered).
+                # Python's random is reseeded in each DataLoader worker, unlike
+                # np.random before torch 1.9
+                center = (
+                    np.mean(xs) + random.uniform(-0.25, 0.25) * crop_w,
+                    np.mean(ys) + random.uniform(-0.25, 0.25) * crop_h
+                )
+                break
+
+        # Without instances, a random crop
+        if center is None:
+            center = (random.uniform(0, w), random.uniform(0, h))
+
+        # Keeping the crop inside the image (no padding)
+        left = int(np.clip(round(center[0] - crop_w / 2), 0, w - crop_w))
+        top = int(np.clip(round(center[1] - crop_h / 2), 0, h - crop_h))
+
+        image = image[top:top+crop_h, left:left+crop_w]
+        mask = mask[top:top+crop_h, left:left+crop_w]
+
+        # Downscaling (the output size is a multiple of 32)
+        scale = self.resolution_scale.value
+        out_h = max(32, int(round(crop_h * scale / 32)) * 32)
+        out_w = max(32, int(round(crop_w * scale / 32)) * 32)
+
+        if (out_h, out_w) != (crop_h, crop_w):
+            image = cv2.resize(image, (out_w, out_h), interpolation=cv2.INTER_AREA)
+            mask = cv2.resize(mask, (out_w, out_h), interpolation=cv2.INTER_NEAREST)
+
+        # Intrinsics of the output: u' = (u - left + 0.5) * sx - 0.5
+        sx = out_w / crop_w
+        sy = out_h / crop_h
+        intrinsics = np.array(self.INTRINSICS, dtype=np.float64)
+        intrinsics[0, 0] *= sx
+        intrinsics[1, 1] *= sy
+        intrinsics[0, 2] = (intrinsics[0, 2] - left + 0.5) * sx - 0.5
+        intrinsics[1, 2] = (intrinsics[1, 2] - top + 0.5) * sy - 0.5
+
+        return image, mask, intrinsics
+
+    def create_dense_sample(self, image, mask, json_data, intrinsics=None):
+
+        if intrinsics is None:
+            intrinsics = self.INTRINSICS
+
+        # Removing destraction objects and the unwanted classes
         new_instance_dict, mask = self.keep_only_wanted_classes(json_data['instance_dict'], mask)
 
-        # Create dense representation of the data
-        quaternions = dm.create_dense_quaternion(mask, json_data)
-        scales = dm.create_dense_scales(mask, json_data)
-        xy, z = dm.create_dense_3d_centers(mask, json_data, self.INTRINSICS)
+        # Create dense representation of the data (single pass)
+        quaternions, scales, xy, z = dm.create_dense_targets(mask, json_data, intrinsics)
         #xy, z = dm.create_simple_dense_3d_centers(mask, json_data)
 
         # After creating the dense data, replace the json_data['instance_dict']
         json_data['instance_dict'] = new_instance_dict
 
         # Converting instances mask to classes mask
-        new_mask = np.zeros_like(mask)
-        for instance_id, class_id in json_data['instance_dict'].items():
-            new_mask[mask == int(instance_id)] = class_id
-        mask = new_mask
+        mask = dm.remap_labels(mask, json_data['instance_dict'])
 
         # Storing mask and image into sample
         sample = {
@@ -1024,6 +1284,89 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
             'z': z
         }
 
+        return sample
+
+    def create_instance_sample(self, image, mask, json_data, intrinsics=None):
+
+        if intrinsics is None:
+            intrinsics = self.INTRINSICS
+
+        # Removing destraction objects and the unwanted classes
+        new_instance_dict, mask = self.keep_only_wanted_classes(json_data['instance_dict'], mask)
+
+        # Obtaining the per-instance parameters of the wanted instances
+        parameters = dm.get_instances_parameters(json_data, intrinsics)
+        rows = [r for r, x in enumerate(parameters['instance_id']) if int(x) in new_instance_dict]
+        n = len(rows)
+
+        if n > MAX_NUM_OF_INSTANCES:
+            raise RuntimeError(f'Too many instances ({n}), MAX_NUM_OF_INSTANCES = {MAX_NUM_OF_INSTANCES}')
+
+        # Instance mask: 0 for the background, then k+1 for the k-th row of the tables
+        instance_mask = dm.remap_labels(
+            mask, 
+            {int(parameters['instance_id'][r]):k+1 for k, r in enumerate(rows)}
+        ).astype(np.uint8)
+
+        # Converting instances mask to classes mask
+        mask = dm.remap_labels(mask, new_instance_dict)
+
+        # Padded per-instance tables
+        RTs = np.asarray(json_data['RTs'], dtype=np.float32).reshape((-1, 4, 4))
+        tables = {
+            'instance_class_id': (np.array([new_instance_dict[int(parameters['instance_id'][r])] for r in rows], dtype=np.int64), ()),
+            'instance_quaternion': (parameters['quaternion'][rows], (4,)),
+            'instance_scales': (parameters['scales'][rows], (3,)),
+            'instance_RT': (RTs[rows], (4, 4)),
+            'instance_center_2d': (parameters['center_2d'][rows].astype(np.float32), (2,)),
+            'instance_z': (parameters['z'][rows].astype(np.float32), ())
+        }
+
+        # Number of pixels of each instance (instances can be fully occluded)
+        tables['instance_num_of_pixels'] = (np.bincount(instance_mask.ravel(), minlength=n+1)[1:n+1].astype(np.int64), ())
+
+        sample = {
+            'clean_image': image,
+            'image': image,
+            'mask': mask,
+            'instance_mask': instance_mask,
+            'num_of_instances': np.array(n, dtype=np.int64)
+        }
+
+        for key, (table, shape) in tables.items():
+            padded_table = np.zeros((MAX_NUM_OF_INSTANCES, *shape), dtype=table.dtype)
+            padded_table[:n] = table
+            sample[key] = padded_table
+
+        return sample
+
+    def read_compiled_sample(self, i):
+
+        # Opening the memory-mapped arrays, if not done already in this process
+        if self.compiled_arrays is None:
+            self.compiled_arrays = open_compiled_arrays(self.compiled_dir)
+
+        # Image (the compiled dataset only stores the dense targets)
+        image = self.read_image(str(self.images_fps[i]))
+
+        # Index of the sample within the compiled dataset
+        c_i = self.compiled_ids[i]
+
+        # Copying the data out of the memory-mapped arrays
+        sample = {
+            'clean_image': image,
+            'image': image,
+            'mask': np.array(self.compiled_arrays['mask'][c_i]),
+            'quaternion': np.array(self.compiled_arrays['quaternion'][c_i]),
+            'scales': np.array(self.compiled_arrays['scales'][c_i]),
+            'xy': np.array(self.compiled_arrays['xy'][c_i]),
+            'z': np.array(self.compiled_arrays['z'][c_i])
+        }
+
+        return sample
+
+    def process_sample(self, sample):
+
         # apply augmentations
         """
         if self.augmentation:
@@ -1044,13 +1387,14 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
         # Changing dtype
         sample.update({
             'image': skimage.img_as_float32(sample['image']),
-            'mask': sample['mask'].astype('long'),
-            'quaternion': skimage.img_as_float32(sample['quaternion']),
-            'scales': skimage.img_as_float32(sample['scales']),
-            'xy': skimage.img_as_float32(sample['xy']),
-            'z': skimage.img_as_float32(sample['z'])
+            'mask': sample['mask'].astype('long')
         })
 
+        # (the dense targets are not present when only the instances are used)
+        for key in ['quaternion', 'scales', 'xy', 'z']:
+            if key in sample:
+                sample[key] = skimage.img_as_float32(sample[key])
+
         return sample
 
     def __len__(self):
@@ -1097,8 +1441,9 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
             directories = [x for x in eval_path.iterdir() if x.is_dir()]
             eval_paths += directories
 
-            # If max size is reached or overpassed, break from loop
-            if max_size != None:
+            # If max size is reached or overpassed, break from loop (a random
+            # subset needs all the samples)
+            if max_size != None and self.subset_seed is None:
                 if len(total_path_list) >= max_size:
                     break
 
@@ -1107,7 +1452,71 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
 
         # Trimming excess if dataset_max_size is set
         if max_size != None:
-            total_path_list = total_path_list[:max_size]
+            total_path_list = [total_path_list[i] for i in self.get_subset_ids(len(total_path_list), max_size)]
+
+        return total_path_list
+
+    def get_subset_ids(self, num_of_samples, max_size):
+
+        # The first samples, or a random subset (kept in the directory order)
+        if self.subset_seed is None or max_size >= num_of_samples:
+            return list(range(min(max_size, num_of_samples)))
+        else:
+            return sorted(random.Random(self.subset_seed).sample(range(num_of_samples), int(max_size)))
+
+    def get_image_paths_in_index(self, dataset_dir, index_dir=None, max_size=None, num_workers=0):
+
+        # Building the index only if missing or stale, on the first rank only
+        # (the other ranks wait and then use the same index)
+        rank, world_size = dt.get_distributed_info()
+
+        index_path = di.get_index_path(dataset_dir, index_dir)
+
+        if rank == 0:
+            index_path = di.get_index(dataset_dir, index_path, num_workers=num_workers)
+
+        if world_size > 1:
+            torch.distributed.barrier()
+            if rank != 0:
+                index_path = di.get_index(dataset_dir, index_path, build=False)
+
+        # The index could not be written (e.g. read-only storage)
+        if index_path is None:
+            print(f'No dataset index available, walking {dataset_dir} instead')
+            return self.get_image_paths_in_dir(dataset_dir, max_size=max_size)
+
+        self.index_path = index_path
+
+        # Class filtering, empty-sample removal and max_size are a single query,
+        # with the same order as get_image_paths_in_dir
+        total_path_list = di.query_samples(
+            index_path,
+            dataset_dir,
+            class_ids=self.class_values_map.keys(),
+            max_size=max_size,
+            subset_seed=self.subset_seed
+        )
+
+        return total_path_list
+
+    def get_image_paths_in_compiled_dir(self, dataset_dir, compiled_dir, max_size=None):
+
+        # Loading the index of the compiled dataset
+        index = load_compiled_index(compiled_dir)
+
+        # The compiled dense data depends on the selected classes
+        if index['classes'] != list(self.selected_classes):
+            raise RuntimeError(f'Compiled dataset classes {index["classes"]} do not match the selected classes {list(self.selected_classes)}')
+
+        # The color images are stored relative to the dataset directory
+        total_path_list = [pathlib.Path(dataset_dir) / x for x in index['color_images']]
+        self.compiled_ids = np.arange(len(total_path_list))
+
+        # Trimming excess if dataset_max_size is set
+        if max_size != None:
+            subset_ids = self.get_subset_ids(len(total_path_list), max_size)
+            total_path_list = [total_path_list[i] for i in subset_ids]
+            self.compiled_ids = self.compiled_ids[subset_ids]
 
         return total_path_list
 
@@ -1119,7 +1528,7 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
 
             # Obtain the json data
             json_fp = str(file_paths[i]).replace('_color.png', '_meta+.json')
-            json_data = jt.load_from_json(json_fp)
+            json_data = jt.load_meta(json_fp)
 
             # Get the instance data
             instance_dict = json_data['instance_dict']
@@ -1133,12 +1542,43 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
 
         return good_samples_fps
 
+    def get_class_counts(self):
+        """
+        Output:
+            class_counts (np.array): [N, C] number of instances of each selected
+                class (C = len(selected_classes)) in each sample
+        """
+
+        # Computed only once
+        if self.class_counts is not None:
+            return self.class_counts
+
+        # From the dataset index (no json parsing)
+        if self.index_path is not None:
+            samples_class_counts = di.query_class_counts(self.index_path, self.dataset_dir, self.images_fps)
+
+        # or from the _meta+ of every sample
+        else:
+            samples_class_counts = []
+            for image_fp in self.images_fps:
+                instance_dict = jt.load_meta(str(image_fp).replace('_color.png', '_meta+.json'))['instance_dict']
+                sample_class_counts = collections.Counter([int(x) for x in instance_dict.values()])
+                samples_class_counts.append(dict(sample_class_counts))
+
+        # Mapping the classes into the selected classes
+        class_counts = np.zeros((len(self.images_fps), len(self.selected_classes)), dtype=np.int64)
+        for i, sample_class_counts in enumerate(samples_class_counts):
+            for class_value, count in sample_class_counts.items():
+                if class_value in self.class_values_map.keys():
+                    class_counts[i, self.class_values_map[class_value]] += count
+
+        self.class_counts = class_counts
+
+        return class_counts
+
     def keep_only_wanted_classes(self, instance_dict, instances_mask=None):
 
         good_instance_dict = {}
-        
-        if instances_mask is not None:
-            good_instances_mask = np.zeros_like(instances_mask)
 
         for id_value, class_value in instance_dict.items():
 
@@ -1146,32 +1586,477 @@ class NOCSPoseRegDataset(torch.utils.data.Dataset):
             if class_value in self.class_values_map.keys():
                 good_instance_dict[int(id_value)] = self.class_values_map[class_value]
 
-                if instances_mask is not None:
-                    good_instances_mask[instances_mask == int(id_value)] = int(id_value)
-
         if instances_mask is not None:
+            # Keeping only the good instances in the mask (single lookup table pass)
+            good_instances_mask = dm.remap_labels(instances_mask, {x:x for x in good_instance_dict.keys()})
             return good_instance_dict, good_instances_mask       
         else:
             return good_instance_dict
 
+    def collate(self, samples):
+        batch = torch.utils.data.dataloader.default_collate(samples)
+        return self.finalize_batch(batch)
+
+    def finalize_batch(self, batch):
+
+        # Aggregating the ground truth from the per-instance tables (only if
+        # requested, the tables are also used for the device dense targets)
+        if self.instance_data and 'instance_class_id' in batch:
+            batch['agg_gt'] = create_agg_gt(batch, len(self.selected_classes))
+
+        return batch
+
     def get_random_batched_sample(self, batch_size=1):
 
-        batched_sample = {}
+        sample_ids = np.random.choice(np.arange(self.__len__()), size=batch_size, replace=False)
 
-        for sample_id in np.random.choice(np.arange(self.__len__()), size=batch_size, replace=False):
+        return self.get_batched_sample(sample_ids)
 
-            sample = self.__getitem__(sample_id)
+    def get_batched_sample(self, sample_ids):
 
-            for key in sample.keys():
+        # Visualizations use the float32 dense targets
+        samples = [self.load_sample(sample_id) for sample_id in sample_ids]
 
-                if key in batched_sample.keys():
-                    batched_sample[key] = np.concatenate([batched_sample[key], np.expand_dims(sample[key], axis=0)], axis=0)
+        # Stacking each key only once
+        batched_sample = {key: np.stack([x[key] for x in samples]) for key in samples[0].keys()}
 
-                else:
-                    batched_sample[key] = np.expand_dims(sample[key], axis=0)
+        return batched_sample
+
+class NOCSPoseRegShardDataset(torch.utils.data.IterableDataset):
+    """NOCS Dataset streamed from sequential tar shards (see shard_dataset.py).
+    Each DataLoader worker of each DDP rank reads its own subset of the shards,
+    and the samples are shuffled with a shuffle buffer.
+
+    Args:
+        shards_dir (str): filepath to the shards (and their shards.json index)
+        max_size (int): maximum number of samples
+        classes (list): classes used to write the shards
+        augmentation (albumentations.Compose): data transfromation pipeline
+        preprocessing (albumentations.Compose): data preprocessing
+        shuffle_buffer_size (int): number of samples in the shuffle buffer
+            (0 = no shuffling)
+    
+    Like torch.utils.data.DistributedSampler, every DDP rank yields the same
+    number of samples per epoch (ceil(N / world_size)), repeating samples of
+    its shards when they do not divide evenly. Use a number of shards that is
+    a multiple of the world size times the number of workers to avoid them.
+    The assignment of the shards to the ranks rotates by one shard every epoch
+    (see set_epoch), so that every rank eventually sees all the shards.
+    """
+
+    CLASSES = NOCSPoseRegDataset.CLASSES
+    COLORMAP = NOCSPoseRegDataset.COLORMAP
+    INTRINSICS = NOCSPoseRegDataset.INTRINSICS
+    TORCH_INTRINSICS = NOCSPoseRegDataset.TORCH_INTRINSICS
+
+    # Same dense synthesis and processing as the map-style dataset
+    keep_only_wanted_classes = NOCSPoseRegDataset.keep_only_wanted_classes
+    create_dense_sample = NOCSPoseRegDataset.create_dense_sample
+    process_sample = NOCSPoseRegDataset.process_sample
+
+    def __init__(
+        self,
+        shards_dir,
+        max_size=None,
+        classes=None,
+        augmentation=None,
+        preprocessing=None,
+        shuffle_buffer_size=1000
+        ):
+
+        # If None or just all the classes, no nead of class values map
+        if classes is None or classes == self.CLASSES:
+            self.selected_classes = self.CLASSES
+            self.class_values_map = {self.CLASSES.index(cls.lower()):self.CLASSES.index(cls.lower()) for cls in self.selected_classes}
+        # then create class values map
+        elif classes:
+            self.selected_classes = classes
+            self.class_values_map = {self.CLASSES.index(cls.lower()):self.selected_classes.index(cls) for cls in self.selected_classes}
+
+        # Loading the index of the shards
+        self.shards_dir = pathlib.Path(shards_dir)
+        index = load_shards_index(self.shards_dir)
+
+        # The shards only contain the samples with instances of their classes
+        if index['classes'] != list(self.selected_classes):
+            raise RuntimeError(f'Shards classes {index["classes"]} do not match the selected classes {list(self.selected_classes)}')
+
+        # Selecting the shards (and number of samples of each) given max_size
+        self.shards = []
+        total_num_of_samples = 0
+        for shard in index['shards']:
+
+            if max_size != None and total_num_of_samples >= max_size:
+                break
+
+            num_of_samples = shard['num_samples']
+            if max_size != None:
+                num_of_samples = min(num_of_samples, max_size - total_num_of_samples)
+
+            self.shards.append((self.shards_dir / shard['name'], num_of_samples))
+            total_num_of_samples += num_of_samples
+
+        # Saving parameters
+        self.augmentation = augmentation
+        self.preprocessing = preprocessing
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+        # Shared with the (persistent) workers, to rotate the shards of the ranks
+        self.epoch = multiprocessing.Value('i', 0, lock=False)
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def __len__(self):
+
+        # Number of samples seen by this rank (all of its workers), the same
+        # for all the ranks so that they run the same number of batches
+        rank, world_size = dt.get_distributed_info()
+        return self.get_rank_num_of_samples(world_size)
+
+    def get_rank_num_of_samples(self, world_size):
+        total_num_of_samples = sum([x[1] for x in self.shards])
+        return int(math.ceil(total_num_of_samples / world_size))
+
+    def get_worker_shards(self):
+        """
+        Output:
+            shards (list): [(shard_fp, num_of_samples), ...] of this worker
+            num_of_samples (int): number of samples that this worker yields
+            rng (random.Random): random generator of this worker
+        """
+
+        rank, world_size = dt.get_distributed_info()
+        worker_info = torch.utils.data.get_worker_info()
+
+        # Shards of this rank (a repeated shard if there are more ranks than
+        # shards), rotated by one shard every epoch
+        offset = self.epoch.value % len(self.shards)
+        shards = self.shards[offset:] + self.shards[:offset]
+        shards = shards[rank::world_size] or [shards[rank % len(shards)]]
+        num_of_samples = self.get_rank_num_of_samples(world_size)
+
+        # then of this worker (with its share of the samples of the rank)
+        if worker_info is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            shards = shards[worker_id::num_workers] or [shards[worker_id % len(shards)]]
+            num_of_samples = num_of_samples // num_workers + int(worker_id < num_of_samples % num_workers)
+            seed = worker_info.seed
+
+        return list(shards), num_of_samples, random.Random(seed)
+
+    def read_shards(self, shards, num_of_samples, rng):
+
+        # Reading the shards (in a different order every pass) until exactly
+        # num_of_samples samples are read, repeating them if needed
+        num_of_read_samples = 0
+
+        while num_of_read_samples < num_of_samples:
+
+            rng.shuffle(shards)
+
+            for shard_fp, shard_num_of_samples in shards:
+                for key, files in self.read_shard(shard_fp, shard_num_of_samples):
+
+                    yield key, files
+                    num_of_read_samples += 1
+
+                    if num_of_read_samples >= num_of_samples:
+                        return
+
+            # (empty shards would never reach num_of_samples)
+            if num_of_read_samples == 0:
+                raise RuntimeError(f'No samples found in the shards of {self.shards_dir}')
+
+    def read_shard(self, shard_fp, num_of_samples):
+
+        # Reading the tar file sequentially, grouping the files of each sample
+        current_key = None
+        files = {}
+        num_of_read_samples = 0
+
+        with tarfile.open(str(shard_fp), mode='r|') as tar:
+            for member in tar:
+
+                if member.isfile() is False:
+                    continue
+
+                key, file_type = member.name.rsplit('_', 1)
+
+                if key != current_key:
+
+                    if files:
+                        yield current_key, files
+                        num_of_read_samples += 1
+                        if num_of_read_samples >= num_of_samples:
+                            return
+                    
+                    current_key = key
+                    files = {}
+
+                files[file_type] = tar.extractfile(member).read()
+
+        if files:
+            yield current_key, files
+
+    def read_streamed_sample(self, files):
+
+        # Image
+        image = skimage.io.imread(io.BytesIO(files['color.png']))
+
+        # Mask
+        mask = skimage.io.imread(io.BytesIO(files['mask.png']), 0)[:,:,0].astype('float')
+        mask[mask == 255] = 0
+
+        # Other data
+        if 'meta+.bin' in files:
+            json_data = jt.parse_meta_binary(files['meta+.bin'])
+        else:
+            json_data = json.loads(files['meta+.json'])
+
+        return image, mask, json_data
+
+    def __iter__(self):
+
+        shards, num_of_samples, rng = self.get_worker_shards()
+
+        # Shuffle buffer with the (still encoded) files of the samples
+        buffer = []
+
+        for key, files in self.read_shards(shards, num_of_samples, rng):
+
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(files)
+                continue
+
+            # Once the buffer is full, output a random sample and replace it
+            if self.shuffle_buffer_size > 0:
+                j = rng.randrange(len(buffer))
+                files, buffer[j] = buffer[j], files
+
+            yield self.decode_sample(files)
+
+        # Emptying the buffer
+        rng.shuffle(buffer)
+        for files in buffer:
+            yield self.decode_sample(files)
+
+    def decode_sample(self, files):
+
+        image, mask, json_data = self.read_streamed_sample(files)
+        sample = self.create_dense_sample(image, mask, json_data)
+
+        # Applying preprocessing and converting to Torch dataformat convention
+        sample = self.process_sample(sample)
+
+        return sample
+
+    def get_batched_sample(self, sample_ids):
+
+        # Position of each sample in the order of the shards index
+        wanted_ids = set(int(x) for x in sample_ids)
+        samples = {}
+
+        # Only reading the shards that contain the samples (sequentially, up
+        # to the last wanted sample)
+        shard_start = 0
+        for shard_fp, num_of_samples in self.shards:
+
+            shard_wanted_ids = [x - shard_start for x in wanted_ids if shard_start <= x < shard_start + num_of_samples]
+
+            if shard_wanted_ids:
+                shard_samples = self.read_shard(shard_fp, max(shard_wanted_ids) + 1)
+                for i, (key, files) in enumerate(shard_samples):
+                    if i in shard_wanted_ids:
+                        samples[shard_start + i] = self.decode_sample(files)
+
+            shard_start += num_of_samples
+
+        samples = [samples[int(x)] for x in sample_ids]
+
+        # Stacking each key only once
+        batched_sample = {key: np.stack([x[key] for x in samples]) for key in samples[0].keys()}
 
         return batched_sample
 
+    def get_random_batched_sample(self, batch_size=1):
+
+        # Random samples of a single random shard (no shuffle buffer to fill)
+        shard_id = np.random.randint(len(self.shards))
+        shard_start = sum([x[1] for x in self.shards[:shard_id]])
+        num_of_samples = self.shards[shard_id][1]
+
+        sample_ids = shard_start + np.random.choice(np.arange(num_of_samples), size=min(batch_size, num_of_samples), replace=False)
+
+        return self.get_batched_sample(sample_ids)
+
+#-------------------------------------------------------------------------------
+# Compiled Dataset Functions
+
+def load_compiled_index(compiled_dir):
+
+    index_fp = pathlib.Path(compiled_dir) / COMPILED_INDEX_NAME
+
+    if index_fp.exists() is False:
+        raise RuntimeError(f'Compiled dataset index not found: {index_fp}')
+
+    index = jt.load_from_json(index_fp)
+
+    return index
+
+def open_compiled_arrays(compiled_dir, mode='r'):
+
+    # Each dense key is stored in its own memory-mapped array, [N,H,W(,C)]
+    compiled_arrays = {}
+    for key in COMPILED_KEYS:
+        compiled_arrays[key] = np.load(str(pathlib.Path(compiled_dir) / f'{key}.npy'), mmap_mode=mode)
+
+    return compiled_arrays
+
+#-------------------------------------------------------------------------------
+# Sharded Dataset Functions
+
+def load_shards_index(shards_dir):
+
+    index_fp = pathlib.Path(shards_dir) / SHARDS_INDEX_NAME
+
+    if index_fp.exists() is False:
+        raise RuntimeError(f'Shards index not found: {index_fp}')
+
+    index = jt.load_from_json(index_fp)
+
+    return index
+
+#-------------------------------------------------------------------------------
+# Ground Truth Aggregation Functions
+
+def create_agg_gt(batch, num_of_classes):
+    """
+    Args:
+        batch (dict): collated batch with the per-instance tables
+        num_of_classes (int): number of classes (including the background)
+    Objective:
+        Construct the aggregated ground truth with the same layout as
+        PoseRegressor.agg_hough_and_generate_RT (AggregationLayer, hough voting
+        and samplewise_get_RT), directly from the _meta+ values. The instance
+        masks are added on the device by lib.gtf.complete_agg_gt.
+    Output:
+        agg_gt (list): per class (without the background)
+            total_num_of_instances: int
+            sample_ids: [N]
+            instance_ids: [N] (the instance mask value minus one)
+            quaternion: [N, 4]
+            scales: [N, 3]
+            xy: [N, 2] projected center (x, y)
+            z: [N, 1] depth in mm
+            R: [N, 3, 3]
+            T: [N, 3]
+            RT: [N, 4, 4]
+    """
+
+    agg_gt = []
+
+    # Instances present in the mask
+    k = batch['instance_class_id'].shape[1]
+    valid = (torch.arange(k) < torch.unsqueeze(batch['num_of_instances'], dim=1)) & (batch['instance_num_of_pixels'] > 0)
+
+    for class_id in range(1, num_of_classes):
+
+        sample_ids, instance_ids = torch.nonzero(
+            valid & (batch['instance_class_id'] == class_id),
+            as_tuple=True
+        )
+
+        quaternion = batch['instance_quaternion'][sample_ids, instance_ids]
+        norm = quaternion.norm(dim=1, keepdim=True)
+        quaternion = quaternion / torch.where(norm > 0, norm, torch.ones_like(norm))
+
+        RT = batch['instance_RT'][sample_ids, instance_ids]
+
+        # RT = inverse([inv(R) | T]), as in samplewise_get_RT
+        class_data = {
+            'total_num_of_instances': int(sample_ids.shape[0]),
+            'sample_ids': sample_ids,
+            'instance_ids': instance_ids,
+            'quaternion': quaternion,
+            'scales': batch['instance_scales'][sample_ids, instance_ids],
+            'xy': batch['instance_center_2d'][sample_ids, instance_ids],
+            'z': torch.unsqueeze(torch.exp(batch['instance_z'][sample_ids, instance_ids]), dim=1),
+            'R': RT[:, :3, :3],
+            'T': torch.inverse(RT)[:, :3, 3],
+            'RT': RT
+        }
+
+        agg_gt.append(class_data)
+
+    return agg_gt
+
+#-------------------------------------------------------------------------------
+# Compact Transport Functions
+
+def quantize_sample(sample):
+
+    # The class mask fits into uint8
+    sample['mask'] = sample['mask'].astype(np.uint8)
+
+    # The dense fields into int16 fixed point
+    for key, scale in QUANTIZATION_SCALES.items():
+        if key not in sample:
+            continue
+        sample[key] = np.clip(np.round(sample[key] * scale), -32768, 32767).astype(np.int16)
+
+    return sample
+
+def dequantize_batch(batch):
+
+    # Only quantized batches are modified (run after moving to the device)
+    if batch['mask'].dtype == torch.uint8:
+        batch['mask'] = batch['mask'].long()
+
+    for key, scale in QUANTIZATION_SCALES.items():
+        if key in batch and batch[key].dtype == torch.int16:
+            batch[key] = batch[key].float() / scale
+
+    return batch
+
+def check_compact_transport(dataset, num_of_samples=10):
+    """
+    Args:
+        dataset (NOCSPoseRegDataset): dataset with compact=False
+        num_of_samples (int): number of samples to check
+    Objective:
+        Compare the dequantized compact samples with the float32 samples. The
+        error of each dense field must be within half a quantization step.
+    Output:
+        max_errors (dict): the maximum absolute error of each key
+    """
+
+    max_errors = {key: 0 for key in ['mask', *QUANTIZATION_SCALES.keys()]}
+
+    for i in range(min(num_of_samples, len(dataset))):
+
+        sample = dataset[i]
+        compact_sample = quantize_sample({k:v.copy() for k,v in sample.items()})
+
+        # Collating as the DataLoader does
+        batch = dequantize_batch(torch.utils.data.dataloader.default_collate([compact_sample]))
+
+        for key in max_errors.keys():
+            error = np.abs(batch[key][0].numpy().astype(np.float64) - sample[key].astype(np.float64)).max()
+            max_errors[key] = max(max_errors[key], error)
+
+    # Verifying the errors
+    if max_errors['mask'] != 0:
+        raise RuntimeError(f'Compact transport changed the mask')
+
+    for key, scale in QUANTIZATION_SCALES.items():
+        if max_errors[key] > 0.5 / scale + 1e-6:
+            raise RuntimeError(f'Compact transport error of {key} ({max_errors[key]}) exceeds the quantization step')
+
+    return max_errors
+
 #-------------------------------------------------------------------------------
 # Functions
 
@@ -1296,6 +2181,29 @@ def test_pose_nocs_dataset():
 
     return 0
 
+def test_compact_transport():
+
+    preprocessing_fn = smp.encoders.get_preprocessing_fn(ENCODER, ENCODER_WEIGHTS)
+
+    dataset = NOCSPoseRegDataset(
+        dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_VALID_DATASET")),
+        max_size=20,
+        classes=['bg','camera','laptop'],
+        preprocessing=transforms.pose.get_preprocessing(preprocessing_fn)
+    )
+
+    # Accuracy equivalence with the float32 samples
+    max_errors = check_compact_transport(dataset, num_of_samples=20)
+    print(f'Max absolute errors: {max_errors}')
+
+    # Size of the samples sent by the DataLoader workers
+    sample = dataset[0]
+    float_size = sum([v.nbytes for v in sample.values()])
+    compact_size = sum([v.nbytes for v in quantize_sample(sample).values()])
+    print(f'Sample size: {float_size/2**20:.2f} MB -> {compact_size/2**20:.2f} MB')
+
+    return 0
+
 #-------------------------------------------------------------------------------
 # Main Code
 
@@ -1310,4 +2218,5 @@ if __name__ == '__main__':
 
     # Pose Datsets
     test_pose_nocs_dataset()
+    #test_compact_transport()
 
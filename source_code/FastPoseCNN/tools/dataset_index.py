@@ -0,0 +1,427 @@
+import os
+import sys
+import time
+import json
+import random
+import hashlib
+import sqlite3
+import argparse
+import pathlib
+import concurrent.futures
+
+# Local Imports
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import json_tools as jt
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Dataset index
+
+Finding the samples of a dataset requires walking the entire directory tree and
+parsing every _meta+.json to remove the samples without instances of the
+selected classes. The dataset index performs this once and persists the result
+into a SQLite file of the index directory ($DATASET_INDEX_DIR), outside of the
+dataset tree (which can then be read-only or shared):
+
+    samples(position, color_image, mask_image, meta, meta_size, meta_mtime_ns,
+            num_of_instances, class_bitmask, class_counts)
+
+The position follows the exact order of the original directory walk, and the
+class_bitmask has the bit (1 << class_id) set for every class with instances
+in the sample. Class filtering, max_size subsetting and empty-sample removal
+are then simple queries. The class_counts ({class_id: number of instances},
+as json) are the per-sample statistics used for class-balanced sampling.
+
+The index also stores the modification time of every walked directory, and
+the size and modification time of every _meta+ file. If a directory changes
+(files added, removed or replaced) the index is considered stale and rebuilt.
+Only the directories are checked at startup (a few thousand stats, instead of
+one per sample on network storage), so a _meta+ file written in place (same
+directory entry) is only detected by a verified check:
+
+    python dataset_index.py --dataset_dir $NOCS_CAMERA_TRAIN_DATASET --verify
+
+The directory walk and the meta parsing can be spread across a process pool
+(one task per directory, e.g. per scene). To (re)build the index of a new
+dataset drop:
+
+    python dataset_index.py --dataset_dir $NOCS_CAMERA_TRAIN_DATASET --num_workers 16
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+INDEX_VERSION = 3
+
+# Index directory when DATASET_INDEX_DIR is not set
+DEFAULT_INDEX_DIR = pathlib.Path.home() / '.cache' / 'FastPoseCNN' / 'dataset_index'
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_index_path(dataset_dir, index_dir=None):
+
+    # The index directory defaults to the environment variable
+    if index_dir is None:
+        index_dir = os.getenv('DATASET_INDEX_DIR', str(DEFAULT_INDEX_DIR))
+
+    # One index per dataset directory (splits can share the same name)
+    dataset_dir = pathlib.Path(dataset_dir).resolve()
+    dataset_hash = hashlib.sha1(str(dataset_dir).encode()).hexdigest()[:12]
+
+    return pathlib.Path(index_dir) / f'{dataset_dir.name}-{dataset_hash}.sqlite'
+
+def is_inside_dataset(index_path, dataset_dir):
+    index_dir = pathlib.Path(index_path).resolve().parent
+    dataset_dir = pathlib.Path(dataset_dir).resolve()
+    return index_dir == dataset_dir or dataset_dir in index_dir.parents
+
+def stat_meta(meta):
+
+    # The file that jt.load_meta reads
+    return os.stat(jt.get_meta_path(meta))
+
+def scan_directory(dataset_dir, dir_path):
+    """
+    Args:
+        dataset_dir (pathlib object): The root of the dataset
+        dir_path (pathlib object): The directory to be scanned
+    Objective:
+        Collect the color images of a single directory (in listing order) with
+        the information of their _meta+.json, and its subdirectories.
+    Output:
+        samples (list): [(color_image, mask_image, meta, meta_size, meta_mtime_ns,
+            num_of_instances, class_bitmask, class_counts), ...] with paths
+            relative to dataset_dir
+        directories (list): the subdirectories (pathlib objects) in listing order
+        mtime_ns (int): the modification time of the directory
+    """
+
+    samples = []
+    directories = []
+
+    # Listing the directory only once
+    with os.scandir(dir_path) as it:
+        entries = list(it)
+
+    for entry in entries:
+
+        # Color images
+        if entry.is_file():
+
+            if entry.name.find('color') == -1 or pathlib.Path(entry.name).suffix != '.png':
+                continue
+
+            color_image = pathlib.Path(entry.path)
+            mask_image = pathlib.Path(entry.path.replace('_color.png', '_mask.png'))
+            meta = pathlib.Path(entry.path.replace('_color.png', '_meta+.json'))
+
+            # Fingerprint of the _meta+ (to detect in-place modifications)
+            meta_stat = stat_meta(meta)
+
+            # Obtain the instance data
+            instance_dict = jt.load_meta(meta)['instance_dict']
+
+            # Constructing the class presence bitmask and the instance counts
+            class_bitmask = 0
+            class_counts = {}
+            for class_value in instance_dict.values():
+                class_bitmask |= (1 << int(class_value))
+                class_counts[int(class_value)] = class_counts.get(int(class_value), 0) + 1
+
+            samples.append((
+                str(color_image.relative_to(dataset_dir)),
+                str(mask_image.relative_to(dataset_dir)),
+                str(meta.relative_to(dataset_dir)),
+                meta_stat.st_size,
+                meta_stat.st_mtime_ns,
+                len(instance_dict),
+                class_bitmask,
+                json.dumps(class_counts)
+            ))
+
+        # Subdirectories
+        elif entry.is_dir():
+            directories.append(pathlib.Path(entry.path))
+
+    mtime_ns = os.stat(dir_path).st_mtime_ns
+
+    return samples, directories, mtime_ns
+
+def walk_dataset(dataset_dir, num_workers=0):
+
+    all_samples = []
+    all_directories = []
+
+    # Same breadth-first order as NOCSPoseRegDataset.get_image_paths_in_dir,
+    # processed level by level: the directories of a level are scanned in
+    # parallel and their results are concatenated in the queue order
+    eval_paths = [dataset_dir]
+
+    executor = None
+    if num_workers > 0:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+
+    try:
+        while eval_paths:
+
+            # Small levels (e.g. the root) are not worth the inter-process overhead
+            if executor is None or len(eval_paths) == 1:
+                results = [scan_directory(dataset_dir, x) for x in eval_paths]
+            else:
+                results = executor.map(scan_directory, [dataset_dir] * len(eval_paths), eval_paths)
+
+            next_eval_paths = []
+
+            for eval_path, (samples, directories, mtime_ns) in zip(eval_paths, results):
+                all_samples += samples
+                all_directories.append((str(eval_path.relative_to(dataset_dir)), mtime_ns))
+                next_eval_paths += directories
+
+            eval_paths = next_eval_paths
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return all_samples, all_directories
+
+def write_index(index_path, dataset_dir, samples, directories):
+
+    index_path = pathlib.Path(index_path)
+
+    # The index would change the fingerprint of the directory that contains it
+    if is_inside_dataset(index_path, dataset_dir):
+        raise RuntimeError(f'The index {index_path} needs to be outside of the dataset {dataset_dir}')
+
+    if index_path.parent.exists() is False:
+        os.makedirs(str(index_path.parent))
+
+    # Writing into a temporary file first, then replacing the index atomically,
+    # so other processes never read a partial index
+    tmp_index_path = index_path.parent / f'{index_path.name}.{os.getpid()}.tmp'
+    if tmp_index_path.exists():
+        os.remove(str(tmp_index_path))
+
+    connection = sqlite3.connect(str(tmp_index_path))
+
+    with connection:
+        connection.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE directories (path TEXT PRIMARY KEY, mtime_ns INTEGER)')
+        connection.execute(
+            'CREATE TABLE samples (position INTEGER PRIMARY KEY, color_image TEXT, '
+            'mask_image TEXT, meta TEXT, meta_size INTEGER, meta_mtime_ns INTEGER, '
+            'num_of_instances INTEGER, class_bitmask INTEGER, class_counts TEXT)'
+        )
+
+        connection.executemany('INSERT INTO info VALUES (?, ?)', [
+            ('version', str(INDEX_VERSION)),
+            ('dataset_dir', str(pathlib.Path(dataset_dir).resolve()))
+        ])
+        connection.executemany('INSERT INTO directories VALUES (?, ?)', directories)
+        connection.executemany(
+            'INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(position, *sample) for position, sample in enumerate(samples)]
+        )
+
+    connection.close()
+
+    os.replace(str(tmp_index_path), str(index_path))
+
+def is_index_stale(index_path, dataset_dir, verify_files=False):
+    """
+    Args:
+        index_path (pathlib object): The index of the dataset
+        dataset_dir (pathlib object): The root of the dataset
+        verify_files (bool): also compare the size and modification time of
+            every _meta+ file (one stat per sample)
+    Output:
+        stale (bool): True if the index needs to be rebuilt
+    """
+
+    index_path = pathlib.Path(index_path)
+
+    if index_path.exists() is False:
+        return True
+
+    try:
+        connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        info = dict(connection.execute('SELECT key, value FROM info').fetchall())
+        directories = connection.execute('SELECT path, mtime_ns FROM directories').fetchall()
+        if verify_files:
+            metas = connection.execute('SELECT meta, meta_size, meta_mtime_ns FROM samples').fetchall()
+        else:
+            metas = []
+        connection.close()
+    except sqlite3.DatabaseError:
+        return True
+
+    # Index created by another version of this file (or of another dataset)
+    if info.get('version') != str(INDEX_VERSION) or info.get('dataset_dir') != str(pathlib.Path(dataset_dir).resolve()):
+        return True
+
+    # If any directory changed (or was removed), the index is stale
+    for path, mtime_ns in directories:
+        try:
+            if os.stat(pathlib.Path(dataset_dir) / path).st_mtime_ns != mtime_ns:
+                return True
+        except FileNotFoundError:
+            return True
+
+    # If any _meta+ was modified in place, the index is stale (verified only)
+    for meta, meta_size, meta_mtime_ns in metas:
+        try:
+            meta_stat = stat_meta(pathlib.Path(dataset_dir) / meta)
+        except FileNotFoundError:
+            return True
+        if meta_stat.st_size != meta_size or meta_stat.st_mtime_ns != meta_mtime_ns:
+            return True
+
+    return False
+
+def build_index(dataset_dir, index_path=None, num_workers=0):
+
+    dataset_dir = pathlib.Path(dataset_dir)
+
+    if index_path is None:
+        index_path = get_index_path(dataset_dir)
+
+    start_time = time.time()
+
+    samples, directories = walk_dataset(dataset_dir, num_workers=num_workers)
+    write_index(index_path, dataset_dir, samples, directories)
+
+    total_time = time.time() - start_time
+    print(f'Indexed {len(samples)} samples of {dataset_dir} in {total_time:.2f}s ({len(samples)/max(total_time, 1e-6):.2f} samples/s)')
+
+    return index_path
+
+def get_index(dataset_dir, index_path=None, rebuild=False, num_workers=0, build=True, verify_files=False):
+    """
+    Args:
+        dataset_dir (pathlib object): The root of the dataset
+        index_path (pathlib object): The index file (default: get_index_path)
+        rebuild (bool): rebuild the index even if up to date
+        num_workers (int): processes used to build the index
+        build (bool): if False, only check the index (e.g. on the non-zero
+            ranks while rank 0 builds it)
+        verify_files (bool): also check the _meta+ files (see is_index_stale)
+    Output:
+        index_path (pathlib object): The up-to-date index, or None if it could
+            not be (re)built
+    """
+
+    dataset_dir = pathlib.Path(dataset_dir)
+
+    if index_path is None:
+        index_path = get_index_path(dataset_dir)
+
+    # Only (re)building the index if needed
+    if rebuild or is_index_stale(index_path, dataset_dir, verify_files=verify_files):
+
+        if build is False:
+            return None
+
+        # e.g. a read-only index directory
+        try:
+            build_index(dataset_dir, index_path, num_workers=num_workers)
+        except (OSError, sqlite3.Error) as e:
+            print(f'Could not write the index {index_path} of {dataset_dir}: {e}')
+            return None
+
+    return index_path
+
+def query_samples(index_path, dataset_dir, class_ids=None, max_size=None, subset_seed=None):
+    """
+    Args:
+        index_path (pathlib object): The index of the dataset
+        dataset_dir (pathlib object): The root of the dataset
+        class_ids (list): Only samples with instances of these classes are kept,
+            if None, only the samples without instances are removed
+        max_size (int): maximum number of samples
+        subset_seed (int): if given, the max_size samples are a random subset
+            of the whole dataset (still in walk order) instead of the first ones
+    Output:
+        color_images (list): The color images in the directory walk order
+    """
+
+    # Bitmask of the wanted classes
+    if class_ids is None:
+        class_bitmask = -1
+    else:
+        class_bitmask = 0
+        for class_id in class_ids:
+            class_bitmask |= (1 << int(class_id))
+
+    query = 'SELECT color_image FROM samples WHERE (class_bitmask & ?) != 0 ORDER BY position'
+    parameters = [class_bitmask]
+
+    if max_size != None and subset_seed is None:
+        query += ' LIMIT ?'
+        parameters.append(int(max_size))
+
+    connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+    rows = connection.execute(query, parameters).fetchall()
+    connection.close()
+
+    # Random subset (without the bias of the directory order)
+    if max_size != None and subset_seed is not None and max_size < len(rows):
+        kept = sorted(random.Random(subset_seed).sample(range(len(rows)), int(max_size)))
+        rows = [rows[i] for i in kept]
+
+    color_images = [pathlib.Path(dataset_dir) / row[0] for row in rows]
+
+    return color_images
+
+def query_class_counts(index_path, dataset_dir, color_images):
+    """
+    Args:
+        index_path (pathlib object): The index of the dataset
+        dataset_dir (pathlib object): The root of the dataset
+        color_images (list): The color images of the samples
+    Output:
+        class_counts (list): {class_id: number of instances} of each sample
+    """
+
+    connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+    rows = connection.execute('SELECT color_image, class_counts FROM samples').fetchall()
+    connection.close()
+
+    all_class_counts = {color_image: class_counts for color_image, class_counts in rows}
+
+    class_counts = []
+    for color_image in color_images:
+        relative_path = str(pathlib.Path(color_image).relative_to(dataset_dir))
+        class_counts.append({int(k):v for k,v in json.loads(all_class_counts[relative_path]).items()})
+
+    return class_counts
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build the persistent index of a NOCS split')
+    parser.add_argument('--dataset_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--index_path', type=pathlib.Path, default=None) # (default: in $DATASET_INDEX_DIR)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--verify', action='store_true', help='only rebuild if stale, checking every _meta+ file')
+    args = parser.parse_args()
+
+    # Checking the index (including the _meta+ files modified in place)
+    if args.verify:
+        get_index(
+            args.dataset_dir,
+            args.index_path,
+            num_workers=args.num_workers,
+            verify_files=True
+        )
+    else:
+        build_index(
+            args.dataset_dir,
+            args.index_path,
+            num_workers=args.num_workers
+        )
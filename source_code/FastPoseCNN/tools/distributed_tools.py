@@ -0,0 +1,24 @@
+import torch
+import torch.distributed
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Distributed tools
+
+Helpers on the DDP process group, kept apart from dataset.py so that the
+modules that only need them (running_metrics, sampler, ...) do not import the
+datasets (and their image and augmentation libraries).
+"""
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_distributed_info():
+
+    # Rank and world size of this process (single process if not distributed)
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    else:
+        return 0, 1
@@ -7,8 +7,6 @@ import numpy as np
 import cv2
 from pyquaternion import Quaternion
 
-import matplotlib.pyplot as plt
-
 import scipy.spatial.transform
 import scipy.spatial
 
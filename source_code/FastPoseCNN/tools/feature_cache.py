@@ -0,0 +1,291 @@
+import os
+import sys
+import time
+import copy
+import hashlib
+import pathlib
+
+import tqdm
+import numpy as np
+import torch
+import torch.distributed
+import torch.utils.data
+
+# Local Imports
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import json_tools as jt
+import dataset as ds
+import distributed_tools as dt
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Encoder feature cache
+
+With a frozen encoder (HPARAM.FREEZE_ENCODER) and no augmentation, the encoder
+features of a sample are the same every epoch, but PoseRegressor.forward still
+recomputes them. The feature cache computes them once per split and stores the
+levels used by the FPN decoders (the last 4) into memory-mapped arrays, one per
+level ([N,C,h,w], float16 by default to halve the size):
+
+    <cache_dir>/encoder_feature_0.npy ... encoder_feature_3.npy
+    <cache_dir>/meta.json
+
+The dataset then returns the cached features with each sample (the
+'encoder_feature_*' keys) and the PoseRegressor only runs the decoders and
+heads (PoseRegressor.forward(..., features=...)).
+
+The meta.json identifies the encoder (name and a fingerprint of its weights),
+the samples and the dtype. Any mismatch rebuilds the cache, so a cache is never
+used with other weights. The meta.json is written last and marks the cache as
+complete. Under DDP, every process computes its share of the samples and writes
+it in place.
+
+The features are computed with the encoder in eval mode, as a frozen
+encoder should be used (its batchnorm statistics are not updated). The size
+per sample at 480x640 is about 4.6MB (resnet18) and 18MB (resnext50_32x4d) in
+float16.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+FEATURE_CACHE_VERSION = 1
+FEATURE_CACHE_META_NAME = 'meta.json'
+
+# Number of encoder levels used by the FPN decoders (the deepest ones)
+NUM_OF_FEATURE_LEVELS = 4
+FEATURE_KEYS = [f'encoder_feature_{i}' for i in range(NUM_OF_FEATURE_LEVELS)]
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def get_encoder_fingerprint(encoder):
+
+    # Hash of the names and values of the weights (and buffers) of the encoder
+    sha1 = hashlib.sha1()
+    for name, value in sorted(encoder.state_dict().items()):
+        sha1.update(name.encode())
+        sha1.update(value.detach().cpu().contiguous().numpy().tobytes())
+
+    return sha1.hexdigest()
+
+def get_dataset_fingerprint(dataset):
+
+    # Hash of the ordered samples of the dataset
+    sha1 = hashlib.sha1()
+    for image_fp in dataset.images_fps:
+        sha1.update(str(image_fp).encode())
+
+    return sha1.hexdigest()
+
+def distributed_barrier():
+
+    _, world_size = dt.get_distributed_info()
+    if world_size > 1:
+        torch.distributed.barrier()
+
+def get_batch_features(batch):
+    """
+    Args:
+        batch (dict): batch (on the device), possibly with the cached features
+    Output:
+        features (list or None): the cached encoder features in float32, or None
+            if the batch does not have them
+    """
+
+    if FEATURE_KEYS[0] not in batch:
+        return None
+
+    return [batch[key].float() for key in FEATURE_KEYS]
+
+def build_feature_cache(
+    dataset,
+    encoder,
+    cache_dir,
+    encoder_name=None,
+    dtype='float16',
+    batch_size=8,
+    num_workers=0,
+    device=None
+    ):
+    """
+    Args:
+        dataset (NOCSPoseRegDataset): the (non-augmented) dataset to cache
+        encoder (torch.nn.Module): the frozen encoder of the PoseRegressor
+        cache_dir (pathlib.Path): directory of the cache of this split
+        encoder_name (str): name of the encoder (stored in the meta data)
+        dtype (str): 'float16' or 'float32'
+        batch_size (int): batch size of the encoder
+        num_workers (int): number of workers loading the images
+        device (torch.device): device of the encoder (default: cuda if available)
+    Output:
+        feature_cache (FeatureCache): the complete cache
+    Objective:
+        Compute and store the encoder features of all the samples, unless a
+        cache with the same encoder, samples and dtype already exists. Under
+        DDP, every process has to call this function.
+    """
+
+    cache_dir = pathlib.Path(cache_dir)
+    meta_fp = cache_dir / FEATURE_CACHE_META_NAME
+    rank, world_size = dt.get_distributed_info()
+
+    if device is None:
+        device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+
+    # A copy of the encoder, so the model (device, mode) is not modified
+    encoder = copy.deepcopy(encoder).to(device).eval()
+
+    expected_meta = {
+        'version': FEATURE_CACHE_VERSION,
+        'encoder_name': encoder_name,
+        'encoder_fingerprint': get_encoder_fingerprint(encoder),
+        'dataset_fingerprint': get_dataset_fingerprint(dataset),
+        'num_samples': len(dataset),
+        'dtype': str(np.dtype(dtype))
+    }
+
+    # Reusing the cache if it matches (all the processes check before any removal)
+    if meta_fp.exists():
+        meta = jt.load_from_json(meta_fp)
+        is_valid = all([meta.get(key) == value for key, value in expected_meta.items()])
+    else:
+        is_valid = False
+
+    distributed_barrier()
+
+    if is_valid:
+        return FeatureCache(cache_dir)
+
+    # Determining the shapes of the features with the first sample
+    with torch.no_grad():
+        image = torch.as_tensor(dataset[0]['image']).unsqueeze(0).to(device)
+        shapes = [tuple(x.shape[1:]) for x in encoder(image)[-NUM_OF_FEATURE_LEVELS:]]
+
+    # Removing the previous meta data (incomplete cache) and allocating the arrays
+    if rank == 0:
+
+        if cache_dir.exists() is False:
+            os.makedirs(str(cache_dir))
+
+        if meta_fp.exists():
+            os.remove(str(meta_fp))
+
+        for key, shape in zip(FEATURE_KEYS, shapes):
+            feature_array = np.lib.format.open_memmap(
+                str(cache_dir / f'{key}.npy'),
+                mode='w+',
+                dtype=np.dtype(dtype),
+                shape=(len(dataset), *shape)
+            )
+            del feature_array
+
+    distributed_barrier()
+
+    # Each process writes its share of the samples in place
+    feature_arrays = open_feature_arrays(cache_dir, mode='r+')
+    sample_ids = list(range(rank, len(dataset), world_size))
+
+    loader = torch.utils.data.DataLoader(
+        EncoderInputDataset(dataset, sample_ids),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available()
+    )
+
+    start_time = time.time()
+
+    with torch.no_grad():
+        for ids, images in tqdm.tqdm(loader, disable=rank != 0, bar_format='{l_bar}{bar:40}{r_bar}{bar:-10b}'):
+
+            features = encoder(images.to(device, non_blocking=True))[-NUM_OF_FEATURE_LEVELS:]
+
+            for key, feature in zip(FEATURE_KEYS, features):
+                feature_arrays[key][ids.numpy()] = feature.cpu().numpy().astype(dtype)
+
+    # Making sure the data reaches the disk
+    for feature_array in feature_arrays.values():
+        feature_array.flush()
+    del feature_arrays
+
+    distributed_barrier()
+
+    # Finally writing the meta data, which marks the cache as complete
+    if rank == 0:
+
+        meta = {
+            **expected_meta,
+            'keys': FEATURE_KEYS,
+            'shapes': [list(x) for x in shapes]
+        }
+        jt.save_to_json(meta_fp, meta)
+
+        total_time = time.time() - start_time
+        size_bytes = sum([(cache_dir / f'{key}.npy').stat().st_size for key in FEATURE_KEYS])
+        print(f'Cached the encoder features of {len(dataset)} samples in {total_time:.2f}s ({size_bytes/2**30:.2f}GB)')
+
+    distributed_barrier()
+
+    return FeatureCache(cache_dir)
+
+def open_feature_arrays(cache_dir, mode='r'):
+
+    # Each feature level is stored in its own memory-mapped array, [N,C,h,w]
+    feature_arrays = {}
+    for key in FEATURE_KEYS:
+        feature_arrays[key] = np.load(str(pathlib.Path(cache_dir) / f'{key}.npy'), mmap_mode=mode)
+
+    return feature_arrays
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class EncoderInputDataset(torch.utils.data.Dataset):
+
+    def __init__(self, dataset, sample_ids):
+
+        # Saving parameters
+        self.dataset = dataset
+        self.sample_ids = sample_ids
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def __getitem__(self, idx):
+
+        # Only the (preprocessed) image is given to the encoder
+        i = self.sample_ids[idx]
+        return i, self.dataset[i]['image']
+
+class FeatureCache():
+
+    def __init__(self, cache_dir):
+
+        # Saving parameters
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.meta = jt.load_from_json(self.cache_dir / FEATURE_CACHE_META_NAME)
+
+        # The memory-mapped arrays are opened lazily (once per worker)
+        self.feature_arrays = None
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getstate__(self):
+
+        # The memory maps are not sent to the (spawned) workers
+        state = self.__dict__.copy()
+        state['feature_arrays'] = None
+        return state
+
+    def __getitem__(self, i):
+
+        # Opening the memory-mapped arrays, if not done already in this process
+        if self.feature_arrays is None:
+            self.feature_arrays = open_feature_arrays(self.cache_dir)
+
+        # Copying the features out of the memory-mapped arrays
+        return {key: np.array(feature_array[i]) for key, feature_array in self.feature_arrays.items()}
@@ -0,0 +1,165 @@
+import os
+import sys
+import logging
+import pathlib
+import threading
+import multiprocessing
+import concurrent.futures
+
+import torch
+
+# Local Imports
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Asynchronous figure rendering
+
+Rendering the summary images of the callbacks (visualize.compare_*) on rank
+zero delays the end of the epoch, while the other DDP processes wait. The
+AsyncFigureRenderer hands the (CPU) data of each figure to a pool of rendering
+processes, which create the image grid with the given visualize function and
+write it into the TensorBoard log directory with their own SummaryWriter
+(TensorBoard merges the event files of a directory).
+
+The number of pending figures is bounded: when the renderers fall behind, new
+figures are dropped (and counted) instead of blocking the training. The
+counts of rendered, dropped and failed figures are logged at the end of each
+epoch by the callback (see get_stats).
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# SummaryWriters of a rendering process (one per log directory)
+WORKER_WRITERS = {}
+
+LOGGER = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def to_cpu(data):
+
+    # Moving all the tensors of a (nested) structure to the CPU, so they can be
+    # sent to the rendering processes
+    if isinstance(data, torch.Tensor):
+        return data.detach().cpu()
+    elif isinstance(data, dict):
+        return {k: to_cpu(v) for k,v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)([to_cpu(x) for x in data])
+    else:
+        return data
+
+def init_worker():
+    torch.set_num_threads(1)
+
+def render_figure(log_dir, tag, global_step, function_name, args, kwargs):
+
+    import torch.utils.tensorboard
+    import visualize as vz
+
+    # Creating the image grid (HxWx3, np.uint8)
+    summary_image = getattr(vz, function_name)(*args, **kwargs)
+
+    # Writing it into the log directory
+    if log_dir not in WORKER_WRITERS.keys():
+        WORKER_WRITERS[log_dir] = torch.utils.tensorboard.SummaryWriter(log_dir=log_dir)
+    writer = WORKER_WRITERS[log_dir]
+
+    writer.add_image(tag, summary_image, global_step, dataformats='HWC')
+    writer.flush()
+
+    return tag
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class AsyncFigureRenderer():
+
+    def __init__(self, num_workers=1, max_pending=8):
+
+        # Saving parameters
+        self.max_pending = max_pending
+
+        # Spawned processes (the training process uses CUDA)
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker
+        )
+
+        self.lock = threading.Lock()
+        self.num_pending = 0
+        self.num_rendered = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+
+    def submit(self, log_dir, tag, global_step, function_name, *args, **kwargs):
+        """
+        Args:
+            log_dir (str): The log directory of the SummaryWriter
+            tag (str): The tag of the figure
+            global_step (int): The step of the figure
+            function_name (str): The visualize function creating the figure
+            *args, **kwargs: The arguments of the visualize function
+        Output:
+            submitted (bool): False if the figure was dropped
+        """
+
+        # Dropping the figure if the renderers are behind
+        with self.lock:
+            if self.num_pending >= self.max_pending:
+                self.num_dropped += 1
+                return False
+            self.num_pending += 1
+
+        future = self.executor.submit(
+            render_figure,
+            str(log_dir),
+            tag,
+            global_step,
+            function_name,
+            to_cpu(args),
+            to_cpu(kwargs)
+        )
+        future.add_done_callback(self.on_done)
+
+        return True
+
+    def on_done(self, future):
+
+        with self.lock:
+            self.num_pending -= 1
+
+            if future.exception() is None:
+                self.num_rendered += 1
+            else:
+                self.num_failed += 1
+                LOGGER.warning(f'figure rendering error: {future.exception()}')
+
+    def get_stats(self):
+
+        with self.lock:
+            return {
+                'pending': self.num_pending,
+                'rendered': self.num_rendered,
+                'dropped': self.num_dropped,
+                'failed': self.num_failed
+            }
+
+    def reset_stats(self):
+
+        # The pending figures are still in flight
+        with self.lock:
+            self.num_rendered = 0
+            self.num_dropped = 0
+            self.num_failed = 0
+
+    def close(self, wait=True):
+
+        # Waiting for the pending figures (e.g. at the end of the training)
+        self.executor.shutdown(wait=wait)
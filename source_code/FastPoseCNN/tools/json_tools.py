@@ -1,10 +1,24 @@
+import os
 import json
+import struct
+import argparse
+import pathlib
+import concurrent.futures
 
 import numpy as np
 
 #-------------------------------------------------------------------------------
 # JSON Constants
 
+# Binary _meta+ format (little-endian):
+#   header (int32): version, num_of_instances, num_of_RTs, num_of_quaternions, num_of_scales, num_of_norm_factors
+#   instance ids (int32), class ids (int32), in the order of the instance_dict
+#   RTs (float64, 4x4), quaternions (float64, 4), scales (float64, 3), norm_factors (float64)
+META_JSON_SUFFIX = '_meta+.json'
+META_BINARY_SUFFIX = '_meta+.bin'
+META_BINARY_VERSION = 1
+META_BINARY_HEADER_SIZE = 6
+
 #-------------------------------------------------------------------------------
 # Classes
 
@@ -72,7 +86,210 @@ def load_from_json(file_path):
 
     return data
 
+def save_meta_to_binary(file_path, data):
 
+    """
+    Saving the _meta+ data (instance_dict, RTs, quaternions, scales, norm_factors)
+    into the compact binary format.
+    Input:
+        file_path: (the destination file)
+        data: the _meta+ data
+    Output:
+        None
+    """
 
-    
+    # catching possible pathlib.Path object
+    if isinstance(file_path, str) is False:
+        file_path = str(file_path)
+
+    # checking if file_path is a binary meta file
+    assert file_path.endswith('.bin'), 'Given file_path is invalid for saving into binary meta file'
+
+    # Instance and class ids, in the order of the instance_dict
+    instance_ids = np.array([int(x) for x in data['instance_dict'].keys()], dtype='<i4')
+    class_ids = np.array([int(x) for x in data['instance_dict'].values()], dtype='<i4')
+
+    # Instance parameters (float64, like the floats of the json)
+    RTs = np.asarray(data['RTs'], dtype='<f8').reshape((-1, 16))
+    quaternions = np.asarray(data['quaternions'], dtype='<f8').reshape((-1, 4))
+    scales = np.asarray(data['scales'], dtype='<f8').reshape((-1, 3))
+    norm_factors = np.asarray(data['norm_factors'], dtype='<f8').reshape((-1,))
+
+    header = np.array([
+        META_BINARY_VERSION,
+        len(instance_ids),
+        len(RTs),
+        len(quaternions),
+        len(scales),
+        len(norm_factors)
+    ], dtype='<i4')
+
+    # Writing into a temporary file first, then replacing the file atomically,
+    # so a failed write never leaves a partial (or outdated) binary behind
+    tmp_file_path = f'{file_path}.{os.getpid()}.tmp'
+
+    try:
+        with open(tmp_file_path, 'wb') as outfile:
+            for array in [header, instance_ids, class_ids, RTs, quaternions, scales, norm_factors]:
+                outfile.write(array.tobytes())
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+
+def load_meta_from_binary(file_path):
+
+    """
+    Loading the _meta+ data from the compact binary format.
+    Input:
+        file_path: (the source file)
+    Output:
+        data: the loaded data, with the same keys as the _meta+.json (the
+            instance parameters are numpy arrays instead of lists)
+    """
+
+    # catching possible pathlib.Path object
+    if isinstance(file_path, str) is False:
+        file_path = str(file_path)
+
+    with open(file_path, 'rb') as infile:
+        buffer = infile.read()
+
+    return parse_meta_binary(buffer)
+
+def parse_meta_binary(buffer):
+
+    """
+    Parsing the _meta+ data from the bytes of the compact binary format.
+    Input:
+        buffer: (the bytes of the file)
+    Output:
+        data: the loaded data
+    """
+
+    header = struct.unpack_from(f'<{META_BINARY_HEADER_SIZE}i', buffer, 0)
+
+    if header[0] != META_BINARY_VERSION:
+        raise RuntimeError(f'Unsupported binary meta version {header[0]}')
+
+    num_of_instances, num_of_RTs, num_of_quaternions, num_of_scales, num_of_norm_factors = header[1:]
+    offset = 4 * META_BINARY_HEADER_SIZE
+
+    # Instance and class ids
+    ids = struct.unpack_from(f'<{2*num_of_instances}i', buffer, offset)
+    offset += 8 * num_of_instances
+
+    # Instance parameters (views of a single float64 array, copied out of the
+    # read-only bytes so that they are writable like the json lists)
+    values = np.frombuffer(buffer, dtype='<f8', offset=offset).copy()
+    parameters = {}
+    start = 0
+    for key, num, shape, size in [
+        ('RTs', num_of_RTs, (4, 4), 16),
+        ('quaternions', num_of_quaternions, (4,), 4),
+        ('scales', num_of_scales, (3,), 3),
+        ('norm_factors', num_of_norm_factors, (), 1)
+        ]:
+        parameters[key] = values[start:start+num*size].reshape((num, *shape))
+        start += num * size
+
+    data = {
+        'instance_dict': {str(x):y for x, y in zip(ids[:num_of_instances], ids[num_of_instances:])},
+        **parameters
+    }
+
+    return data
+
+def get_meta_path(file_path):
+
+    """
+    Selecting the _meta+ file of a sample: the binary format if available and
+    not older than the json (a json edited or regenerated after the
+    conversion is used instead of the outdated binary).
+    Input:
+        file_path: (the _meta+.json or _meta+.bin file)
+    Output:
+        meta_file_path: the file to load
+    """
+
+    # catching possible pathlib.Path object
+    if isinstance(file_path, str) is False:
+        file_path = str(file_path)
+
+    binary_file_path = file_path.replace(META_JSON_SUFFIX, META_BINARY_SUFFIX)
+    json_file_path = file_path.replace(META_BINARY_SUFFIX, META_JSON_SUFFIX)
+
+    try:
+        binary_mtime = os.stat(binary_file_path).st_mtime_ns
+    except FileNotFoundError:
+        return json_file_path
+
+    try:
+        json_mtime = os.stat(json_file_path).st_mtime_ns
+    except FileNotFoundError:
+        return binary_file_path
+
+    return binary_file_path if binary_mtime >= json_mtime else json_file_path
+
+def load_meta(file_path):
+
+    """
+    Loading the _meta+ data of a sample, using the binary format if available
+    (and up to date, see get_meta_path) and falling back to the json otherwise.
+    Input:
+        file_path: (the _meta+.json or _meta+.bin file)
+    Output:
+        data: the loaded data
+    """
+
+    meta_file_path = get_meta_path(file_path)
+
+    if meta_file_path.endswith(META_BINARY_SUFFIX):
+        return load_meta_from_binary(meta_file_path)
+    else:
+        return load_from_json(meta_file_path)
+
+def convert_meta_json_to_binary(json_file_path):
+
+    # catching possible pathlib.Path object
+    if isinstance(json_file_path, str) is False:
+        json_file_path = str(json_file_path)
+
+    data = load_from_json(json_file_path)
+    save_meta_to_binary(json_file_path.replace(META_JSON_SUFFIX, META_BINARY_SUFFIX), data)
+
+def convert_dataset_meta_to_binary(dataset_dir, num_workers=0):
+
+    """
+    Converting all the _meta+.json of a dataset into the binary format (the
+    json files are kept).
+    Input:
+        dataset_dir: (the root of the dataset)
+        num_workers: number of processes
+    Output:
+        num_of_files: number of converted files
+    """
+
+    json_file_paths = sorted(pathlib.Path(dataset_dir).rglob(f'*{META_JSON_SUFFIX}'))
+
+    if num_workers == 0:
+        for json_file_path in json_file_paths:
+            convert_meta_json_to_binary(json_file_path)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(convert_meta_json_to_binary, json_file_paths, chunksize=256))
+
+    return len(json_file_paths)
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert the _meta+.json of a dataset into the binary format')
+    parser.add_argument('--dataset_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
 
+    num_of_files = convert_dataset_meta_to_binary(args.dataset_dir, args.num_workers)
+    print(f'Converted {num_of_files} _meta+.json files')
@@ -0,0 +1,225 @@
+import time
+import queue
+import threading
+
+import numpy as np
+import torch
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Batch prefetcher
+
+Without prefetching, the next batch is only requested (and copied to the
+device) once the training step is done, so the loading and the host to device
+copy are serialized with the forward pass. The BatchPrefetcher wraps a loader
+and keeps the next N batches ready: a background thread iterates the loader
+and, when a CUDA device is available, copies each batch on a side stream with
+non_blocking transfers (pinned memory is needed for the copy to be truly
+asynchronous). The training stream only waits for the copy of the batch it
+uses.
+
+On CPU-only runs, the thread simply keeps a queue of the next batches.
+
+The time the training loop spends waiting for a batch (stall) and the number
+of batches ready when a batch is requested (depth) are recorded, a prefetch
+depth close to N with no stall means the loading is fully hidden.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Interval (seconds) at which a blocked producer checks if it should stop
+STOP_CHECK_INTERVAL = 0.1
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def move_to_device(data, device):
+
+    # Moving all the tensors of a (nested) batch
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=True)
+    elif isinstance(data, dict):
+        return {k: move_to_device(v, device) for k,v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return type(data)([move_to_device(x, device) for x in data])
+    else:
+        return data
+
+def record_stream(data, stream):
+
+    # Marking the tensors as used by the stream, so their memory (allocated on
+    # the side stream) is not reused before the stream is done with them
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            record_stream(v, stream)
+    elif isinstance(data, (list, tuple)):
+        for x in data:
+            record_stream(x, stream)
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class BatchPrefetcher():
+
+    def __init__(self, loader, depth=2, device=None):
+
+        # Saving parameters
+        self.loader = loader
+        self.depth = depth
+        self.device = device
+
+        self.epoch = 0
+        self.thread = None
+        self.stop_event = None
+
+        # Per-batch stall (seconds) and number of batches ready
+        self.stall_times = []
+        self.depths = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def get_device(self):
+
+        # Copying to the device used by this process (resolved when iterating,
+        # e.g. after the DDP process group has selected it)
+        if self.device is not None:
+            return torch.device(self.device)
+        elif torch.cuda.is_available():
+            return torch.device('cuda', torch.cuda.current_device())
+        else:
+            return torch.device('cpu')
+
+    def producer(self, batch_queue, stop_event, device):
+
+        # Side stream for the host to device copies
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+            stream = torch.cuda.Stream(device)
+        else:
+            stream = None
+
+        def put(item):
+            while stop_event.is_set() is False:
+                try:
+                    batch_queue.put(item, timeout=STOP_CHECK_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            if stream is None:
+                for batch in self.loader:
+                    if put((batch, None, None)) is False:
+                        return
+
+            else:
+                # The loader also records its events on the side stream, so it
+                # only reuses its memory once the copy is done
+                with torch.cuda.stream(stream):
+                    for batch in self.loader:
+                        batch = move_to_device(batch, device)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                        if put((batch, event, None)) is False:
+                            return
+
+        except Exception as error:
+            put((None, None, error))
+            return
+
+        # End of the epoch
+        put(None)
+
+    def stop(self):
+
+        # Stopping the producer of an interrupted epoch
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def __iter__(self):
+
+        self.stop()
+
+        # Reshuffling the distributed sampler (if any) every epoch
+        sampler = getattr(self.loader, 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(self.epoch)
+        self.epoch += 1
+
+        device = self.get_device()
+        batch_queue = queue.Queue(maxsize=self.depth)
+        self.stop_event = threading.Event()
+
+        self.thread = threading.Thread(
+            target=self.producer,
+            args=(batch_queue, self.stop_event, device),
+            daemon=True
+        )
+        self.thread.start()
+
+        while True:
+
+            start_time = time.perf_counter()
+            depth = batch_queue.qsize()
+            item = batch_queue.get()
+            stall_time = time.perf_counter() - start_time
+
+            if item is None:
+                break
+
+            batch, event, error = item
+
+            if error is not None:
+                self.stop()
+                raise error
+
+            # The training stream waits for the copy of this batch only
+            if event is not None:
+                current_stream = torch.cuda.current_stream(device)
+                current_stream.wait_event(event)
+                record_stream(batch, current_stream)
+
+            self.stall_times.append(stall_time)
+            self.depths.append(depth)
+
+            yield batch
+
+        self.thread.join()
+        self.thread = None
+
+    def get_stats(self):
+
+        stats = {}
+
+        if self.stall_times:
+            stall_times = np.array(self.stall_times) * 1000
+            stats.update({
+                'prefetch_depth_mean': float(np.mean(self.depths)),
+                'prefetch_stall_mean_ms': float(np.mean(stall_times)),
+                'prefetch_stall_max_ms': float(np.max(stall_times)),
+                'prefetch_stall_total_s': float(np.sum(stall_times) / 1000)
+            })
+
+        # Including the statistics of the wrapped loader
+        if hasattr(self.loader, 'get_stats'):
+            stats.update(self.loader.get_stats())
+
+        return stats
+
+    def reset_stats(self):
+
+        self.stall_times = []
+        self.depths = []
+
+        if hasattr(self.loader, 'reset_stats'):
+            self.loader.reset_stats()
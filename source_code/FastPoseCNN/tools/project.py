@@ -2,8 +2,6 @@ import os
 import sys
 import pathlib
 
-import matplotlib.cm
-
 from easydict import EasyDict
 
 import numpy as np
@@ -46,10 +44,34 @@ cfg.CARVANA_DATASET = cfg.DATASET_DIR / 'CARVANA'
 
 constants = EasyDict()
 
+# Segments (x, y0, y1) of matplotlib's 'hsv' colormap, to reproduce its class
+# colors without importing matplotlib
+HSV_SEGMENTS = {
+    'red': ((0.0, 1.0, 1.0), (0.15873, 1.0, 1.0), (0.174603, 0.96875, 0.96875), (0.333333, 0.03125, 0.03125),
+        (0.349206, 0.0, 0.0), (0.666667, 0.0, 0.0), (0.68254, 0.03125, 0.03125), (0.84127, 0.96875, 0.96875),
+        (0.857143, 1.0, 1.0), (1.0, 1.0, 1.0)),
+    'green': ((0.0, 0.0, 0.0), (0.15873, 0.9375, 0.9375), (0.174603, 1.0, 1.0), (0.507937, 1.0, 1.0),
+        (0.666667, 0.0625, 0.0625), (0.68254, 0.0, 0.0), (1.0, 0.0, 0.0)),
+    'blue': ((0.0, 0.0, 0.0), (0.333333, 0.0, 0.0), (0.349206, 0.0625, 0.0625), (0.507937, 1.0, 1.0),
+        (0.84127, 1.0, 1.0), (0.857143, 0.9375, 0.9375), (1.0, 0.09375, 0.09375))
+}
+
 #-------------------------------------------------------------------------------
 # Functions regarding the constants
 
-def generate_colormap(num_classes, cmap=matplotlib.cm.get_cmap('hsv'), bg_index=0):
+def hsv_cmap(fraction, lut_size=256):
+
+    # Same lookup as matplotlib.cm.get_cmap('hsv'): the segments are sampled
+    # into a table of lut_size colors, indexed by int(fraction * lut_size)
+    index = min(max(int(fraction * lut_size), 0), lut_size - 1)
+    x = index / (lut_size - 1)
+
+    return tuple(
+        np.interp(x, [y[0] for y in HSV_SEGMENTS[channel]], [y[1] for y in HSV_SEGMENTS[channel]])
+        for channel in ['red', 'green', 'blue']
+    )
+
+def generate_colormap(num_classes, cmap=hsv_cmap, bg_index=0):
 
     colormap = np.zeros((num_classes, 3))
 
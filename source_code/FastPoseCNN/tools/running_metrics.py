@@ -0,0 +1,231 @@
+import math
+
+import torch
+import torch.distributed
+
+# Local Imports
+import distributed_tools as dt
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Streaming metric accumulators
+
+Keeping every per-batch loss and metric tensor until the end of the epoch
+grows the memory with the epoch, and averaging them one by one (NaN check,
+copy to a single device) forces a host synchronization per element.
+
+The RunningMetrics keeps, per metric name, a small state tensor on the device
+of the values (count, NaN count, sum, min, max and, optionally, the Welford
+mean and M2 for the variance). Each update only queues a few device operations
+(no synchronization). At the end of the epoch, compute() merges the states of
+all the DDP processes with a single all_gather and copies the result to the
+host once. The metric names of the processes are gathered as padded byte
+tensors (torch.distributed.all_gather_object needs torch >= 1.8).
+
+NaN values (e.g. a loss without instances) are counted but excluded from the
+statistics, a metric that was always NaN has a NaN mean.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Layout of the state tensor of a metric
+STATE_NAMES = ['count', 'nan_count', 'sum', 'min', 'max', 'mean', 'm2']
+COUNT, NAN_COUNT, SUM, MIN, MAX, MEAN, M2 = range(len(STATE_NAMES))
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def empty_state(device):
+
+    state = torch.zeros((len(STATE_NAMES),), dtype=torch.float64, device=device)
+    state[MIN] = math.inf
+    state[MAX] = -math.inf
+
+    return state
+
+def merge_states(states):
+    """
+    Args:
+        states (torch.Tensor): [N, M, S] states of M metrics from N processes
+    Output:
+        merged_states (torch.Tensor): [M, S] states of the M metrics
+    """
+
+    count = states[:,:,COUNT]
+    total_count = count.sum(dim=0)
+    safe_total_count = torch.clamp(total_count, min=1)
+
+    merged_states = torch.zeros_like(states[0])
+    merged_states[:,COUNT] = total_count
+    merged_states[:,NAN_COUNT] = states[:,:,NAN_COUNT].sum(dim=0)
+    merged_states[:,SUM] = states[:,:,SUM].sum(dim=0)
+    merged_states[:,MIN] = states[:,:,MIN].min(dim=0)[0]
+    merged_states[:,MAX] = states[:,:,MAX].max(dim=0)[0]
+
+    # Parallel (Chan et al.) combination of the Welford statistics
+    mean = (count * states[:,:,MEAN]).sum(dim=0) / safe_total_count
+    merged_states[:,MEAN] = mean
+    merged_states[:,M2] = (states[:,:,M2] + count * (states[:,:,MEAN] - mean)**2).sum(dim=0)
+
+    return merged_states
+
+def all_gather_names(names, device, world_size):
+    """
+    Args:
+        names (list): the metric names of this process
+        device (torch.device): the device of the collectives
+        world_size (int): number of processes
+    Output:
+        all_names (list): the metric names of all the processes (sorted)
+    """
+
+    # Names encoded as a single byte tensor (newline separated)
+    encoded_names = torch.tensor(list('\n'.join(names).encode('utf-8')), dtype=torch.uint8, device=device)
+
+    # all_gather needs tensors of the same size: gathering the sizes first
+    size = torch.tensor([encoded_names.numel()], dtype=torch.int64, device=device)
+    all_sizes = [torch.empty_like(size) for _ in range(world_size)]
+    torch.distributed.all_gather(all_sizes, size)
+    all_sizes = [int(x.item()) for x in all_sizes]
+
+    # then the names padded to the largest size
+    padded_names = torch.zeros((max(max(all_sizes), 1),), dtype=torch.uint8, device=device)
+    padded_names[:encoded_names.numel()] = encoded_names
+    all_padded_names = [torch.empty_like(padded_names) for _ in range(world_size)]
+    torch.distributed.all_gather(all_padded_names, padded_names)
+
+    all_names = set()
+    for padded_names, size in zip(all_padded_names, all_sizes):
+        if size > 0:
+            all_names.update(bytes(padded_names[:size].cpu().tolist()).decode('utf-8').split('\n'))
+
+    return sorted(all_names)
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class RunningMetrics():
+
+    def __init__(self, track_variance=False):
+
+        # Saving parameters
+        self.track_variance = track_variance
+
+        # State tensor of each metric (on the device of its values)
+        self.states = {}
+
+    def keys(self):
+        return self.states.keys()
+
+    def reset(self):
+        self.states = {}
+
+    def update(self, name, value):
+        """
+        Args:
+            name (str): name of the metric
+            value (torch.Tensor): value(s) of the metric, every element is a sample
+        """
+
+        value = torch.as_tensor(value).detach().reshape(-1).to(torch.float64)
+
+        if name not in self.states.keys():
+            self.states[name] = empty_state(value.device)
+        state = self.states[name]
+
+        # Excluding the NaN values (without leaving the device)
+        valid = torch.isnan(value) == False
+        count = valid.sum()
+        valid_value = torch.where(valid, value, torch.zeros_like(value))
+
+        state[NAN_COUNT] += value.numel() - count
+        state[SUM] += valid_value.sum()
+        state[MIN] = torch.min(state[MIN], torch.where(valid, value, torch.full_like(value, math.inf)).min())
+        state[MAX] = torch.max(state[MAX], torch.where(valid, value, torch.full_like(value, -math.inf)).max())
+
+        # Welford update with the mean and M2 of the new values
+        if self.track_variance:
+            total_count = state[COUNT] + count
+            safe_total_count = torch.clamp(total_count, min=1)
+            value_mean = valid_value.sum() / torch.clamp(count, min=1)
+            value_m2 = torch.where(valid, (value - value_mean)**2, torch.zeros_like(value)).sum()
+            delta = value_mean - state[MEAN]
+            state[MEAN] += delta * count / safe_total_count
+            state[M2] += value_m2 + delta**2 * state[COUNT] * count / safe_total_count
+
+        state[COUNT] += count
+
+    def update_dict(self, metrics):
+
+        for name, value in metrics.items():
+            self.update(name, value)
+
+    def get_device(self):
+
+        # The device of the states, or the one required by the process group
+        for state in self.states.values():
+            return state.device
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized() and \
+            torch.distributed.get_backend() == 'nccl':
+            return torch.device('cuda', torch.cuda.current_device())
+
+        return torch.device('cpu')
+
+    def compute(self, sync=True):
+        """
+        Args:
+            sync (bool): merge the states of all the DDP processes (every
+                process has to call compute)
+        Output:
+            results (dict): per metric, a dict with the mean, count, nan_count,
+                sum, min, max (and var and std, if tracked) as floats
+        """
+
+        names = sorted(self.states.keys())
+        device = self.get_device()
+        _, world_size = dt.get_distributed_info()
+
+        # The processes may not have logged the same metrics
+        if sync and world_size > 1:
+            names = all_gather_names(names, device, world_size)
+
+        if not names:
+            return {}
+
+        states = torch.stack([
+            self.states[name].to(device) if name in self.states.keys() else empty_state(device)
+            for name in names
+        ])
+
+        # A single collective for all the metrics
+        if sync and world_size > 1:
+            all_states = [torch.empty_like(states) for _ in range(world_size)]
+            torch.distributed.all_gather(all_states, states)
+            states = merge_states(torch.stack(all_states))
+
+        # A single copy to the host
+        states = states.cpu().tolist()
+
+        results = {}
+        for name, state in zip(names, states):
+
+            count = state[COUNT]
+
+            results[name] = {
+                'mean': state[SUM] / count if count > 0 else math.nan,
+                'count': int(count),
+                'nan_count': int(state[NAN_COUNT]),
+                'sum': state[SUM],
+                'min': state[MIN] if count > 0 else math.nan,
+                'max': state[MAX] if count > 0 else math.nan
+            }
+
+            if self.track_variance:
+                results[name]['var'] = state[M2] / (count - 1) if count > 1 else math.nan
+                results[name]['std'] = math.sqrt(results[name]['var']) if count > 1 else math.nan
+
+        return results
@@ -0,0 +1,183 @@
+import os
+import hashlib
+import pathlib
+import multiprocessing
+
+import numpy as np
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Decoded-sample cache
+
+Decoding the PNGs of a sample (skimage.io.imread) is repeated every time the
+sample is accessed, e.g. every epoch for the validation split. The
+DecodedSampleCache stores the decoded arrays as raw .npy files in a local
+directory (/dev/shm for shared memory), so the next access is a plain read.
+
+All the DataLoader workers of a process use the same directory: the files are
+written atomically (temporary file + rename), and the total size and the
+hit/miss counters are kept in shared multiprocessing values. Under DDP, each
+process (LOCAL_RANK) uses its own subdirectory, since the lock and the size
+are only shared with its own workers. When the cache exceeds its maximum size,
+the least recently used files (oldest modification time, which is refreshed on
+every hit) are evicted.
+
+The entries are keyed by the path of the source file (the source is not
+stat-ed on every access), so the cache must be cleared (clear) when the
+dataset is modified.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# After exceeding the maximum size, evict until this fraction of it is left
+EVICTION_TARGET = 0.9
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class DecodedSampleCache():
+
+    def __init__(self, cache_dir, max_size_bytes):
+
+        # Saving parameters (a directory per DDP process on this machine)
+        self.cache_dir = pathlib.Path(cache_dir) / f'rank_{int(os.getenv("LOCAL_RANK", 0))}'
+        self.max_size_bytes = int(max_size_bytes)
+
+        if self.cache_dir.exists() is False:
+            os.makedirs(str(self.cache_dir))
+
+        # Shared (across DataLoader workers) size, counters and eviction lock
+        self.lock = multiprocessing.Lock()
+        self.size_bytes = multiprocessing.Value('q', 0, lock=False)
+        self.hits = multiprocessing.Value('q', 0)
+        self.misses = multiprocessing.Value('q', 0)
+        self.evictions = multiprocessing.Value('q', 0)
+
+        # Accounting for the files left by a previous run
+        self.size_bytes.value = sum([x.stat().st_size for x in self.cache_dir.glob('*.npy')])
+        self.evict()
+
+    def get_cache_fp(self, file_path, tag):
+
+        key = hashlib.md5(f'{file_path}|{tag}'.encode()).hexdigest()
+
+        return self.cache_dir / f'{key}.npy'
+
+    def load(self, file_path, decode_fn, tag=''):
+        """
+        Args:
+            file_path (str): The source file
+            decode_fn (function): decode_fn(file_path) -> np.ndarray
+            tag (str): Distinguishes different decodings of the same file
+        Output:
+            array (np.ndarray): the decoded array
+        """
+
+        cache_fp = self.get_cache_fp(file_path, tag)
+
+        # Hit: reading the raw array and refreshing its LRU position
+        try:
+            array = np.load(str(cache_fp), allow_pickle=False)
+            os.utime(str(cache_fp))
+            with self.hits.get_lock():
+                self.hits.value += 1
+            return array
+
+        # Miss (or evicted by another worker in the meantime)
+        except (FileNotFoundError, ValueError):
+            pass
+
+        with self.misses.get_lock():
+            self.misses.value += 1
+
+        array = decode_fn(str(file_path))
+        self.save(cache_fp, array)
+
+        return array
+
+    def save(self, cache_fp, array):
+
+        # Writing atomically, other workers never read a partial file
+        tmp_cache_fp = self.cache_dir / f'{cache_fp.stem}.{os.getpid()}.tmp'
+        with open(str(tmp_cache_fp), 'wb') as outfile:
+            np.save(outfile, array, allow_pickle=False)
+
+        file_size = tmp_cache_fp.stat().st_size
+
+        with self.lock:
+            already_cached = cache_fp.exists()
+            os.replace(str(tmp_cache_fp), str(cache_fp))
+            if already_cached is False:
+                self.size_bytes.value += file_size
+
+        if self.size_bytes.value > self.max_size_bytes:
+            self.evict()
+
+    def evict(self):
+
+        with self.lock:
+
+            if self.size_bytes.value <= self.max_size_bytes:
+                return
+
+            # Least recently used first
+            entries = []
+            for cache_fp in self.cache_dir.glob('*.npy'):
+                try:
+                    stat = cache_fp.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, cache_fp))
+                except FileNotFoundError:
+                    continue
+            entries.sort()
+
+            size_bytes = sum([x[1] for x in entries])
+            target_size_bytes = EVICTION_TARGET * self.max_size_bytes
+
+            for _, file_size, cache_fp in entries:
+
+                if size_bytes <= target_size_bytes:
+                    break
+
+                try:
+                    os.remove(str(cache_fp))
+                except FileNotFoundError:
+                    pass
+
+                size_bytes -= file_size
+                with self.evictions.get_lock():
+                    self.evictions.value += 1
+
+            self.size_bytes.value = size_bytes
+
+    def clear(self):
+
+        with self.lock:
+            for cache_fp in self.cache_dir.glob('*.npy'):
+                try:
+                    os.remove(str(cache_fp))
+                except FileNotFoundError:
+                    pass
+            self.size_bytes.value = 0
+
+    def get_stats(self):
+
+        hits = self.hits.value
+        misses = self.misses.value
+        total = hits + misses
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else float('nan'),
+            'evictions': self.evictions.value,
+            'size_mb': self.size_bytes.value / 2**20
+        }
+
+    def reset_stats(self):
+
+        for counter in [self.hits, self.misses, self.evictions]:
+            with counter.get_lock():
+                counter.value = 0
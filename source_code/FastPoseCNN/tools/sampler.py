@@ -0,0 +1,148 @@
+import math
+
+import numpy as np
+import torch
+import torch.utils.data
+
+# Local Imports
+import distributed_tools as dt
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Class-balanced sampling
+
+With a few selected classes (e.g. ['bg', 'camera', 'laptop']), most samples
+only contain instances of the most common class. The ClassBalancedSampler
+draws the samples (with replacement) with weights computed from the per-sample
+instance counts of the dataset (NOCSPoseRegDataset.get_class_counts, cached in
+the dataset index), so the instances seen in an epoch follow a target class
+distribution (uniform by default).
+
+The weight of a sample is the sum of the weights of its instances. The class
+weights start as target / frequency and are then refined (fixed point), since
+a sample can contain instances of several classes. A target is not always
+reachable (e.g. a class mostly found next to many instances of another one),
+get_expected_distribution returns the distribution actually achieved.
+
+Every DDP process draws the same indices (same seed and epoch) and keeps its
+own share, as the DistributedSampler does.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Fixed-point iterations refining the class weights
+NUM_OF_REFINEMENTS = 20
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def compute_sample_weights(class_counts, target_distribution=None):
+    """
+    Args:
+        class_counts (np.array): [N, C] number of instances of each class in each sample
+        target_distribution (np.array): [C] wanted fraction of the instances of
+            each class (None = uniform over the classes with instances)
+    Output:
+        sample_weights (np.array): [N] sampling probability of each sample
+        class_weights (np.array): [C] weight of an instance of each class
+    """
+
+    class_counts = np.asarray(class_counts, dtype=np.float64)
+    class_frequency = class_counts.sum(axis=0)
+    present = class_frequency > 0
+
+    # Target over the classes with instances
+    if target_distribution is None:
+        target_distribution = present.astype(np.float64)
+    target_distribution = np.where(present, np.asarray(target_distribution, dtype=np.float64), 0)
+    target_distribution = target_distribution / target_distribution.sum()
+
+    # Initial class weights
+    class_weights = np.zeros_like(target_distribution)
+    class_weights[present] = target_distribution[present] / class_frequency[present]
+
+    for _ in range(NUM_OF_REFINEMENTS):
+
+        sample_weights = class_counts @ class_weights
+
+        # Distribution of the instances when sampling with these weights
+        achieved_distribution = sample_weights @ class_counts
+        achieved_distribution = achieved_distribution / achieved_distribution.sum()
+
+        class_weights[present] *= target_distribution[present] / achieved_distribution[present]
+
+    sample_weights = class_counts @ class_weights
+
+    # Samples without instances are never drawn (unless nothing else exists)
+    if sample_weights.sum() == 0:
+        sample_weights = np.ones_like(sample_weights)
+
+    return sample_weights / sample_weights.sum(), class_weights
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class ClassBalancedSampler(torch.utils.data.Sampler):
+
+    def __init__(
+        self,
+        class_counts,
+        num_samples=None,
+        target_distribution=None,
+        seed=0,
+        num_replicas=None,
+        rank=None
+        ):
+
+        # DDP sharding (defaults to the current process group)
+        if num_replicas is None or rank is None:
+            rank, num_replicas = dt.get_distributed_info()
+
+        # Saving parameters
+        self.class_counts = np.asarray(class_counts)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        # Samples drawn per epoch (by all the processes)
+        if num_samples is None:
+            num_samples = self.class_counts.shape[0]
+        self.num_samples = int(math.ceil(num_samples / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+
+        self.sample_weights, self.class_weights = compute_sample_weights(
+            self.class_counts,
+            target_distribution
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+
+        # Same draw in every process
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        indices = torch.multinomial(
+            torch.from_numpy(self.sample_weights),
+            self.total_size,
+            replacement=True,
+            generator=generator
+        ).tolist()
+
+        # Keeping the share of this process
+        return iter(indices[self.rank:self.total_size:self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+    def get_expected_distribution(self):
+
+        # Expected fraction of the drawn instances of each class
+        expected_distribution = self.sample_weights @ self.class_counts
+        return expected_distribution / expected_distribution.sum()
@@ -0,0 +1,216 @@
+import time
+import queue
+import threading
+
+import torch
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Asynchronous scalar writer
+
+Writing a (GPU) tensor with SummaryWriter.add_scalar converts it to a Python
+float, which waits for the device to finish all the work queued so far. With
+a few scalars per loss and metric, the training loop synchronizes many times
+per batch.
+
+The AsyncScalarWriter receives all the scalars of a batch at once:
+
+    1. the values are stacked into a single tensor on the device (no sync),
+    2. copied to the host with one non_blocking transfer (into a pinned buffer
+       of a small pool when the values are on a CUDA device, one buffer per
+       batch in flight), followed by a CUDA event,
+    3. a background thread waits for the event and writes the values with the
+       SummaryWriter of the split, flushing every flush_interval seconds.
+
+Per-batch scalars can be decimated: with a decimation of N, only every Nth
+value of a metric is written. The decimation is an int (every metric) or a
+dict {metric_name: N} (the other metrics are not decimated). The
+ScalarDecimator is shared with the synchronous logging of MyLogger.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Batches of scalars waiting to be written (the training blocks beyond this)
+MAX_PENDING_BATCHES = 1000
+
+# Interval (seconds) at which the idle writing thread checks the flush timer
+IDLE_CHECK_INTERVAL = 1.0
+
+# Pinned host buffers reused by the transfers (the training blocks beyond this)
+PINNED_POOL_SIZE = 8
+
+# Minimum number of values of a pinned buffer
+PINNED_BUFFER_SIZE = 64
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class ScalarDecimator():
+
+    def __init__(self, decimation=1):
+
+        # Saving parameters
+        self.decimation = decimation
+
+        # Number of values received per (split, metric)
+        self.counters = {}
+
+    def get_decimation(self, name):
+
+        if isinstance(self.decimation, dict):
+            return self.decimation.get(name, 1)
+        else:
+            return self.decimation
+
+    def keep(self, mode, name):
+
+        # Only keeping every Nth value of the metric
+        counter = self.counters.get((mode, name), 0)
+        self.counters[(mode, name)] = counter + 1
+
+        return counter % self.get_decimation(name) == 0
+
+    def filter(self, mode, metrics):
+        return {name: value for name, value in metrics.items() if self.keep(mode, name)}
+
+class AsyncScalarWriter():
+
+    def __init__(self, writers, flush_interval=10.0, decimation=1):
+
+        # Saving parameters
+        self.writers = writers
+        self.flush_interval = flush_interval
+        self.decimator = ScalarDecimator(decimation)
+
+        # Pool of the pinned host buffers (allocated on demand)
+        self.free_buffers = queue.Queue()
+        self.num_buffers = 0
+
+        self.queue = queue.Queue(maxsize=MAX_PENDING_BATCHES)
+        self.thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.thread.start()
+
+    def get_pinned_buffer(self, size):
+
+        # A free buffer, or a new one while the pool is not full, or waiting
+        # for the writing thread to release one
+        try:
+            buffer = self.free_buffers.get_nowait()
+        except queue.Empty:
+            if self.num_buffers < PINNED_POOL_SIZE:
+                self.num_buffers += 1
+                buffer = None
+            else:
+                buffer = self.free_buffers.get()
+
+        # (buffers too small for the batch are replaced)
+        if buffer is None or buffer.numel() < size:
+            buffer = torch.empty((max(size, PINNED_BUFFER_SIZE),), dtype=torch.float32, pin_memory=True)
+
+        return buffer
+
+    def add_scalars(self, mode, metrics, step, decimate=True):
+        """
+        Args:
+            mode (str): the split (key of the writers)
+            metrics (dict): {name: value} scalars (tensors or numbers)
+            step (int): global step of the scalars
+            decimate (bool): apply the per-metric decimation
+        """
+
+        # Only keeping every Nth value of the metrics
+        if decimate:
+            metrics = self.decimator.filter(mode, metrics)
+
+        names = list(metrics.keys())
+        values = list(metrics.values())
+
+        if not names:
+            return
+
+        # Stacking the values on the device of the first tensor
+        device = torch.device('cpu')
+        for value in values:
+            if isinstance(value, torch.Tensor):
+                device = value.device
+                break
+
+        stacked_values = torch.stack([
+            torch.as_tensor(value).detach().reshape(()).to(device, torch.float32)
+            for value in values
+        ])
+
+        # A single transfer to the host
+        if stacked_values.is_cuda:
+            buffer = self.get_pinned_buffer(len(names))
+            host_values = buffer[:len(names)]
+            host_values.copy_(stacked_values, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            buffer = None
+            host_values = stacked_values
+            event = None
+
+        self.queue.put((mode, names, host_values, buffer, event, step))
+
+    def writer_loop(self):
+
+        last_flush_time = time.perf_counter()
+
+        while True:
+
+            try:
+                item = self.queue.get(timeout=IDLE_CHECK_INTERVAL)
+            except queue.Empty:
+                item = False
+
+            # Shutdown signal
+            if item is None:
+                self.queue.task_done()
+                break
+
+            if item is not False:
+
+                mode, names, host_values, buffer, event, step = item
+
+                # Waiting for the copy (in this thread, not in the training loop)
+                if event is not None:
+                    event.synchronize()
+
+                values = host_values.tolist()
+
+                # The pinned buffer can be reused by the next batches
+                if buffer is not None:
+                    self.free_buffers.put(buffer)
+
+                for name, value in zip(names, values):
+                    self.writers[mode].add_scalar(name, value, step)
+
+                self.queue.task_done()
+
+            # Flushing the event files every flush_interval seconds
+            if time.perf_counter() - last_flush_time >= self.flush_interval:
+                for writer in self.writers.values():
+                    writer.flush()
+                last_flush_time = time.perf_counter()
+
+    def flush(self):
+
+        # Waiting for the pending scalars to be written
+        self.queue.join()
+
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        for writer in self.writers.values():
+            writer.flush()
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import tarfile
+import argparse
+import pathlib
+
+import tqdm
+
+# Local Imports
+root = next(path for path in pathlib.Path(os.path.abspath(__file__)).parents if path.name == 'FastPoseCNN')
+sys.path.append(str(root))
+sys.path.append(str(pathlib.Path(__file__).parent))
+
+import setup_env
+import json_tools as jt
+import dataset as ds
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Sharding a dataset
+
+Reading millions of small files (_color.png, _mask.png, _meta+.json) is
+dominated by the file-system metadata operations. Sharding a dataset packs the
+(still encoded) files of its samples into large uncompressed tar files, which
+NOCSPoseRegShardDataset then streams with large sequential reads:
+
+    python shard_dataset.py --dataset_dir $NOCS_CAMERA_TRAIN_DATASET --shards_dir $NOCS_CAMERA_TRAIN_SHARDS --classes bg camera laptop
+
+The files of a sample are stored consecutively, named after the path of the
+sample relative to the dataset directory (e.g. 00000/0000_color.png). The
+_meta+.bin is used instead of the _meta+.json when available (and up to date). Only the samples
+with instances of the selected classes are written.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+SHARDS_VERSION = 1
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def write_shards(
+    dataset_dir,
+    shards_dir,
+    classes=None,
+    samples_per_shard=1000,
+    max_size=None
+    ):
+
+    dataset_dir = pathlib.Path(dataset_dir)
+    shards_dir = pathlib.Path(shards_dir)
+
+    if shards_dir.exists() is False:
+        os.makedirs(str(shards_dir))
+
+    # Removing a previous index, so partially written shards are never used
+    index_fp = shards_dir / ds.SHARDS_INDEX_NAME
+    if index_fp.exists():
+        os.remove(str(index_fp))
+
+    # Collecting the samples (with empty samples already removed)
+    dataset = ds.NOCSPoseRegDataset(
+        dataset_dir=dataset_dir,
+        max_size=max_size,
+        classes=classes,
+        use_index=True
+    )
+    num_samples = len(dataset)
+
+    if num_samples == 0:
+        raise RuntimeError(f'No samples found in {dataset_dir}')
+
+    shards = []
+    start_time = time.time()
+
+    for shard_id, start in enumerate(tqdm.tqdm(range(0, num_samples, samples_per_shard), bar_format='{l_bar}{bar:40}{r_bar}{bar:-10b}')):
+
+        shard_name = f'shard-{shard_id:06d}.tar'
+        color_images = dataset.images_fps[start:start+samples_per_shard]
+
+        with tarfile.open(str(shards_dir / shard_name), mode='w') as tar:
+            for color_image in color_images:
+
+                # The binary meta is preferred, if available and up to date
+                meta = pathlib.Path(jt.get_meta_path(str(color_image).replace('_color.png', jt.META_JSON_SUFFIX)))
+
+                mask_image = pathlib.Path(str(color_image).replace('_color.png', '_mask.png'))
+
+                for file_path in [color_image, mask_image, meta]:
+                    tar.add(str(file_path), arcname=str(file_path.relative_to(dataset_dir)), recursive=False)
+
+        shards.append({'name': shard_name, 'num_samples': len(color_images)})
+
+    # Finally writing the index, which marks the shards as complete
+    index = {
+        'version': SHARDS_VERSION,
+        'classes': list(dataset.selected_classes),
+        'num_samples': num_samples,
+        'shards': shards
+    }
+    jt.save_to_json(index_fp, index)
+
+    total_time = time.time() - start_time
+    print(f'Wrote {num_samples} samples into {len(shards)} shards in {total_time:.2f}s')
+
+    return index
+
+#-------------------------------------------------------------------------------
+# Main Code
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack a NOCS split into sequential tar shards')
+    parser.add_argument('--dataset_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--shards_dir', type=pathlib.Path, required=True)
+    parser.add_argument('--classes', type=str, nargs='+', default=None)
+    parser.add_argument('--samples_per_shard', type=int, default=1000)
+    parser.add_argument('--max_size', type=int, default=None)
+    args = parser.parse_args()
+
+    write_shards(
+        args.dataset_dir,
+        args.shards_dir,
+        classes=args.classes,
+        samples_per_shard=args.samples_per_shard,
+        max_size=args.max_size
+    )
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+# Local Imports
+import dataset as ds
+import compile_dataset as cd
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_compiled_samples_match_dense_synthesis(dataset_dir, selected_classes, tmp_path):
+
+    compiled_dir = tmp_path / 'compiled'
+    cd.compile_pose_dataset(dataset_dir, compiled_dir, classes=selected_classes)
+
+    dataset = ds.NOCSPoseRegDataset(dataset_dir, classes=selected_classes)
+    compiled_dataset = ds.NOCSPoseRegDataset(dataset_dir, classes=selected_classes, compiled_dir=compiled_dir)
+
+    assert len(compiled_dataset) == len(dataset)
+
+    # The compiled dense targets are the ones synthesized at load time
+    for i in range(len(dataset)):
+        sample = dataset[i]
+        compiled_sample = compiled_dataset[i]
+
+        assert sample.keys() == compiled_sample.keys()
+        for key in sample.keys():
+            np.testing.assert_allclose(compiled_sample[key], sample[key], atol=1e-6, err_msg=key)
+
+def test_compiled_dataset_rejects_other_classes(dataset_dir, selected_classes, tmp_path):
+
+    compiled_dir = tmp_path / 'compiled'
+    cd.compile_pose_dataset(dataset_dir, compiled_dir, classes=selected_classes)
+
+    # The compiled dense data depends on the selected classes
+    with pytest.raises(RuntimeError):
+        ds.NOCSPoseRegDataset(dataset_dir, classes=['bg', 'camera'], compiled_dir=compiled_dir)
@@ -0,0 +1,51 @@
+import numpy as np
+import cv2
+import pytest
+
+# Local Imports
+import dataset as ds
+
+#-------------------------------------------------------------------------------
+# Tests
+
+@pytest.mark.parametrize('crop_size, resolution_scale', [((320, 480), 1.0), ((320, 480), 0.5), (None, 0.5)])
+def test_crop_intrinsics_project_the_instance_centers(dataset_dir, selected_classes, crop_size, resolution_scale):
+
+    dataset = ds.NOCSPoseRegDataset(
+        dataset_dir,
+        classes=selected_classes,
+        crop_size=crop_size,
+        resolution_scale=resolution_scale
+    )
+
+    rng = np.random.default_rng(0)
+    num_of_checked = 0
+    for _ in range(10):
+
+        # A single camera, drawn around its projected center
+        T = np.array([rng.uniform(-0.1, 0.1), rng.uniform(-0.1, 0.1), rng.uniform(0.8, 1.2)])
+        center = dataset.INTRINSICS @ T
+        center = center[:2] / center[2]
+
+        mask = np.zeros((480, 640), dtype=np.uint8)
+        cv2.circle(mask, (int(round(center[0])), int(round(center[1]))), 30, 1, -1)
+        image = np.zeros((480, 640, 3), dtype=np.uint8)
+
+        image, mask, intrinsics = dataset.crop_raw_sample(image, mask, {'instance_dict': {'1': 3}})
+
+        # The output is a multiple of 32 (for the encoder)
+        assert image.shape[:2] == mask.shape
+        assert mask.shape[0] % 32 == 0 and mask.shape[1] % 32 == 0
+
+        # The projection with the intrinsics of the output is the instance center
+        # (when the instance is fully inside the crop)
+        ys, xs = np.nonzero(mask == 1)
+        if ys.min() == 0 or xs.min() == 0 or ys.max() == mask.shape[0]-1 or xs.max() == mask.shape[1]-1:
+            continue
+
+        projected_center = intrinsics @ T
+        projected_center = projected_center[:2] / projected_center[2]
+        np.testing.assert_allclose(projected_center, [xs.mean(), ys.mean()], atol=1)
+        num_of_checked += 1
+
+    assert num_of_checked > 0
@@ -0,0 +1,55 @@
+import os
+import json
+import shutil
+
+import pytest
+
+# Local Imports
+import dataset as ds
+import dataset_index as di
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_index_matches_directory_walk(dataset_dir, selected_classes, tmp_path):
+
+    walked_dataset = ds.NOCSPoseRegDataset(dataset_dir, classes=selected_classes)
+    indexed_dataset = ds.NOCSPoseRegDataset(dataset_dir, classes=selected_classes, use_index=True, index_dir=tmp_path)
+
+    assert indexed_dataset.index_path is not None
+    assert indexed_dataset.images_fps == walked_dataset.images_fps
+
+    # max_size keeps the first samples of the walk
+    indexed_dataset = ds.NOCSPoseRegDataset(dataset_dir, max_size=4, classes=selected_classes, use_index=True, index_dir=tmp_path)
+    assert indexed_dataset.images_fps == walked_dataset.images_fps[:4]
+
+def test_index_staleness(dataset_dir, tmp_path):
+
+    # A copy of the dataset that can be modified
+    dataset_dir = shutil.copytree(dataset_dir, tmp_path / 'dataset')
+    index_path = di.get_index(dataset_dir, di.get_index_path(dataset_dir, tmp_path / 'index'))
+
+    assert di.is_index_stale(index_path, dataset_dir) is False
+
+    # A _meta+ written in place is only found by the verified check
+    meta = dataset_dir / '00000' / '0000_meta+.json'
+    data = json.loads(meta.read_text())
+    data['instance_dict']['1'] = 6
+    meta.write_text(json.dumps(data))
+    os.utime(str(meta), ns=(0, 0))
+
+    assert di.is_index_stale(index_path, dataset_dir) is False
+    assert di.is_index_stale(index_path, dataset_dir, verify_files=True)
+
+    # A removed sample changes its directory
+    di.get_index(dataset_dir, index_path, rebuild=True)
+    os.remove(str(dataset_dir / '00001' / '0002_color.png'))
+    assert di.is_index_stale(index_path, dataset_dir)
+
+def test_index_outside_of_dataset(dataset_dir):
+
+    index_path = di.get_index_path(dataset_dir, dataset_dir / 'index')
+
+    # (it would change the fingerprint of its own directory)
+    with pytest.raises(RuntimeError):
+        di.get_index(dataset_dir, index_path)
@@ -0,0 +1,42 @@
+import copy
+
+import numpy as np
+
+# Local Imports
+import project as pj
+import data_manipulation as dm
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_dense_targets_match_per_instance_functions(random_frames):
+
+    intrinsics = pj.constants.INTRINSICS['NOCS']
+
+    for mask, json_data in random_frames:
+
+        # Previous implementation (one pass per instance)
+        old_outputs = (
+            dm.create_dense_quaternion(mask, copy.deepcopy(json_data)),
+            dm.create_dense_scales(mask, copy.deepcopy(json_data)),
+            *dm.create_dense_3d_centers(mask, copy.deepcopy(json_data), intrinsics)
+        )
+
+        new_outputs = dm.create_dense_targets(mask, copy.deepcopy(json_data), intrinsics)
+
+        for name, old, new in zip(['quaternion', 'scales', 'xy', 'z'], old_outputs, new_outputs):
+            assert old.shape == new.shape, name
+            np.testing.assert_allclose(new, old, atol=1e-6, err_msg=name)
+
+def test_remap_labels(random_frames):
+
+    mask, json_data = random_frames[0]
+    label_map = {int(k):v for k,v in json_data['instance_dict'].items()}
+
+    # Same as a per-label assignment, labels not in the map become 0
+    expected = np.zeros_like(mask)
+    for old_label, new_label in label_map.items():
+        expected[mask == old_label] = new_label
+
+    np.testing.assert_array_equal(dm.remap_labels(mask, label_map), expected)
+    np.testing.assert_array_equal(dm.remap_labels(mask, {}), np.zeros_like(mask))
@@ -0,0 +1,61 @@
+import os
+import copy
+
+import numpy as np
+
+# Local Imports
+import json_tools as jt
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_meta_binary_round_trip(random_frames, tmp_path):
+
+    for i, (_, json_data) in enumerate(random_frames):
+
+        json_file_path = tmp_path / f'{i:04d}{jt.META_JSON_SUFFIX}'
+        jt.save_to_json(json_file_path, json_data)
+        jt.convert_meta_json_to_binary(json_file_path)
+
+        data = jt.load_meta(json_file_path)
+        expected = jt.load_from_json(json_file_path)
+
+        # Same keys and values as the json (the parameters as arrays)
+        assert data['instance_dict'] == {str(k):v for k,v in expected['instance_dict'].items()}
+        for key in ['RTs', 'quaternions', 'scales', 'norm_factors']:
+            np.testing.assert_array_equal(data[key], np.asarray(expected[key]), err_msg=key)
+
+        # Writable, like the lists of the json
+        data['RTs'][0][0, 0] = 0
+
+def test_meta_binary_empty_sample(tmp_path):
+
+    json_data = {'instance_dict': {}, 'RTs': [], 'quaternions': [], 'scales': [], 'norm_factors': []}
+
+    binary_file_path = tmp_path / f'0000{jt.META_BINARY_SUFFIX}'
+    jt.save_meta_to_binary(binary_file_path, json_data)
+
+    data = jt.load_meta_from_binary(binary_file_path)
+    assert data['instance_dict'] == {}
+    assert data['RTs'].shape == (0, 4, 4)
+
+def test_outdated_meta_binary_is_ignored(random_frames, tmp_path):
+
+    _, json_data = random_frames[0]
+
+    json_file_path = tmp_path / f'0000{jt.META_JSON_SUFFIX}'
+    binary_file_path = tmp_path / f'0000{jt.META_BINARY_SUFFIX}'
+    jt.save_to_json(json_file_path, json_data)
+    jt.convert_meta_json_to_binary(json_file_path)
+
+    assert jt.get_meta_path(json_file_path) == str(binary_file_path)
+
+    # Editing the json after the conversion
+    edited_json_data = copy.deepcopy(json_data)
+    edited_json_data['instance_dict']['1'] = 0
+    jt.save_to_json(json_file_path, edited_json_data)
+    binary_mtime = os.stat(str(binary_file_path)).st_mtime_ns
+    os.utime(str(json_file_path), ns=(binary_mtime + 1, binary_mtime + 1))
+
+    assert jt.get_meta_path(json_file_path) == str(json_file_path)
+    assert jt.load_meta(json_file_path)['instance_dict']['1'] == 0
@@ -0,0 +1,43 @@
+import argparse
+
+import torch
+import pytest
+
+import segmentation_models_pytorch as smp
+
+# Local Imports
+import pose_regressor as pr
+import onnx_backend as ob
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# The PoseRegressor uses the FPN decoder of segmentation_models_pytorch 0.1
+pytestmark = pytest.mark.skipif(hasattr(smp, 'fpn') is False, reason='requires segmentation_models_pytorch 0.1 (smp.fpn)')
+
+#-------------------------------------------------------------------------------
+# Tests
+
+@pytest.mark.parametrize('decoder_sharing', ['separate', 'adapters'])
+def test_onnx_runtime_matches_pytorch(decoder_sharing, tmp_path):
+
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+
+    # Random weights (exported at a small image size)
+    torch.manual_seed(0)
+    model = pr.PoseRegressor(
+        argparse.Namespace(),
+        intrinsics=torch.eye(3),
+        encoder_name='resnet18',
+        encoder_weights=None,
+        classes=3,
+        decoder_sharing=decoder_sharing
+    ).eval()
+
+    onnx_path = ob.export_onnx(model, tmp_path / 'pose_regressor.onnx', image_size=(128, 160))
+    onnx_runner = ob.ONNXPoseRegressor(onnx_path, argparse.Namespace(), intrinsics=torch.eye(3), classes=3)
+
+    # The dynamic batch dimension and the PARITY_* tolerances
+    results = ob.check_onnx_parity(model, onnx_runner, torch.rand((2, 3, 128, 160)))
+    assert results['passed'], results
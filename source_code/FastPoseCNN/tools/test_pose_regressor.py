@@ -0,0 +1,73 @@
+import argparse
+
+import torch
+import pytest
+
+import segmentation_models_pytorch as smp
+
+# Local Imports
+import feature_cache as fc
+import pose_regressor as pr
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# The PoseRegressor uses the FPN decoder of segmentation_models_pytorch 0.1
+pytestmark = pytest.mark.skipif(hasattr(smp, 'fpn') is False, reason='requires segmentation_models_pytorch 0.1 (smp.fpn)')
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def create_model(decoder_sharing='separate'):
+
+    # Random weights, only the dense part (no HPARAM needed)
+    torch.manual_seed(0)
+    model = pr.PoseRegressor(
+        argparse.Namespace(),
+        intrinsics=torch.eye(3),
+        encoder_name='resnet18',
+        encoder_weights=None,
+        classes=3,
+        decoder_sharing=decoder_sharing
+    )
+
+    return model.eval()
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_cached_features_match_the_encoder():
+
+    model = create_model()
+    x = torch.rand((2, 3, 128, 160))
+    outputs = pr.DENSE_OUTPUTS + ['cat_mask']
+
+    with torch.no_grad():
+        expected_predictions = model.predict(x, outputs)
+        features = model.encoder(x)[-fc.NUM_OF_FEATURE_LEVELS:]
+        predictions = model.predict(x, outputs, features=features)
+        float16_predictions = model.predict(x, outputs, features=[y.half().float() for y in features])
+
+    # The float32 features skip the encoder without changing the outputs
+    for key in outputs:
+        assert torch.equal(predictions[key], expected_predictions[key]), key
+
+    # The float16 features only change the mask logits slightly
+    torch.testing.assert_close(float16_predictions['mask'], expected_predictions['mask'], rtol=0, atol=1e-2)
+
+@pytest.mark.parametrize('decoder_sharing', pr.DECODER_SHARING_OPTIONS)
+def test_selective_outputs_match_all_the_outputs(decoder_sharing):
+
+    model = create_model(decoder_sharing)
+    x = torch.rand((2, 3, 128, 160))
+
+    with torch.no_grad():
+        all_predictions = model.predict(x, pr.DENSE_OUTPUTS + ['cat_mask'])
+
+        for output_set in pr.SELECTIVE_BENCHMARK_OUTPUT_SETS + [['cat_mask'], ['z']]:
+            predictions = model.predict(x, output_set)
+
+            # Only the requested outputs, identical to the complete pass
+            assert set(predictions.keys()) == set(output_set)
+            for key in output_set:
+                assert torch.equal(predictions[key], all_predictions[key]), (output_set, key)
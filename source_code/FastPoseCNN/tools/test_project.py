@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+# Local Imports
+import project as pj
+
+#-------------------------------------------------------------------------------
+# Tests
+
+@pytest.mark.parametrize('num_classes', [2, 3, 7, 81])
+def test_colormap_matches_matplotlib_hsv(num_classes):
+
+    matplotlib = pytest.importorskip('matplotlib')
+    import matplotlib.cm
+
+    # (matplotlib.cm.get_cmap was removed in matplotlib 3.9)
+    hsv_cmap = matplotlib.colormaps['hsv'] if hasattr(matplotlib, 'colormaps') else matplotlib.cm.get_cmap('hsv')
+
+    # The class colors are unchanged after dropping the matplotlib import
+    np.testing.assert_allclose(
+        pj.generate_colormap(num_classes),
+        pj.generate_colormap(num_classes, cmap=hsv_cmap),
+        atol=1e-12
+    )
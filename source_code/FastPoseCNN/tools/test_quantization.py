@@ -0,0 +1,54 @@
+import argparse
+
+import torch
+import pytest
+
+import segmentation_models_pytorch as smp
+
+# Local Imports
+import pose_regressor as pr
+import quantization as qt
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# The PoseRegressor uses the FPN decoder of segmentation_models_pytorch 0.1
+pytestmark = pytest.mark.skipif(hasattr(smp, 'fpn') is False, reason='requires segmentation_models_pytorch 0.1 (smp.fpn)')
+
+#-------------------------------------------------------------------------------
+# Tests
+
+@pytest.mark.parametrize('decoder_sharing', pr.DECODER_SHARING_OPTIONS)
+def test_quantized_model_follows_the_float_model(decoder_sharing):
+
+    if 'fbgemm' not in torch.backends.quantized.supported_engines:
+        pytest.skip('requires the fbgemm quantized engine')
+
+    # Random weights, calibrated with random images
+    torch.manual_seed(0)
+    model = pr.PoseRegressor(
+        argparse.Namespace(),
+        intrinsics=torch.eye(3),
+        encoder_name='resnet18',
+        encoder_weights=None,
+        classes=3,
+        decoder_sharing=decoder_sharing
+    ).eval()
+
+    batches = [{'image': torch.rand((2, 3, 128, 160))} for _ in range(4)]
+    quantized_model = qt.quantize_pose_regressor(model, batches)
+
+    # Every module but the float heads is quantized (the encoder included)
+    assert 'encoder' in quantized_model.quantized_modules
+    assert set(quantized_model.quantized_modules).isdisjoint(qt.DEFAULT_FLOAT_MODULES)
+
+    x = torch.rand((2, 3, 128, 160))
+    with torch.no_grad():
+        predictions = model.predict(x, pr.DENSE_OUTPUTS)
+        quantized_predictions = quantized_model.predict(x, pr.DENSE_OUTPUTS)
+
+    # The int8 logits follow the float ones (loosely, with random weights)
+    for key in pr.DENSE_OUTPUTS:
+        assert quantized_predictions[key].shape == predictions[key].shape, key
+        correlation = torch.corrcoef(torch.stack([predictions[key].flatten(), quantized_predictions[key].flatten()]))[0, 1]
+        assert correlation > 0.8, (key, correlation.item())
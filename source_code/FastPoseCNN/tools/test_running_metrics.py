@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+import pytest
+
+# Local Imports
+import running_metrics as rm
+
+#-------------------------------------------------------------------------------
+# Fixtures
+
+@pytest.fixture
+def batches():
+
+    # Batches of losses of different sizes, with some NaN values (no instances)
+    rng = np.random.default_rng(0)
+    batches = [rng.normal(3, 2, rng.integers(1, 9)) for _ in range(50)]
+    for batch in batches[::7]:
+        batch[0] = np.nan
+
+    return batches
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_running_metrics_match_numpy(batches):
+
+    running_metrics = rm.RunningMetrics(track_variance=True)
+    for batch in batches:
+        running_metrics.update('loss', torch.from_numpy(batch))
+    running_metrics.update('always_nan', torch.tensor([np.nan, np.nan]))
+
+    results = running_metrics.compute()
+    values = np.concatenate(batches)
+
+    assert results['loss']['count'] == np.count_nonzero(~np.isnan(values))
+    assert results['loss']['nan_count'] == np.count_nonzero(np.isnan(values))
+    np.testing.assert_allclose(
+        [results['loss'][x] for x in ['mean', 'sum', 'min', 'max', 'var', 'std']],
+        [np.nanmean(values), np.nansum(values), np.nanmin(values), np.nanmax(values), np.nanvar(values, ddof=1), np.nanstd(values, ddof=1)],
+        rtol=1e-12
+    )
+
+    # A metric that was always NaN has a NaN mean
+    assert results['always_nan']['count'] == 0 and np.isnan(results['always_nan']['mean'])
+
+def test_merged_states_match_numpy(batches):
+
+    # Each (simulated) DDP process sees a part of the batches
+    processes_metrics = [rm.RunningMetrics(track_variance=True) for _ in range(3)]
+    for i, batch in enumerate(batches):
+        processes_metrics[i % 3].update('loss', torch.from_numpy(batch))
+
+    states = torch.stack([torch.stack([x.states['loss']]) for x in processes_metrics])
+    merged_state = rm.merge_states(states)[0]
+
+    values = np.concatenate(batches)
+    count = np.count_nonzero(~np.isnan(values))
+
+    np.testing.assert_allclose(
+        merged_state[[rm.COUNT, rm.SUM, rm.MIN, rm.MAX, rm.MEAN]].numpy(),
+        [count, np.nansum(values), np.nanmin(values), np.nanmax(values), np.nanmean(values)],
+        rtol=1e-12
+    )
+    np.testing.assert_allclose(merged_state[rm.M2].item() / (count - 1), np.nanvar(values, ddof=1), rtol=1e-12)
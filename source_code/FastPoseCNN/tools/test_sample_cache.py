@@ -0,0 +1,32 @@
+import numpy as np
+
+# Local Imports
+import sample_cache as sc
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_cache_uses_a_directory_per_rank(monkeypatch, tmp_path):
+
+    monkeypatch.setenv('LOCAL_RANK', '1')
+    cache = sc.DecodedSampleCache(tmp_path, 2**20)
+
+    assert cache.cache_dir == tmp_path / 'rank_1'
+
+def test_cache_hits_and_evictions(tmp_path):
+
+    # Room for ~2 arrays of 80 kB
+    cache = sc.DecodedSampleCache(tmp_path, 2 * 80_200)
+    arrays = {f'{i}.png': np.full((100, 100), i, dtype=np.float64) for i in range(3)}
+
+    for file_path in arrays.keys():
+        np.testing.assert_array_equal(cache.load(file_path, arrays.__getitem__), arrays[file_path])
+    np.testing.assert_array_equal(cache.load('2.png', lambda x: None), arrays['2.png'])
+
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses']) == (1, 3)
+    assert stats['evictions'] > 0
+    assert cache.size_bytes.value <= cache.max_size_bytes
+
+    cache.clear()
+    assert list(cache.cache_dir.glob('*.npy')) == []
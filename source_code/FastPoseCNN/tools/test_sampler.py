@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+# Local Imports
+import sampler as sp
+
+#-------------------------------------------------------------------------------
+# Fixtures
+
+@pytest.fixture
+def class_counts():
+
+    # Mostly cameras (86% of the instances), some laptops, and samples with both
+    rng = np.random.default_rng(0)
+    class_counts = np.zeros((1000, 3), dtype=np.int64)
+    class_counts[:, 1] = rng.integers(1, 4, 1000)
+    class_counts[::5, 2] = rng.integers(1, 3, 200)
+    class_counts[::10, 1] = 0
+
+    return class_counts
+
+#-------------------------------------------------------------------------------
+# Tests
+
+@pytest.mark.parametrize('target_distribution', [None, [0, 0.6, 0.4]])
+def test_drawn_instances_follow_the_target_distribution(class_counts, target_distribution):
+
+    sampler = sp.ClassBalancedSampler(class_counts, num_samples=200_000, target_distribution=target_distribution, num_replicas=1, rank=0)
+
+    expected_distribution = [0, 0.5, 0.5] if target_distribution is None else target_distribution
+    np.testing.assert_allclose(sampler.get_expected_distribution(), expected_distribution, atol=1e-3)
+
+    # Empirical distribution of the instances of the drawn samples
+    drawn_distribution = class_counts[list(iter(sampler))].sum(axis=0)
+    drawn_distribution = drawn_distribution / drawn_distribution.sum()
+    np.testing.assert_allclose(drawn_distribution, expected_distribution, atol=0.01)
+
+def test_ranks_split_the_same_draw(class_counts):
+
+    num_replicas = 3
+    samplers = [sp.ClassBalancedSampler(class_counts, num_replicas=num_replicas, rank=rank) for rank in range(num_replicas)]
+    full_sampler = sp.ClassBalancedSampler(class_counts, num_samples=len(samplers[0])*num_replicas, num_replicas=1, rank=0)
+
+    # Equal shares that interleave into the single process draw
+    assert [len(x) for x in samplers] == [334] * num_replicas
+    shares = [list(iter(x)) for x in samplers]
+    assert [x for share in zip(*shares) for x in share] == list(iter(full_sampler))
+
+    # A new draw every epoch
+    for sampler in samplers:
+        sampler.set_epoch(1)
+    assert [list(iter(x)) for x in samplers] != shares
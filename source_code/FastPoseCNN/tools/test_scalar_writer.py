@@ -0,0 +1,16 @@
+# Local Imports
+import scalar_writer as sw
+
+#-------------------------------------------------------------------------------
+# Tests
+
+def test_decimator_keeps_every_nth_value_per_split_and_metric():
+
+    decimator = sw.ScalarDecimator({'loss': 3})
+
+    kept = [decimator.filter('train', {'loss': i, 'metric': i}) for i in range(7)]
+    assert [x['loss'] for x in kept if 'loss' in x] == [0, 3, 6]
+    assert [x['metric'] for x in kept] == list(range(7))
+
+    # The splits are counted separately
+    assert decimator.filter('valid', {'loss': 0}) == {'loss': 0}
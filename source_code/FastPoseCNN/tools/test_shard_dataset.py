@@ -0,0 +1,82 @@
+import collections
+
+import numpy as np
+import pytest
+
+# Local Imports
+import dataset as ds
+import distributed_tools as dt
+import shard_dataset as sd
+
+#-------------------------------------------------------------------------------
+# Fixtures
+
+@pytest.fixture(scope='module')
+def shards_dir(dataset_dir, selected_classes, tmp_path_factory):
+
+    # 6 samples into 3 shards (the index of the writer is kept out of the dataset)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('DATASET_INDEX_DIR', str(tmp_path_factory.mktemp('index')))
+        shards_dir = tmp_path_factory.mktemp('shards')
+        sd.write_shards(dataset_dir, shards_dir, classes=selected_classes, samples_per_shard=2)
+
+    return shards_dir
+
+#-------------------------------------------------------------------------------
+# Functions
+
+def iterate_rank(monkeypatch, dataset, rank, world_size, epoch=0):
+
+    # The color images of the samples yielded by a rank (without decoding)
+    monkeypatch.setattr(dt, 'get_distributed_info', lambda: (rank, world_size))
+    monkeypatch.setattr(dataset, 'decode_sample', lambda files: files['color.png'])
+    dataset.set_epoch(epoch)
+
+    return len(dataset), list(iter(dataset))
+
+#-------------------------------------------------------------------------------
+# Tests
+
+@pytest.mark.parametrize('world_size', [1, 2, 4, 5])
+def test_ranks_yield_the_same_number_of_samples(monkeypatch, shards_dir, selected_classes, world_size):
+
+    dataset = ds.NOCSPoseRegShardDataset(shards_dir, classes=selected_classes, shuffle_buffer_size=3)
+
+    for rank in range(world_size):
+        num_of_samples, samples = iterate_rank(monkeypatch, dataset, rank, world_size)
+
+        # ceil(N / world_size) samples on every rank, matching __len__
+        assert num_of_samples == int(np.ceil(6 / world_size))
+        assert len(samples) == num_of_samples
+
+def test_ranks_shards_rotate_with_the_epoch(monkeypatch, shards_dir, selected_classes):
+
+    dataset = ds.NOCSPoseRegShardDataset(shards_dir, classes=selected_classes, shuffle_buffer_size=0)
+
+    # Over the epochs, a rank sees all the samples
+    seen_samples = collections.Counter()
+    for epoch in range(3):
+        _, samples = iterate_rank(monkeypatch, dataset, 0, 3, epoch)
+        seen_samples.update(samples)
+
+    assert len(seen_samples) == 6
+
+def test_batched_sample_matches_map_dataset(monkeypatch, dataset_dir, shards_dir, selected_classes, tmp_path):
+
+    monkeypatch.setenv('DATASET_INDEX_DIR', str(tmp_path))
+
+    dataset = ds.NOCSPoseRegDataset(dataset_dir, classes=selected_classes)
+    shard_dataset = ds.NOCSPoseRegShardDataset(shards_dir, classes=selected_classes)
+
+    # The shards follow the order of the samples
+    sample_ids = [4, 1]
+    batched_sample = shard_dataset.get_batched_sample(sample_ids)
+    expected_batched_sample = dataset.get_batched_sample(sample_ids)
+
+    assert batched_sample.keys() == expected_batched_sample.keys()
+    for key in batched_sample.keys():
+        np.testing.assert_allclose(batched_sample[key], expected_batched_sample[key], atol=1e-6, err_msg=key)
+
+    # Random batches are stacked from a single shard
+    random_batched_sample = shard_dataset.get_random_batched_sample(2)
+    assert random_batched_sample['image'].shape[0] == 2
@@ -6,4 +6,5 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from general import *
 import pose_regression as pose
-import segmentation as seg
\ No newline at end of file
+import segmentation as seg
+import batched
\ No newline at end of file
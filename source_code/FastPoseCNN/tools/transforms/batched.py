@@ -0,0 +1,250 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Batched pose augmentation
+
+The albumentations pipeline (get_training_augmentation) runs per sample on the
+CPU workers and only knows how to transform images and masks. The
+BatchedPoseAugmentation runs on whole collated batches (on the training
+device), with random parameters drawn per sample from a seeded generator:
+
+    photometric (image only): brightness, contrast, saturation, gamma, gaussian
+        noise and a 3x3 blur. Applied in the [0, 1] range of each image, so the
+        image can be normalized by the encoder preprocessing.
+
+    geometric (image, clean_image, mask, dense targets and instance data): a
+        zoom (scaling about the image center) and a translation. An isotropic
+        scaling and a translation do not change the direction from a pixel to
+        the object center, so the xy unit vectors are only resampled. Zooming
+        by s approximates moving the objects s times closer, so the z (log of
+        the depth) becomes z - log(s). The quaternion and scales are resampled.
+
+Rotations and flips are not used: they would also require rotating the xy
+vectors and the quaternions (a flip is not even a rotation). The aggregated
+ground truth from the dataset (agg_gt) is removed after a geometric
+augmentation, the aggregation layers recompute it from the augmented targets.
+"""
+
+#-------------------------------------------------------------------------------
+# File Constants
+
+# Dense keys resampled with nearest interpolation (per-instance values)
+DENSE_KEYS = ['mask', 'quaternion', 'scales', 'xy', 'z', 'instance_mask']
+
+#-------------------------------------------------------------------------------
+# Classes
+
+class BatchedPoseAugmentation():
+
+    def __init__(
+        self,
+        seed=0,
+        p_photometric=0.9,
+        brightness=0.2,
+        contrast=0.2,
+        saturation=0.3,
+        gamma=0.3,
+        p_noise=0.2,
+        noise_std=0.03,
+        p_blur=0.3,
+        p_geometric=0.5,
+        scale_range=(0.8, 1.25),
+        translate=0.1
+        ):
+
+        # Saving parameters
+        self.seed = seed
+        self.p_photometric = p_photometric
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.gamma = gamma
+        self.p_noise = p_noise
+        self.noise_std = noise_std
+        self.p_blur = p_blur
+        self.p_geometric = p_geometric
+        self.scale_range = scale_range
+        self.translate = translate
+
+        # A generator per device (created with the first batch on it)
+        self.generators = {}
+
+    def get_generator(self, device):
+
+        if device not in self.generators.keys():
+
+            # Different (but reproducible) parameters in each DDP process
+            rank = 0
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                rank = torch.distributed.get_rank()
+
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed + rank)
+            self.generators[device] = generator
+
+        return self.generators[device]
+
+    def uniform(self, low, high, size, generator, device):
+        return low + (high - low) * torch.rand(size, generator=generator, device=device)
+
+    def bernoulli(self, p, size, generator, device):
+        return torch.rand(size, generator=generator, device=device) < p
+
+    def __call__(self, batch):
+
+        device = batch['image'].device
+        generator = self.get_generator(device)
+
+        batch = self.photometric(batch, generator)
+        batch = self.geometric(batch, generator)
+
+        return batch
+
+    #---------------------------------------------------------------------------
+    # Photometric
+
+    def photometric(self, batch, generator):
+
+        image = batch['image'].float()
+        b, c = image.shape[:2]
+        device = image.device
+
+        # Working in the [0, 1] range of each image
+        low = image.reshape((b, -1)).min(dim=1)[0].reshape((b, 1, 1, 1))
+        high = image.reshape((b, -1)).max(dim=1)[0].reshape((b, 1, 1, 1))
+        span = torch.clamp(high - low, min=1e-6)
+        image = (image - low) / span
+
+        # Samples that are augmented (the others use the identity parameters)
+        apply = self.bernoulli(self.p_photometric, (b,), generator, device).reshape((b, 1, 1, 1)).float()
+
+        # Brightness and contrast
+        brightness = self.uniform(-self.brightness, self.brightness, (b, 1, 1, 1), generator, device) * apply
+        contrast = 1 + self.uniform(-self.contrast, self.contrast, (b, 1, 1, 1), generator, device) * apply
+        mean = image.mean(dim=(1, 2, 3), keepdim=True)
+        image = (image - mean) * contrast + mean + brightness
+
+        # Saturation (blending with the grayscale image)
+        if c == 3:
+            saturation = 1 + self.uniform(-self.saturation, self.saturation, (b, 1, 1, 1), generator, device) * apply
+            gray = (0.299 * image[:, 0:1] + 0.587 * image[:, 1:2] + 0.114 * image[:, 2:3])
+            image = gray + (image - gray) * saturation
+
+        # Gamma
+        image = torch.clamp(image, 0, 1)
+        gamma = torch.exp(self.uniform(-self.gamma, self.gamma, (b, 1, 1, 1), generator, device) * apply)
+        image = image ** gamma
+
+        # Gaussian noise
+        noise = self.bernoulli(self.p_noise, (b,), generator, device).reshape((b, 1, 1, 1)).float()
+        image = image + noise * self.noise_std * torch.randn(image.shape, generator=generator, device=device)
+
+        # 3x3 blur (depthwise)
+        blur = self.bernoulli(self.p_blur, (b,), generator, device).reshape((b, 1, 1, 1))
+        kernel = torch.full((c, 1, 3, 3), 1/9, device=device)
+        blurred = F.conv2d(F.pad(image, (1, 1, 1, 1), mode='replicate'), kernel, groups=c)
+        image = torch.where(blur, blurred, image)
+
+        # Back into the original range
+        image = torch.clamp(image, 0, 1) * span + low
+        batch['image'] = image.to(batch['image'].dtype)
+
+        return batch
+
+    #---------------------------------------------------------------------------
+    # Geometric
+
+    def geometric(self, batch, generator):
+
+        image = batch['image']
+        b, _, h, w = image.shape
+        device = image.device
+
+        apply = self.bernoulli(self.p_geometric, (b,), generator, device)
+
+        # Zoom s and translation (tx, ty) in normalized coordinates [-1, 1]
+        log_scale = self.uniform(
+            math.log(self.scale_range[0]),
+            math.log(self.scale_range[1]),
+            (b,), generator, device
+        )
+        log_scale = torch.where(apply, log_scale, torch.zeros_like(log_scale))
+        scale = torch.exp(log_scale)
+        translation = self.uniform(-self.translate, self.translate, (b, 2), generator, device) * 2
+        translation = torch.where(torch.unsqueeze(apply, dim=1), translation, torch.zeros_like(translation))
+
+        if bool(apply.any()) is False:
+            return batch
+
+        # Sampling grid: p_in = (p_out - t) / s
+        theta = torch.zeros((b, 2, 3), device=device)
+        theta[:, 0, 0] = 1 / scale
+        theta[:, 1, 1] = 1 / scale
+        theta[:, :, 2] = -translation / torch.unsqueeze(scale, dim=1)
+        grid = F.affine_grid(theta, (b, 1, h, w), align_corners=False)
+
+        # Images (bilinear, the clean image is channels last)
+        batch['image'] = self.resample(batch['image'], grid, 'bilinear')
+        if 'clean_image' in batch:
+            batch['clean_image'] = self.resample(
+                batch['clean_image'].permute(0, 3, 1, 2),
+                grid,
+                'bilinear'
+            ).permute(0, 2, 3, 1).contiguous()
+
+        # Dense data (nearest, the outside is background)
+        for key in DENSE_KEYS:
+            if key in batch:
+                batch[key] = self.resample(batch[key], grid, 'nearest')
+
+        # Moving the objects closer (or further away)
+        if 'z' in batch:
+            foreground = batch['mask'] > 0
+            batch['z'] = torch.where(foreground, batch['z'] - log_scale.reshape((b, 1, 1)), batch['z'])
+
+        # Per-instance data
+        if 'instance_center_2d' in batch:
+            # (pixel index coordinates, the image center is at (w-1)/2, (h-1)/2)
+            center = torch.tensor([(w - 1) / 2, (h - 1) / 2], device=device)
+            pixel_translation = translation * torch.tensor([w / 2, h / 2], device=device)
+            batch['instance_center_2d'] = (
+                (batch['instance_center_2d'] - center) * scale.reshape((b, 1, 1))
+                + center + torch.unsqueeze(pixel_translation, dim=1)
+            )
+        if 'instance_z' in batch:
+            batch['instance_z'] = batch['instance_z'] - torch.unsqueeze(log_scale, dim=1)
+
+        # The aggregated ground truth no longer matches
+        batch.pop('agg_gt', None)
+
+        return batch
+
+    def resample(self, tensor, grid, mode):
+
+        # Adding the channel axis to the single channel data
+        single_channel = tensor.dim() == 3
+        if single_channel:
+            tensor = torch.unsqueeze(tensor, dim=1)
+
+        resampled = F.grid_sample(
+            tensor.float(),
+            grid,
+            mode=mode,
+            padding_mode='zeros',
+            align_corners=False
+        )
+
+        if tensor.dtype.is_floating_point is False:
+            resampled = torch.round(resampled)
+        resampled = resampled.to(tensor.dtype)
+
+        if single_channel:
+            resampled = resampled[:, 0]
+
+        return resampled
@@ -20,11 +20,6 @@ import scipy.ndimage
 import torch
 import torchvision
 
-import matplotlib
-#matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.cm
-
 # Local Imports
 root = pathlib.Path(os.getenv("ROOT_DIR"))
 sys.path.append(str(pathlib.Path(__file__).parent))
@@ -33,9 +28,40 @@ import project as pj
 import draw as dr
 import data_manipulation as dm
 
+#-------------------------------------------------------------------------------
+# Documentation
+
+"""
+# Summary images
+
+The summaries (compare_* functions) are composed with numpy and cv2 only: each
+keyword of make_summary_image is a row of the grid, each sample of the batch a
+column, and the name of the row is written on its first tile. The result is a
+np.uint8 (HxWx3) image, ready for SummaryWriter.add_image(..., dataformats='HWC')
+or skimage.io.imsave. The images follow the matplotlib.imshow conventions:
+float images are in [0,1], integer images in [0,255] and single channel (HxW)
+data is shown with the viridis colormap.
+
+matplotlib is only imported (lazily) to plot the APs.
+"""
+
 #-------------------------------------------------------------------------------
 # File's Constants
 
+# Colormaps (names as in matplotlib) available without matplotlib
+COLORMAPS = {
+    'hsv': cv2.COLORMAP_HSV,
+    'viridis': cv2.COLORMAP_VIRIDIS,
+    'jet': cv2.COLORMAP_JET,
+    'magma': cv2.COLORMAP_MAGMA,
+    'inferno': cv2.COLORMAP_INFERNO,
+    'plasma': cv2.COLORMAP_PLASMA
+}
+
+# Summary image layout (pixels)
+TILE_PADDING = 2
+LABEL_MARGIN = 5
+
 #-------------------------------------------------------------------------------
 # Class
 
@@ -85,14 +111,8 @@ def get_visualized_u_vector_xy(mask, xy, colormap='hsv'):
     # Determing the angle of the unit vectors: f: R^2 -> R^1
     angle = np.arctan2(xy[:,:,0], xy[:,:,1])
 
-    # Create norm function to shift data to [0:1]
-    norm = matplotlib.colors.Normalize(vmin=np.min(angle), vmax=np.max(angle))
-
-    # Obtain the colormap of choice
-    my_colormap = matplotlib.cm.get_cmap(colormap)
-    
-    # Normalize data, apply the colormap, make it bytes (np.array), and remove the alpha channel
-    colorized_angle = my_colormap(norm(angle), bytes=True)[:,:,:3] # removing alpha channel
+    # Normalize data to [0:1] and apply the colormap (np.uint8 RGB)
+    colorized_angle = apply_colormap(angle, np.min(angle), np.max(angle), colormap)
 
     # Removing background
     colorized_angle = np.where(np.expand_dims(mask, axis=-1) == 0, 0, colorized_angle)
@@ -139,14 +159,8 @@ def get_visualized_simple_xys(xys):
 
 def get_visualized_z(z, colormap='viridis'):
 
-    # Create norm function to shift data to [0:1]
-    norm = matplotlib.colors.Normalize(vmin=0, vmax=8)
-
-    # Obtain the colormap of choice
-    my_colormap = matplotlib.cm.get_cmap(colormap)
-    
-    # Normalize data, apply the colormap, make it bytes (np.array), and remove the alpha channel
-    colorized_z = my_colormap(norm(z), bytes=True)[:,:,:3] # removing alpha channel
+    # Normalize data to [0:1] and apply the colormap (np.uint8 RGB)
+    colorized_z = apply_colormap(z, 0, 8, colormap)
     
     return colorized_z
 
@@ -187,12 +201,9 @@ def get_visualized_quaternion(quaternion, bg='black'):
     quaternion = dm.set_image_data_format(quaternion, 'channels_last')
     empty_quaternion = np.zeros_like(quaternion)
 
-    # creating norm function
-    norm = matplotlib.colors.Normalize(vmin=-1, vmax=1)
-
-    # Normalize data
-    norm_quat = norm(quaternion)
-    empty_norm_quat = norm(empty_quaternion)
+    # Normalize data from [-1:1] to [0:1]
+    norm_quat = (quaternion + 1) / 2
+    empty_norm_quat = (empty_quaternion + 1) / 2
 
     # Colorized quat
     colorized_quat = d4_to_d3(norm_quat)
@@ -394,75 +405,141 @@ def draw_pts(draw_image, pts, color, t=1):
     return draw_image
 
 #-------------------------------------------------------------------------------
-# General Matplotlib Functions
+# General Image Functions
 
-def make_summary_figure(**images):
+def apply_colormap(data, vmin, vmax, colormap='viridis'):
+    """
+    Args:
+        data (np.array): HxW data
+        vmin, vmax (float): range of the data mapped to the colormap
+        colormap (str): name of the colormap (see COLORMAPS)
+    Output:
+        colorized_data (np.array): HxWx3 np.uint8 RGB image
+    """
 
-    # Calculating the number of rows and columns
-    nr = len(images)
-    nc = images[list(images.keys())[0]].shape[0]
-    
-    h = nr * images[list(images.keys())[0]][0].shape[0]
-    w = nc * images[list(images.keys())[0]][0].shape[1]
-
-    largest_dim = max(h,w)
-    largest_size_in_inches = 8
-
-    h_ratio = h/largest_dim
-    w_ratio = w/largest_dim
-
-    cal_h = h_ratio * largest_size_in_inches
-    cal_w = w_ratio * largest_size_in_inches
-
-    # Initializing the figure and axs
-    fig = plt.figure(figsize=(cal_w, cal_h))
-    fig.subplots_adjust(
-        left=0,
-        bottom=0,
-        right=1,
-        top=1,
-        wspace=0,
-        hspace=0
-    )
+    if colormap not in COLORMAPS.keys():
+        raise RuntimeError(f'Invalid colormap: {colormap}')
 
-    for i, (name, image) in enumerate(images.items()):
-        if len(image.shape) >= 3: # NHW or NCHW
-            for j, img in enumerate(image):
+    # Normalize data to [0:1] and then to [0:255] (colormap index)
+    norm_data = (np.asarray(data, dtype=np.float32) - vmin) / max(vmax - vmin, 1e-8)
+    index = (np.clip(norm_data, 0, 1) * 255).astype(np.uint8)
 
-                plt.subplot(nr, nc, 1 + j + nc*i)
-                plt.xticks([])
-                plt.yticks([])
-                if j == 0:
-                    plt.ylabel(' '.join(name.split('_')).title())
-                    plt.text(25, 25, ' '.join(name.split('_')).title(), bbox=dict(facecolor='white', alpha=0.5), color=(0,0,0))
+    # Apply the colormap (cv2 is BGR)
+    colorized_data = cv2.applyColorMap(index, COLORMAPS[colormap])
 
-                img = dm.set_image_data_format(img, "channels_last")
+    return np.ascontiguousarray(colorized_data[:,:,::-1])
 
-                plt.imshow(img)
+def to_uint8_image(image):
+
+    # Convert tensors to np.array
+    if isinstance(image, torch.Tensor):
+        image = image.detach().cpu().numpy()
+
+    # Single channel data is colorized (as matplotlib.imshow)
+    if len(image.shape) == 2:
+        return apply_colormap(image, np.min(image), np.max(image))
+
+    # Make channels_last in the image
+    image = dm.set_image_data_format(image, 'channels_last')
+
+    # Grayscale to RGB, and removing the alpha channel
+    if image.shape[-1] == 1:
+        image = np.repeat(image, 3, axis=-1)
+    image = image[:,:,:3]
+
+    # Float images are in [0,1], integer images in [0,255]
+    if image.dtype != np.uint8:
+        if np.issubdtype(image.dtype, np.floating):
+            image = np.clip(np.nan_to_num(image), 0, 1) * 255
+        image = np.clip(image, 0, 255).astype(np.uint8)
+
+    return np.ascontiguousarray(image)
+
+def draw_label(image, text):
+
+    # Scaling the text with the size of the tile
+    h, w = image.shape[:2]
+    font_scale = max(0.3, min(h, w) / 480)
+    thickness = max(1, int(round(font_scale)))
+    (text_w, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+
+    # Semi-transparent white box behind the text
+    x1, y1 = LABEL_MARGIN, LABEL_MARGIN
+    x2 = min(w, x1 + text_w + 2*LABEL_MARGIN)
+    y2 = min(h, y1 + text_h + baseline + 2*LABEL_MARGIN)
+    image[y1:y2, x1:x2] = (image[y1:y2, x1:x2].astype(np.float32) * 0.5 + 127.5).astype(np.uint8)
+
+    # Black text
+    cv2.putText(
+        image,
+        text,
+        (x1 + LABEL_MARGIN, y1 + LABEL_MARGIN + text_h),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        font_scale,
+        (0,0,0),
+        thickness,
+        cv2.LINE_AA
+    )
+
+    return image
+
+def make_summary_image(**images):
+    """
+    Args:
+        **images: rows of the grid, each one a batch of images (NxHxW, NxHxWxC
+            or NxCxHxW) or a single HxW image
+    Output:
+        summary_image (np.array): HxWx3 np.uint8 grid of the images
+    """
+
+    # Collecting the tiles of each row
+    rows = []
+    for name, image in images.items():
+        if len(image.shape) >= 3: # NHW or NCHW
+            rows.append((name, [to_uint8_image(img) for img in image]))
         else: # HW only
+            rows.append((name, [to_uint8_image(image)]))
+
+    # Calculating the number of rows and columns, and the size of a tile
+    nr = len(rows)
+    nc = max([len(tiles) for _, tiles in rows])
+    h, w = rows[0][1][0].shape[:2]
+
+    # White background (the padding between the tiles)
+    summary_image = np.full(
+        (nr * h + (nr - 1) * TILE_PADDING, nc * w + (nc - 1) * TILE_PADDING, 3),
+        255,
+        dtype=np.uint8
+    )
+
+    for i, (name, tiles) in enumerate(rows):
+        for j, tile in enumerate(tiles):
+
+            # All the tiles have the size of the first one
+            if tile.shape[:2] != (h, w):
+                tile = cv2.resize(tile, (w, h), interpolation=cv2.INTER_NEAREST)
 
-            plt.subplot(nr, nc, i + 1)
-            plt.xticks([])
-            plt.yticks([])
-            plt.title(' '.join(name.split('_')).title())
-            plt.imshow(image)
+            # Writting the name of the row on its first tile
+            if j == 0:
+                tile = draw_label(tile.copy(), ' '.join(name.split('_')).title())
 
-    # Overall figure configurations
-    #plt.tight_layout()
+            y, x = i * (h + TILE_PADDING), j * (w + TILE_PADDING)
+            summary_image[y:y+h, x:x+w] = tile
 
-    return fig    
+    return summary_image
 
 def debug_show(**images):
 
-    fig = make_summary_figure(**images)
-    plt.show()
+    summary_image = make_summary_image(**images)
+    cv2.imshow('debug', cv2.cvtColor(summary_image, cv2.COLOR_RGB2BGR))
+    cv2.waitKey(0)
 
 def show_tensor(tensor: torch.Tensor):
 
     # Standardizing all the data
-    img = dm.standardize_image(tensor)
-    plt.imshow(img)
-    plt.show()
+    img = to_uint8_image(dm.standardize_image(tensor))
+    cv2.imshow('tensor', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    cv2.waitKey(0)
 
 # #-----------------------------------------------------------------------------
 # Single Sample Ground Truth and Prediction Visualization
@@ -472,7 +549,7 @@ def compare_all(preds, gts, mask_colormap):
     Compare the performance of all matching attributes between the predictions 
     and the ground truth data (within a single sample). Grabbing all of the 
     images within the single sample and stacking them into a single image
-    container to later create a figure with the images.
+    container to later create an image grid with the images.
     """
 
     # Selecting clean image if available
@@ -510,13 +587,13 @@ def compare_all(preds, gts, mask_colormap):
             pred_imgs = np.concatenate((pred_imgs, np.expand_dims(pred_img, axis=0)), axis=0)
             gt_imgs = np.concatenate((gt_imgs, np.expand_dims(gt_img, axis=0)), axis=0)
 
-    # Create figure of the prediction and ground truths
-    fig = make_summary_figure(
+    # Create an image grid of the prediction and ground truths
+    summary_image = make_summary_image(
         gt = gt_imgs,
         pred = pred_imgs
     )
 
-    return fig    
+    return summary_image
 
 #-------------------------------------------------------------------------------
 # Visualization of Individual Task
@@ -527,7 +604,7 @@ def compare_mask_performance(sample, pred_cat_mask, colormap):
     image_key = 'clean_image' if 'clean_image' in sample.keys() else 'image'
     mask_key = 'clean_mask' if 'clean_mask' in sample.keys() else 'mask'
     
-    # Converting visual images into np.uint8 for matplotlib compatibility
+    # Selecting the visual image
     image_vis = sample[image_key]#.astype(np.uint8)
     gt_mask = sample[mask_key].astype(np.uint8)
 
@@ -535,20 +612,20 @@ def compare_mask_performance(sample, pred_cat_mask, colormap):
     gt_mask_vis = get_visualized_masks(gt_mask, colormap)
     pred_mask_vis = get_visualized_masks(pred_cat_mask, colormap)
 
-    # Creating a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Creating an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         image=image_vis,
         ground_truth_mask=gt_mask_vis,
         predicted_mask=pred_mask_vis)
 
-    return summary_fig
+    return summary_image
 
 def compare_quat_performance(sample, pred_quaternion, pred_cat_mask, mask_colormap):
 
     # Selecting clean image and mask if available
     image_key = 'clean_image' if 'clean_image' in sample.keys() else 'image'
 
-    # Converting visual images into np.uint8 for matplotlib compatibility
+    # Selecting the visual image
     image_vis = sample[image_key]#.astype(np.uint8)
     pred_mask_vis = get_visualized_masks(pred_cat_mask, mask_colormap)
 
@@ -556,22 +633,22 @@ def compare_quat_performance(sample, pred_quaternion, pred_cat_mask, mask_colorm
     gt_quat_vis = get_visualized_quaternions(sample['quaternion'])
     pred_quat_vis = get_visualized_quaternions(pred_quaternion)
 
-    # Create a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Create an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         image = image_vis,
         pred_mask = pred_mask_vis,
         gt_quaternion = gt_quat_vis,
         pred_quaternion = pred_quat_vis
     )
 
-    return summary_fig
+    return summary_image
 
 def compare_xy_performance(sample, pred_xy, pred_cat_mask, mask_colormap):
 
     # Selecting clean image and mask if available
     image_key = 'clean_image' if 'clean_image' in sample.keys() else 'image'
 
-    # Converting visual images into np.uint8 for matplotlib compatibility
+    # Selecting the visual image
     image_vis = sample[image_key]#.astype(np.uint8)
     pred_mask_vis = get_visualized_masks(pred_cat_mask, mask_colormap)
 
@@ -581,22 +658,22 @@ def compare_xy_performance(sample, pred_xy, pred_cat_mask, mask_colormap):
     gt_xy_vis = get_visualized_u_vector_xys(sample['mask'], sample['xy'])
     pred_xy_vis = get_visualized_u_vector_xys(pred_cat_mask, pred_xy)
 
-    # Create a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Create an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         image = image_vis,
         pred_mask=pred_mask_vis,
         gt_xy = gt_xy_vis,
         pred_xy = pred_xy_vis
     )
 
-    return summary_fig
+    return summary_image
 
 def compare_z_performance(sample, pred_z, pred_cat_mask, mask_colormap):
 
     # Selecting clean image and mask if available
     image_key = 'clean_image' if 'clean_image' in sample.keys() else 'image'
 
-    # Converting visual images into np.uint8 for matplotlib compatibility
+    # Selecting the visual image
     image_vis = sample[image_key]#.astype(np.uint8)
     pred_mask_vis = get_visualized_masks(pred_cat_mask, mask_colormap)
 
@@ -604,22 +681,22 @@ def compare_z_performance(sample, pred_z, pred_cat_mask, mask_colormap):
     gt_z_vis = get_visualized_zs(sample['z'])
     pred_z_vis = get_visualized_zs(pred_z)
 
-    # Create a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Create an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         image = image_vis,
         pred_mask=pred_mask_vis,
         gt_z = gt_z_vis,
         pred_z = pred_z_vis
     )
 
-    return summary_fig
+    return summary_image
 
 def compare_scales_performance(sample, pred_scales, pred_cat_mask, mask_colormap):
 
     # Selecting clean image and mask if available
     image_key = 'clean_image' if 'clean_image' in sample.keys() else 'image'
 
-    # Converting visual images into np.uint8 for matplotlib compatibility
+    # Selecting the visual image
     image_vis = sample[image_key]#.astype(np.uint8)
     pred_mask_vis = get_visualized_masks(pred_cat_mask, mask_colormap)
 
@@ -627,17 +704,29 @@ def compare_scales_performance(sample, pred_scales, pred_cat_mask, mask_colormap
     gt_scales_vis = get_visualized_scales(sample['scales'])
     pred_scales_vis = get_visualized_scales(pred_scales)
 
-    # Create a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Create an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         image = image_vis,
         pred_mask=pred_mask_vis,
         gt_scales = gt_scales_vis,
         pred_z = pred_scales_vis
     )
 
-    return summary_fig
+    return summary_image
+
+def get_return_as_grid(return_as_grid, return_as_figure):
+
+    # return_as_figure is the deprecated name of return_as_grid (the figures
+    # were replaced by the image grids of make_summary_image)
+    if return_as_figure is not None:
+        warnings.warn('return_as_figure is deprecated, use return_as_grid', DeprecationWarning)
+        return return_as_figure
 
-def compare_hough_voting_performance(image, gt_pred_matches, return_as_figure=True):
+    return return_as_grid
+
+def compare_hough_voting_performance(image, gt_pred_matches, return_as_grid=True, return_as_figure=None):
+
+    return_as_grid = get_return_as_grid(return_as_grid, return_as_figure)
 
     # Obtaining image shape information
     b, h, w, _ = image.shape
@@ -708,9 +797,9 @@ def compare_hough_voting_performance(image, gt_pred_matches, return_as_figure=Tr
         'pred_hv': drawn_pred_hv.cpu().numpy()
     }
 
-    if return_as_figure:
-        summary_fig = make_summary_figure(**images)
-        return summary_fig
+    if return_as_grid:
+        summary_image = make_summary_image(**images)
+        return summary_image
     else:
         return images
 
@@ -791,14 +880,14 @@ def compare_pose_performance(sample, pred_quaternion):
     gt_poses = np.array(gt_poses, dtype=np.uint8)
     pred_poses = np.array(pred_poses, dtype=np.uint8)
 
-    # Creating a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Creating an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         image=image,
         gt_pose=gt_poses,
         pred_pose=pred_poses
     )
 
-    return summary_fig  
+    return summary_image  
 
 def compare_pose_performance_v2(preds, gts, intrinsics):
 
@@ -850,13 +939,13 @@ def compare_pose_performance_v2(preds, gts, intrinsics):
     gt_poses = np.array(gt_poses)
     pred_poses = np.array(pred_poses)
 
-    # Creating a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Creating an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         gt_pose=gt_poses,
         pred_pose=pred_poses
     )
 
-    return summary_fig
+    return summary_image
 
 def compare_pose_performance_v3(preds, gts, intrinsics, pred_mask=None, mask_colormap=None):
 
@@ -907,13 +996,13 @@ def compare_pose_performance_v3(preds, gts, intrinsics, pred_mask=None, mask_col
     # Convert list to array 
     poses = np.array(poses)
 
-    # Creating a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Creating an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         poses=poses,
         pred_mask=pred_mask
     )
 
-    return summary_fig
+    return summary_image
 
 def compare_pose_performance_v4(sample, pred_cat_mask, pred_gt_matches, intrinsics, mask_colormap):
     
@@ -991,13 +1080,13 @@ def compare_pose_performance_v4(sample, pred_cat_mask, pred_gt_matches, intrinsi
     # Stack the drawn images
     draw_images = np.stack(draw_images)
 
-    # Creating a matplotlib figure illustrating the inputs vs outputs
-    summary_fig = make_summary_figure(
+    # Creating an image grid illustrating the inputs vs outputs
+    summary_image = make_summary_image(
         poses=draw_images,
         pred_mask=pred_mask_vis
     )
 
-    return summary_fig
+    return summary_image
 
 def compare_pose_performance_v5(
     image: torch.Tensor, 
@@ -1005,9 +1094,12 @@ def compare_pose_performance_v5(
     pred_cat_mask: torch.Tensor, 
     mask_colormap,
     intrinsics: np.ndarray,
-    return_as_figure: bool = True,
+    return_as_grid: bool = True,
+    return_as_figure: bool = None
     ):
 
+    return_as_grid = get_return_as_grid(return_as_grid, return_as_figure)
+
     # Draw image
     draw_image = image.cpu().numpy()
 
@@ -1053,9 +1145,9 @@ def compare_pose_performance_v5(
         'pred_mask': pred_mask_vis
     }        
 
-    if return_as_figure:
-        summary_fig = make_summary_figure(**images)
-        return summary_fig
+    if return_as_grid:
+        summary_image = make_summary_image(**images)
+        return summary_image
     else:
         return images
 
@@ -1088,7 +1180,7 @@ def compare_all_performance(sample, outputs, pred_gt_matches, intrinsics, mask_c
     hv_images = compare_hough_voting_performance(
         sample['clean_image'],
         pred_gt_matches,
-        return_as_figure=False
+        return_as_grid=False
     )
 
     # Pose
@@ -1098,7 +1190,7 @@ def compare_all_performance(sample, outputs, pred_gt_matches, intrinsics, mask_c
         outputs['auxilary']['cat_mask'],
         mask_colormap,
         intrinsics,
-        return_as_figure=False
+        return_as_grid=False
     )
 
     gt_images = {
@@ -1123,12 +1215,12 @@ def compare_all_performance(sample, outputs, pred_gt_matches, intrinsics, mask_c
         'poses': pose_images['poses'],
     }
 
-    # Creating a gigantic figure
-    poses_fig = make_summary_figure(**pose_images)
-    gt_fig = make_summary_figure(**gt_images)
-    pred_fig = make_summary_figure(**pred_images)
+    # Creating gigantic image grids
+    poses_image = make_summary_image(**pose_images)
+    gt_image = make_summary_image(**gt_images)
+    pred_image = make_summary_image(**pred_images)
 
-    return gt_fig, pred_fig, poses_fig
+    return gt_image, pred_image, poses_image
 
 #-------------------------------------------------------------------------------
 # Plot metrics
@@ -1141,6 +1233,9 @@ def plot_ap(
     x_axis_label
     ):
 
+    # Only the AP plots require matplotlib
+    import matplotlib.pyplot as plt
+
     # Initializing the matplotlib figure
     fig = plt.figure()
     plt.title(title)
@@ -1170,6 +1265,9 @@ def plot_aps(
     x_axis_labels
     ):
 
+    # Only the AP plots require matplotlib
+    import matplotlib.pyplot as plt
+
     # Initializing the matplotlib figure
     fig, axs = plt.subplots(1,3, sharey=True, figsize=(10, 5))
 
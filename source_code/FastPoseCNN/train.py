@@ -92,6 +92,23 @@ class PoseRegresssionTask(pl.LightningModule):
         # Saving the metrics
         self.metrics = metrics
 
+        # On-device running statistics of the losses and metrics of each epoch
+        self.running_metrics = {
+            'train': tools.running_metrics.RunningMetrics(track_variance=self.HPARAM.TRACK_METRIC_VARIANCE),
+            'valid': tools.running_metrics.RunningMetrics(track_variance=self.HPARAM.TRACK_METRIC_VARIANCE)
+        }
+
+        # Generator of the dense targets (when the dataset only provides instances)
+        self.dense_target_generator = lib.DenseTargetGenerator()
+
+        # Augmentation of the training batches (on the device)
+        if self.HPARAM.BATCH_AUGMENTATION:
+            self.batch_augmentation = tools.transforms.batched.BatchedPoseAugmentation(
+                seed=self.HPARAM.BATCH_AUGMENTATION_SEED
+            )
+        else:
+            self.batch_augmentation = None
+
     @pl.core.decorators.auto_move_data
     def forward(self, x):
         return self.model(x)
@@ -149,16 +166,42 @@ class PoseRegresssionTask(pl.LightningModule):
         return result
 
     def shared_step(self, mode, batch, batch_idx):
-        
-        # Forward pass the input and generate the prediction of the NN
-        outputs = self.model(batch['image'])
 
-        # Obtaining the aggregated values for the both the ground truth
-        agg_gt = self.model.agg_hough_and_generate_RT(
-            batch['mask'],
-            data=batch
+        # Restoring the compact (quantized) targets, now on the device
+        batch = tools.ds.dequantize_batch(batch)
+
+        # Expanding the per-instance data into the dense targets, on the device
+        if 'instance_mask' in batch and 'quaternion' not in batch:
+            batch.update(self.dense_target_generator(batch))
+
+        # Augmenting the complete training batch
+        if mode == 'train' and self.batch_augmentation is not None:
+            batch = self.batch_augmentation(batch)
+        
+        # Forward pass the input and generate the prediction of the NN (from
+        # the cached encoder features, if the batch has them)
+        outputs = self.model(
+            batch['image'],
+            batch.get('intrinsics'),
+            features=tools.feature_cache.get_batch_features(batch)
         )
 
+        # Obtaining the aggregated values for the both the ground truth, either
+        # already aggregated by the dataset (DATASET_AGG_GT) or through the
+        # aggregation layers
+        if 'agg_gt' in batch:
+            agg_gt = lib.gtf.complete_agg_gt(
+                batch['agg_gt'],
+                batch['instance_mask'],
+                batch.get('xy')
+            )
+        else:
+            agg_gt = self.model.agg_hough_and_generate_RT(
+                batch['mask'],
+                data=batch,
+                inv_intrinsics=torch.inverse(batch['intrinsics']) if 'intrinsics' in batch else None
+            )
+
         if self.HPARAM.PERFORM_AGGREGATION and self.HPARAM.PERFORM_MATCHING:
             # Determine matches between the aggreated ground truth and preds
             gt_pred_matches = lib.gtf.batchwise_find_matches(
@@ -196,12 +239,16 @@ class PoseRegresssionTask(pl.LightningModule):
                 else:
                     multi_task_losses['pose']['total_loss'] += losses['task_total_loss']
 
+        # Scalars of the batch (logged to Tensorboard at once)
+        batch_scalars = {}
+
         # Logging the losses
         for task_name in multi_task_losses.keys():
             
-            # Logging the batch loss to Tensorboard
+            # Logging the batch loss to Tensorboard and to the epoch statistics
             for loss_name, loss_value in multi_task_losses[task_name].items():
-                self.logger.log_metrics(mode, {f'{task_name}/{loss_name}/batch':loss_value.detach().clone()}, batch_idx)
+                batch_scalars[f'{task_name}/{loss_name}/batch'] = loss_value.detach()
+                self.running_metrics[mode].update(f'{task_name}/{loss_name}', loss_value)
 
         # Calculate separate task metrics
         for task_name in self.metrics.keys():
@@ -220,7 +267,11 @@ class PoseRegresssionTask(pl.LightningModule):
         # Logging the metrics
         for task_name in multi_task_metrics.keys():
             for metric_name, metric_value in multi_task_metrics[task_name].items():
-                self.logger.log_metrics(mode, {f'{task_name}/{metric_name}/batch':metric_value.detach().clone()}, batch_idx) 
+                batch_scalars[f'{task_name}/{metric_name}/batch'] = metric_value.detach()
+                self.running_metrics[mode].update(f'{task_name}/{metric_name}', metric_value)
+
+        # Logging the batch scalars (decimated per metric)
+        self.logger.log_metrics(mode, batch_scalars, batch_idx, decimate=True)
 
         return multi_task_losses, multi_task_metrics
 
@@ -334,7 +385,25 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         encoder=None,
         encoder_weights=None,
         train_size=None,
-        valid_size=None
+        valid_size=None,
+        compiled=False,
+        use_index=False,
+        sharded=False,
+        shuffle_buffer_size=1000,
+        cache_size=0,
+        compact=False,
+        dense_targets=True,
+        agg_gt=False,
+        shm_loader=False,
+        ring_size=None,
+        prefetch_depth=0,
+        crop_size=None,
+        resolution_schedule=None,
+        subset_seed=None,
+        balanced_sampling=False,
+        target_distribution=None,
+        feature_cache=False,
+        feature_cache_dtype='float16'
         ):
 
         super().__init__()
@@ -348,6 +417,57 @@ class PoseRegressionDataModule(pl.LightningDataModule):
         self.encoder_weights = encoder_weights
         self.train_size = train_size
         self.valid_size = valid_size
+        self.compiled = compiled
+        self.use_index = use_index
+        self.sharded = sharded
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.cache_size = cache_size
+        self.compact = compact
+        self.dense_targets = dense_targets
+        self.agg_gt = agg_gt
+        self.shm_loader = shm_loader
+        self.ring_size = ring_size
+        self.prefetch_depth = prefetch_depth
+        self.crop_size = crop_size
+        self.resolution_schedule = resolution_schedule
+        self.subset_seed = subset_seed
+        self.balanced_sampling = balanced_sampling
+        self.target_distribution = target_distribution
+        self.feature_cache = feature_cache
+        self.feature_cache_dtype = feature_cache_dtype
+
+        # The frozen encoder of the cached features (see set_feature_encoder)
+        self.feature_encoder = None
+
+        # The batch buffers of the shared-memory ring have a fixed size
+        if shm_loader and resolution_schedule:
+            raise RuntimeError('The shared-memory loader does not support resolution schedules')
+
+        # The encoder features are cached for the full images, in a fixed order
+        if feature_cache and (sharded or crop_size is not None or resolution_schedule):
+            raise RuntimeError('The feature cache does not support sharded datasets, cropping or resolution schedules')
+
+        # The shards only provide the full-resolution dense samples, in the
+        # order of the shards
+        if sharded:
+            unsupported = {
+                'compiled': compiled,
+                'use_index': use_index,
+                'cache_size': cache_size > 0,
+                'compact': compact,
+                'dense_targets': dense_targets is False,
+                'agg_gt': agg_gt,
+                'crop_size': crop_size is not None,
+                'resolution_schedule': bool(resolution_schedule),
+                'subset_seed': subset_seed is not None,
+                'balanced_sampling': balanced_sampling
+            }
+            unsupported = [key for key, value in unsupported.items() if value]
+            if unsupported:
+                raise RuntimeError(f'The sharded dataset does not support {", ".join(unsupported)}')
+
+        # Shared-memory loaders and prefetchers (created once per split)
+        self.loaders = {}
 
     def setup(self, stage=None):
 
@@ -365,40 +485,214 @@ class PoseRegressionDataModule(pl.LightningDataModule):
             if self.selected_classes is None:
                 self.selected_classes = tools.pj.constants.NOCS_CLASSES
 
-            train_dataset = tools.ds.NOCSPoseRegDataset(
-                dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_DATASET")),
-                max_size=self.train_size,
-                classes=self.selected_classes,
-                augmentation=tools.transforms.pose.get_training_augmentation(),
-                preprocessing=tools.transforms.pose.get_preprocessing(preprocessing_fn)
-            )
+            # If requested, serve the dense data from the compiled datasets
+            if self.compiled:
+                train_compiled_dir = pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_COMPILED"))
+                valid_compiled_dir = pathlib.Path(os.getenv("NOCS_CAMERA_VALID_COMPILED"))
+            else:
+                train_compiled_dir = valid_compiled_dir = None
+
+            # If requested, cache the decoded images of each split (in GB)
+            if self.cache_size > 0:
+                train_cache = tools.sample_cache.DecodedSampleCache(
+                    pathlib.Path(os.getenv("SAMPLE_CACHE_DIR")) / 'train',
+                    self.cache_size * 2**30
+                )
+                valid_cache = tools.sample_cache.DecodedSampleCache(
+                    pathlib.Path(os.getenv("SAMPLE_CACHE_DIR")) / 'valid',
+                    self.cache_size * 2**30
+                )
+            else:
+                train_cache = valid_cache = None
+
+            # The dataset indices are written outside of the (possibly read-only) datasets
+            index_dir = os.getenv("DATASET_INDEX_DIR") if self.use_index else None
+
+            # If requested, stream the samples from the sequential shards
+            if self.sharded:
+
+                train_dataset = tools.ds.NOCSPoseRegShardDataset(
+                    shards_dir=pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_SHARDS")),
+                    max_size=self.train_size,
+                    classes=self.selected_classes,
+                    augmentation=tools.transforms.pose.get_training_augmentation(),
+                    preprocessing=tools.transforms.pose.get_preprocessing(preprocessing_fn),
+                    shuffle_buffer_size=self.shuffle_buffer_size
+                )
+
+                valid_dataset = tools.ds.NOCSPoseRegShardDataset(
+                    shards_dir=pathlib.Path(os.getenv("NOCS_CAMERA_VALID_SHARDS")),
+                    max_size=self.valid_size,
+                    classes=self.selected_classes,
+                    augmentation=tools.transforms.pose.get_validation_augmentation(),
+                    preprocessing=tools.transforms.pose.get_preprocessing(preprocessing_fn),
+                    shuffle_buffer_size=self.shuffle_buffer_size
+                )
 
-            valid_dataset = tools.ds.NOCSPoseRegDataset(
-                dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_VALID_DATASET")), 
-                max_size=self.valid_size,
-                classes=self.selected_classes,
-                augmentation=tools.transforms.pose.get_validation_augmentation(),
-                preprocessing=tools.transforms.pose.get_preprocessing(preprocessing_fn)
-            )
+            else:
+
+                train_dataset = tools.ds.NOCSPoseRegDataset(
+                    dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_TRAIN_DATASET")),
+                    max_size=self.train_size,
+                    classes=self.selected_classes,
+                    augmentation=tools.transforms.pose.get_training_augmentation(),
+                    preprocessing=tools.transforms.pose.get_preprocessing(preprocessing_fn),
+                    compiled_dir=train_compiled_dir,
+                    use_index=self.use_index,
+                    index_dir=index_dir,
+                    index_workers=self.num_workers,
+                    cache=train_cache,
+                    compact=self.compact,
+                    dense_targets=self.dense_targets,
+                    instance_data=self.agg_gt,
+                    crop_size=self.crop_size,
+                    resolution_scale=self.get_resolution_scale(0),
+                    subset_seed=self.subset_seed
+                )
+
+                valid_dataset = tools.ds.NOCSPoseRegDataset(
+                    dataset_dir=pathlib.Path(os.getenv("NOCS_CAMERA_VALID_DATASET")), 
+                    max_size=self.valid_size,
+                    classes=self.selected_classes,
+                    augmentation=tools.transforms.pose.get_validation_augmentation(),
+                    preprocessing=tools.transforms.pose.get_preprocessing(preprocessing_fn),
+                    compiled_dir=valid_compiled_dir,
+                    use_index=self.use_index,
+                    index_dir=index_dir,
+                    index_workers=self.num_workers,
+                    cache=valid_cache,
+                    compact=self.compact,
+                    dense_targets=self.dense_targets,
+                    instance_data=self.agg_gt,
+                    subset_seed=self.subset_seed
+                )
 
             self.datasets = {
                 'train': train_dataset,
                 'valid': valid_dataset
             }
+
+            # If requested, compute (once) and attach the encoder features
+            if self.feature_cache:
+                self.setup_feature_cache()
         
         else:
             raise RuntimeError('Dataset needs to be selected')
 
+    def set_feature_encoder(self, encoder):
+        self.feature_encoder = encoder
+
+    def setup_feature_cache(self):
+
+        if self.feature_encoder is None:
+            raise RuntimeError('The feature cache needs the (frozen) encoder, see set_feature_encoder')
+
+        for dataset_key, dataset in self.datasets.items():
+            feature_cache = tools.feature_cache.build_feature_cache(
+                dataset,
+                self.feature_encoder,
+                pathlib.Path(os.getenv("FEATURE_CACHE_DIR")) / dataset_key,
+                encoder_name=self.encoder,
+                dtype=self.feature_cache_dtype,
+                batch_size=self.batch_size,
+                num_workers=self.num_workers
+            )
+            dataset.set_feature_cache(feature_cache)
+
+    def get_resolution_scale(self, epoch):
+
+        # The scale of the last milestone reached ({epoch: scale})
+        if not self.resolution_schedule:
+            return 1.0
+
+        milestones = [x for x in sorted(self.resolution_schedule.keys()) if x <= epoch]
+        return self.resolution_schedule[milestones[-1]] if milestones else 1.0
+
+    def update_resolution(self, epoch):
+
+        # Only the training samples follow the schedule
+        dataset = self.datasets['train']
+        if hasattr(dataset, 'set_resolution_scale'):
+            dataset.set_resolution_scale(self.get_resolution_scale(epoch))
+
+    def set_epoch(self, epoch):
+
+        # Rotating the shards of the ranks (sharded training samples only)
+        dataset = self.datasets['train']
+        if hasattr(dataset, 'set_epoch'):
+            dataset.set_epoch(epoch)
+
     def get_loader(self, dataset_key):
 
         if dataset_key in self.datasets.keys():        
             
-            dataloader = torch.utils.data.DataLoader(
-                self.datasets[dataset_key],
-                num_workers=self.num_workers,
-                batch_size=self.batch_size,
-                shuffle=True
-            )
+            # Reusing the persistent workers, shared-memory ring or prefetcher
+            if dataset_key in self.loaders.keys():
+                return self.loaders[dataset_key]
+
+            # Streamed datasets shuffle by themselves
+            shuffle = not isinstance(self.datasets[dataset_key], torch.utils.data.IterableDataset)
+
+            # If requested, oversampling the rare classes (training only)
+            if self.balanced_sampling and shuffle and dataset_key == 'train':
+                balanced_sampler = tools.sampler.ClassBalancedSampler(
+                    self.datasets[dataset_key].get_class_counts(),
+                    target_distribution=self.target_distribution,
+                    seed=self.subset_seed or 0
+                )
+            else:
+                balanced_sampler = None
+
+            # If requested, the workers write the batches in place (map datasets only)
+            if self.shm_loader and shuffle:
+                self.loaders[dataset_key] = tools.batch_loader.SharedMemoryBatchLoader(
+                    self.datasets[dataset_key],
+                    batch_size=self.batch_size,
+                    num_workers=self.num_workers,
+                    shuffle=shuffle,
+                    ring_size=self.ring_size,
+                    pin_memory=True,
+                    sampler=balanced_sampler
+                )
+                dataloader = self.loaders[dataset_key]
+
+            else:
+
+                # Map datasets can aggregate the ground truth while collating
+                collate_fn = getattr(self.datasets[dataset_key], 'collate', None)
+
+                # A wrapped DataLoader (or any DataLoader when lightning is not
+                # replacing the samplers, see replace_sampler_ddp) does not get
+                # the distributed sampler from lightning, so it is added here
+                _, world_size = tools.dt.get_distributed_info()
+                if balanced_sampler is not None:
+                    sampler = balanced_sampler
+                    shuffle = False
+                elif (self.prefetch_depth > 0 or self.balanced_sampling) and shuffle and world_size > 1:
+                    sampler = torch.utils.data.distributed.DistributedSampler(self.datasets[dataset_key])
+                    shuffle = False
+                else:
+                    sampler = None
+
+                dataloader = torch.utils.data.DataLoader(
+                    self.datasets[dataset_key],
+                    num_workers=self.num_workers,
+                    batch_size=self.batch_size,
+                    shuffle=shuffle,
+                    sampler=sampler,
+                    collate_fn=collate_fn,
+                    pin_memory=self.prefetch_depth > 0 and torch.cuda.is_available()
+                )
+
+            # If requested, the next batches are loaded (and copied to the
+            # device) in the background
+            if self.prefetch_depth > 0:
+                self.loaders[dataset_key] = tools.prefetcher.BatchPrefetcher(
+                    dataloader,
+                    depth=self.prefetch_depth
+                )
+                dataloader = self.loaders[dataset_key]
+
             return dataloader
 
         else:
@@ -441,6 +735,12 @@ if __name__ == '__main__':
     # Ensuring that DISTRIBUTED_BACKEND doesn't cause problems
     HPARAM.DISTRIBUTED_BACKEND = None if HPARAM.NUM_GPUS <= 1 else HPARAM.DISTRIBUTED_BACKEND
 
+    # The aggregated ground truth of the dataset has the layout of the complete
+    # aggregation (hough voting and RT) and is only used for the matching
+    if HPARAM.DATASET_AGG_GT and not (HPARAM.PERFORM_AGGREGATION and HPARAM.PERFORM_HOUGH_VOTING and \
+        HPARAM.PERFORM_RT_CALCULATION and HPARAM.PERFORM_MATCHING):
+        raise RuntimeError('DATASET_AGG_GT requires PERFORM_AGGREGATION, PERFORM_HOUGH_VOTING, PERFORM_RT_CALCULATION and PERFORM_MATCHING')
+
     # Creating data module
     dataset = PoseRegressionDataModule(
         dataset_name=HPARAM.DATASET_NAME,
@@ -450,7 +750,25 @@ if __name__ == '__main__':
         encoder=HPARAM.ENCODER,
         encoder_weights=HPARAM.ENCODER_WEIGHTS,
         train_size=HPARAM.TRAIN_SIZE,
-        valid_size=HPARAM.VALID_SIZE
+        valid_size=HPARAM.VALID_SIZE,
+        compiled=HPARAM.COMPILED_DATASET,
+        use_index=HPARAM.DATASET_INDEX,
+        sharded=HPARAM.SHARDED_DATASET,
+        shuffle_buffer_size=HPARAM.SHUFFLE_BUFFER_SIZE,
+        cache_size=HPARAM.SAMPLE_CACHE_SIZE,
+        compact=HPARAM.COMPACT_TRANSPORT,
+        dense_targets=not HPARAM.DEVICE_DENSE_TARGETS,
+        agg_gt=HPARAM.DATASET_AGG_GT,
+        shm_loader=HPARAM.SHM_LOADER,
+        ring_size=HPARAM.SHM_RING_SIZE,
+        prefetch_depth=HPARAM.PREFETCH_DEPTH,
+        crop_size=HPARAM.CROP_SIZE,
+        resolution_schedule=HPARAM.RESOLUTION_SCHEDULE,
+        subset_seed=HPARAM.SUBSET_SEED,
+        balanced_sampling=HPARAM.BALANCED_SAMPLING,
+        target_distribution=HPARAM.TARGET_CLASS_DISTRIBUTION,
+        feature_cache=HPARAM.FEATURE_CACHE,
+        feature_cache_dtype=HPARAM.FEATURE_CACHE_DTYPE
     )
 
     # Selecting the criterion (specific to each task)
@@ -525,7 +843,7 @@ if __name__ == '__main__':
         # Merge the NameSpaces between the model's hyperparameters and 
         # the evaluation hyperparameters
         for attr in OLD_HPARAM.keys():
-            if attr in ['BACKBONE_ARCH', 'ENCODER', 'ENCODER_WEIGHTS', 'SELECTED_CLASSES']:
+            if attr in ['BACKBONE_ARCH', 'ENCODER', 'ENCODER_WEIGHTS', 'DECODER_SHARING', 'SELECTED_CLASSES']:
                 setattr(HPARAM, attr, OLD_HPARAM[attr])
 
         # Decrease the learning rate to simply fine tune parameters
@@ -539,7 +857,8 @@ if __name__ == '__main__':
             architecture=HPARAM.BACKBONE_ARCH,
             encoder_name=HPARAM.ENCODER,
             encoder_weights=HPARAM.ENCODER_WEIGHTS,
-            classes=len(HPARAM.SELECTED_CLASSES)
+            classes=len(HPARAM.SELECTED_CLASSES),
+            decoder_sharing=HPARAM.DECODER_SHARING
         )
 
         # Create PyTorch Lightning Module
@@ -561,12 +880,14 @@ if __name__ == '__main__':
             encoder_name=HPARAM.ENCODER,
             encoder_weights=HPARAM.ENCODER_WEIGHTS,
             classes=len(HPARAM.SELECTED_CLASSES),
+            decoder_sharing=HPARAM.DECODER_SHARING
         )
 
         # Attaching PyTorch Lightning logic to base model
         model = PoseRegresssionTask(base_model, criterion, metrics, HPARAM)
 
     # Freeze any components of the model
+    # (with a shared decoder, only the task adapters and heads are frozen)
     if HPARAM.FREEZE_ENCODER:
         lib.gtf.freeze(model.model.encoder)
     if HPARAM.FREEZE_MASK_TRAINING:
@@ -582,6 +903,13 @@ if __name__ == '__main__':
         lib.gtf.freeze(model.model.scales_decoder)
         lib.gtf.freeze(model.model.scales_head)
 
+    # The cached encoder features are only valid for a frozen encoder and
+    # non-augmented samples
+    if HPARAM.FEATURE_CACHE:
+        if HPARAM.FREEZE_ENCODER is False or HPARAM.BATCH_AUGMENTATION:
+            raise RuntimeError('The feature cache requires FREEZE_ENCODER and no BATCH_AUGMENTATION')
+        dataset.set_feature_encoder(model.model.encoder)
+
     # If no runs this day, create a runs-of-the-day folder
     date = datetime.datetime.now().strftime('%y-%m-%d')
     run_of_the_day_dir = pathlib.Path(os.getenv("LOGS")) / date
@@ -652,7 +980,8 @@ if __name__ == '__main__':
         distributed_backend=HPARAM.DISTRIBUTED_BACKEND, # required to work
         logger=tb_logger,
         callbacks=[custom_callback, loss_checkpoint_callback],
-        gradient_clip_val=0.5
+        gradient_clip_val=0.5,
+        replace_sampler_ddp=not HPARAM.BALANCED_SAMPLING # (the balanced sampler shards itself)
     )
 
     # Train